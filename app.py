@@ -1,59 +1,175 @@
+import logging
 import os
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from dotenv import load_dotenv
 import google.generativeai as genai
 import json
-import traceback # Import traceback for detailed error info
+import re
+import time
+from cancellation import ActiveTurns, CancelScope, TurnCancelled
+from history_manager import HistoryCompactor
+from knowledge_base import KnowledgeBase
+from log_config import setup_logging
+from metrics import metrics
+from response_cache import ResponseCache
+from session_manager import ChatSessionManager
+from tool_cache import ToolResultCache
+from tool_executor import ToolExecutor
+from tool_prefetch import PhraseMatcher, prefetch_context, prefetch_tool_calls
+from tool_registry import ToolArgumentError, ToolRegistry
+from upstream import UpstreamDispatcher
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Log records are handed to a background thread for writing, so request threads never block on stdout.
+# Set LOG_LEVEL=DEBUG to see the step-by-step trace of each turn.
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# --- Tool registry ---
+# Every tool the model may call is registered here with the @available_tools.tool decorator.
+# The Gemini function declaration is derived from the function's type annotations and docstring,
+# and its argument validator is compiled once at startup, so adding a tool means writing one function.
+available_tools = ToolRegistry()
+
+# Results of tools registered with `cache_ttl=<seconds>` are cached here, keyed on normalized arguments.
+# Set TOOL_CACHE_DISK_PATH to a sqlite file to keep cached results across restarts.
+tool_result_cache = ToolResultCache(
+    max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    disk_path=os.getenv("TOOL_CACHE_DISK_PATH") or None,
+)
+
+
+# Simulate search results - add more complex logic/data as needed
+SIMULATED_SEARCH_RESULTS = {
+    "weather in london": "It's currently cloudy with a chance of rain in London.",
+    "capital of france": "The capital of France is Paris.",
+    "current date": "The current date is May 2, 2025.",
+    "who is the president of the united states": "The current president of the United States is Joe Biden (as of 2025).",
+    "capital of india": "The capital of India is New Delhi.",
+    "hi": "Hello!",
+    "hello": "Hi there!",
+    "what is artificial intelligence": "Artificial intelligence is a field focusing on creating intelligent agents, which perceive their environment and take actions to maximize success at goal achievement.",
+    # Add more simulated results here for different queries
+}
+
+# --- Knowledge base behind search_tool ---
+# A BM25 index (optionally fused with hashed-embedding similarity) built once at startup. By default it holds
+# just the simulated results above; set KNOWLEDGE_BASE_PATH to an index directory built with
+# `python knowledge_base.py add <dir> passages.jsonl` to search your own passages. That index is memory-mapped
+# rather than loaded, and passages added later go into a new segment instead of rebuilding it.
+knowledge_base = KnowledgeBase(
+    path=os.getenv("KNOWLEDGE_BASE_PATH") or None,
+    embedding_dimensions=int(os.getenv("KNOWLEDGE_BASE_EMBEDDING_DIMENSIONS", "0")),
+    min_coverage=float(os.getenv("KNOWLEDGE_BASE_MIN_COVERAGE", "0.6")),
+)
+if os.getenv("KNOWLEDGE_BASE_PATH"):
+    logger.info("Knowledge Base: %s passages from %s", len(knowledge_base), os.getenv("KNOWLEDGE_BASE_PATH"))
+else:
+    knowledge_base.add({"title": query, "text": text} for query, text in SIMULATED_SEARCH_RESULTS.items())
+SEARCH_TOOL_TOP_K = int(os.getenv("SEARCH_TOOL_TOP_K", "3"))
+
+
+# --- Define the simulated tool function ---
+# This function MUST return a Python dictionary for the content of the 'response' field.
+# With TOOL_PREFETCH_ENABLED=1, messages that mention one of the known queries get the result fetched
+# before the first model call (see `prefetch`), so the model can usually answer in a single call.
+# The known queries are those of the sample passages, so there is nothing to prefetch with a KNOWLEDGE_BASE_PATH.
+@available_tools.tool(
+    timeout=float(os.getenv("SEARCH_TOOL_TIMEOUT_SECONDS", "5")),
+    cache_ttl=float(os.getenv("SEARCH_TOOL_CACHE_TTL_SECONDS", "300")),
+    prefetch=None if os.getenv("KNOWLEDGE_BASE_PATH") else PhraseMatcher(SIMULATED_SEARCH_RESULTS),
+)
+def search_tool(query: str):
+    """
+    Searches the web for information. Use this for questions about current events, facts, or anything you don't know.
+
+    Args:
+        query: The search query.
+    """
+    # Looks the query up in the knowledge base and returns the best SEARCH_TOOL_TOP_K passages.
+    # It returns a Python dictionary as the result content for the API response.
+    logger.debug("Tool Call: Agent requested search for: %s", query)
+    passages = knowledge_base.search(query, top_k=SEARCH_TOOL_TOP_K)
+    if not passages:
+        return {"result": f"No information found for '{query}'."}
+    logger.debug("Tool Result: %s passages, best: %s", len(passages), passages[0]["text"])
+    # **FIX:** ALWAYS return the result text wrapped inside a Python dictionary.
+    # The key name ("result" here) matches documentation examples; it holds the best passage, and
+    # "passages" lists the other matches in order (the model can use them when the best one doesn't answer).
+    # This dictionary will be serialized into a Protobuf Struct for the API response's 'response' field.
+    return {"result": passages[0]["text"], "passages": [passage["text"] for passage in passages[1:]]}
+
+
+# --- Model and session pool setup ---
+# Everything that talks to the model goes through `model` (a genai.GenerativeModel, or any object with the
+# same start_chat()/send_message() interface, wrapped in an UpstreamDispatcher) and the session pool built around it.
+model = None
+session_manager = None
+genai_initialized = False
+
+
+def install_model(new_model):
+    """
+    Makes `new_model` the model used for all chat sessions and starts a fresh session pool around it.
+    Called once at startup with the Gemini model; benchmarks and tests call it with a local stand-in
+    (see bench/fake_gemini.py) so the server can run without network access or an API key.
+    """
+    global model, session_manager, genai_initialized
+    # Every model call from every session goes through one dispatcher: it keeps calls under the API quota
+    # (UPSTREAM_REQUESTS_PER_SECOND), retries 429s with backoff instead of failing the turn, and can share one call
+    # between identical standalone first messages in flight at the same time (UPSTREAM_COALESCE_ENABLED=1).
+    dispatcher = UpstreamDispatcher(
+        new_model,
+        requests_per_second=float(os.getenv("UPSTREAM_REQUESTS_PER_SECOND", "0")),
+        burst=float(os.getenv("UPSTREAM_BURST")) if os.getenv("UPSTREAM_BURST") else None,
+        max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "3")),
+        retry_base_seconds=float(os.getenv("UPSTREAM_RETRY_BASE_SECONDS", "0.5")),
+        retry_max_seconds=float(os.getenv("UPSTREAM_RETRY_MAX_SECONDS", "8")),
+        coalesce=os.getenv("UPSTREAM_COALESCE_ENABLED", "0") == "1",
+    )
+    model = dispatcher
+    # Each client gets its own chat session (with its own history) from this pool.
+    # A fresh chat object is created with empty history the first time a session id is seen.
+    session_manager = ChatSessionManager(
+        chat_factory=lambda: dispatcher.start_chat(history=[]),
+        max_sessions=int(os.getenv("CHAT_MAX_SESSIONS", "1000")),
+        idle_ttl_seconds=float(os.getenv("CHAT_SESSION_IDLE_TTL_SECONDS", "1800")),
+        max_history_messages=int(os.getenv("CHAT_MAX_HISTORY_MESSAGES", "40")),
+        # Older tool results are shortened and the history is held to a token budget,
+        # so each turn's request doesn't keep growing with the length of the conversation
+        history_compactor=HistoryCompactor(
+            keep_recent_turns=int(os.getenv("CHAT_HISTORY_KEEP_RECENT_TURNS", "6")),
+            token_budget=int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "8000")),
+        ),
+    )
+    genai_initialized = True
+
+
 # Configure the Google Generative AI library
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
-    print("\n--- Configuration Error: GOOGLE_API_KEY not found in .env file ---")
-    print("Please create a .env file in the same directory as app.py and add GOOGLE_API_KEY=YOUR_API_KEY_HERE\n")
-    # Set flag to indicate initialization failure
-    genai_initialized = False
+    logger.error("Configuration Error: GOOGLE_API_KEY not found in .env file")
+    logger.error("Please create a .env file in the same directory as app.py and add GOOGLE_API_KEY=YOUR_API_KEY_HERE")
 else:
     try:
-        genai.configure(api_key=GOOGLE_API_KEY)
+        # The client (and its connection) is created once and reused by every call: with the default gRPC
+        # transport all calls share one multiplexed HTTP/2 connection; GENAI_TRANSPORT=rest uses a pooled
+        # keep-alive HTTP/1.1 session instead.
+        genai.configure(api_key=GOOGLE_API_KEY, transport=os.getenv("GENAI_TRANSPORT") or None)
         # Initialize the generative model
         # Use a model that supports function calling (e.g., gemini-1.5-flash or gemini-1.0-pro)
         # Check https://ai.google.dev/models/gemini for available models and their capabilities
-        print(f"Attempting to initialize Gemini model...")
-        model = genai.GenerativeModel(
+        logger.info("Attempting to initialize Gemini model...")
+        install_model(genai.GenerativeModel(
             model_name='gemini-1.5-flash', # Or 'gemini-1.0-pro' - Adjust if needed based on your key access
-            tools=[{
-                "function_declarations": [
-                    {
-                        "name": "search_tool",
-                        "description": "Searches the web for information. Use this for questions about current events, facts, or anything you don't know.",
-                        "parameters": {
-                            "type": "OBJECT",
-                            "properties": {
-                                "query": {
-                                    "type": "STRING",
-                                    "description": "The search query."
-                                }
-                            },
-                            "required": ["query"]
-                        }
-                    }
-                ]
-            }]
-        )
-        # Start a chat session with empty history initially
-        # This object maintains the conversation state for the session
-        chat = model.start_chat(history=[])
-        genai_initialized = True
-        print("Google Generative AI model initialized successfully.")
+            tools=available_tools.gemini_tools(), # Function declarations derived from the registered tools
+        ))
+        logger.info("Google Generative AI model initialized successfully.")
     except Exception as e:
-        print(f"\n--- Google API Initialization Error: {e} ---")
-        print("Please double-check your GOOGLE_API_KEY and ensure the model name ('gemini-1.5-flash') is correct and available to your key.\n")
-        model = None
-        chat = None
-        genai_initialized = False
+        logger.error("Google API Initialization Error: %s", e)
+        logger.error("Please double-check your GOOGLE_API_KEY and ensure the model name ('gemini-1.5-flash') is correct and available to your key.")
 
 
 app = Flask(__name__)
@@ -62,249 +178,399 @@ app = Flask(__name__)
 app.static_folder = os.path.join(os.path.dirname(__file__), 'static')
 
 
-# --- Define the simulated tool function ---
-# This function MUST return a Python dictionary for the content of the 'response' field.
-def search_tool(query):
-    """
-    This is a *simulated* search function.
-    It returns a Python dictionary as the result content for the API response.
-    """
-    print(f"--- Simulated Tool Call: Agent requested search for: {query} ---")
-    # Simulate search results - add more complex logic/data as needed
-    simulated_results = {
-        "weather in london": "It's currently cloudy with a chance of rain in London.",
-        "capital of france": "The capital of France is Paris.",
-        "current date": "The current date is May 2, 2025.",
-        "who is the president of the united states": "The current president of the United States is Joe Biden (as of 2025).",
-        "capital of india": "The capital of India is New Delhi.",
-        "hi": "Hello!",
-        "hello": "Hi there!",
-        "what is artificial intelligence": "Artificial intelligence is a field focusing on creating intelligent agents, which perceive their environment and take actions to maximize success at goal achievement.",
-        # Add more simulated results here for different queries
-    }
-    # Return a simulated result text
-    result_text = simulated_results.get(query.lower(), f"Simulated search result for '{query}': Information found suggests...")
-    print(f"--- Simulated Tool Result Text: {result_text} ---")
-    # **FIX:** ALWAYS return the result text wrapped inside a Python dictionary.
-    # The key name ("result" here) matches documentation examples.
-    # This dictionary will be serialized into a Protobuf Struct for the API response's 'response' field.
-    return {"result": result_text} # Use a key like 'result' for the text
+# Fallback replies used when the model returns no text (shared with the asyncio serving path in asgi_app.py)
+NO_TEXT_AFTER_TOOLS_REPLY = "AI processed the tool output but did not provide a text follow-up response."
+NO_TEXT_REPLY = "AI did not provide a text response."
+MODEL_NOT_INITIALIZED_REPLY = "Backend AI model failed to initialize. Check server logs for API key or model errors."
 
+# Repeated standalone questions can be answered from this cache without calling the model (opt-in)
+if os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1":
+    response_cache = ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000")),
+        similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92")),
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+    )
+else:
+    response_cache = None
 
-# --- Dictionary mapping tool names (as strings) to actual Python functions ---
-available_tools = {
-    "search_tool": search_tool,
-}
+# Turns currently running, per session, so POST /chat/cancel (a barge-in from the web UI) can abort them
+active_turns = ActiveTurns()
+
+# Session ids come from the client, so only accept short, URL-safe tokens.
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
 
 # --- Function to handle agent interaction including tool use ---
-def agent_chat_response(user_input):
+def agent_chat_response(user_input, session_id):
     # Check if Google AI model was initialized successfully on startup
-    if not genai_initialized or model is None or chat is None:
-        print("--- Chat Request Failed: Google AI model failed to initialize ---")
-        return "Backend AI model failed to initialize. Check server logs for API key or model errors."
+    if not genai_initialized or model is None or session_manager is None:
+        logger.error("Chat Request Failed: Google AI model failed to initialize")
+        return MODEL_NOT_INITIALIZED_REPLY
+
+    # Look up (or create) this client's chat session and run the whole turn under its lock,
+    # so turns from the same client are serialized while different clients run in parallel.
+    # Raises TurnCancelled if the turn is cancelled through active_turns; its history is rolled back first.
+    session = session_manager.get(session_id)
+    with active_turns.track(session_id) as cancel_scope, session.lock:
+        final_text_to_return = _run_agent_turn(session.chat, user_input, cancel_scope)
+        session_manager.trim_history(session)
+    return final_text_to_return
 
-    # **FIX:** Initialize these variables to empty strings/lists OUTSIDE any conditional blocks
-    final_text_to_return = ""
-    initial_text_from_first_response = ""
-    tool_results_for_api_list = [] # List to store the structure needed for the *second* API call (sending tool results back)
-    final_text_from_second_response = "" # Variable to capture text from the *second* response
+
+# --- Function to execute a single tool call requested by the model ---
+# Returns the structured FunctionResponse part for this call, ready to be sent back to the API.
+def _execute_tool_call(tool_call):
+    function_name = tool_call.name # Get the name of the function to call
+    function_args = tool_call.args # Get the arguments for the function call
+
+    logger.debug("Attempting to execute tool: %s with args: %s", function_name, function_args)
+
+    tool_result_content_dict = None # Initialize variable for tool's returned dictionary (the *content* for 'response' field)
+    execution_error_message = None # Initialize error message string
+
+
+    # Check if the requested tool name exists and is executable in our backend
+    if function_name in available_tools:
+        tool_started = time.perf_counter()
+        try:
+            # Validate the arguments with the tool's precompiled validator and call it - no per-tool branching needed.
+            # The tool function *must* return a Python dictionary for its result.
+            registered_tool = available_tools[function_name]
+            tool_kwargs = registered_tool.validate_args(function_args)
+            cache_ttl = registered_tool.options.get("cache_ttl")
+            if cache_ttl:
+                # Served from the result cache when the same (normalized) call was made recently
+                raw_result = tool_result_cache.call(function_name, tool_kwargs, lambda: registered_tool.function(**tool_kwargs), cache_ttl)
+            else:
+                raw_result = registered_tool.function(**tool_kwargs)
+
+            # **FIX:** Validate that the tool actually returned a dictionary as expected
+            if isinstance(raw_result, dict):
+                 tool_result_content_dict = raw_result # Use the valid dictionary result (e.g., {"result": "..."})
+                 logger.debug("Tool '%s' executed successfully, returned dictionary.", function_name)
+            else:
+                 # Handle case where tool returned something unexpected (not a dict)
+                 execution_error_message = f"Tool '{function_name}' returned unexpected non-dict result type: {type(raw_result).__name__}. Value: {raw_result}"
+                 logger.warning("Tool Execution Warning: %s", execution_error_message)
+
+        except ToolArgumentError as e:
+            # Handle invalid or missing arguments, as checked against the tool's declared signature
+            execution_error_message = f"Invalid arguments for tool '{function_name}': {e}. Received: {function_args}"
+            logger.error("Tool Execution Error: %s", execution_error_message)
+
+        except Exception as e: # Catch *unexpected* exceptions during the Python tool function call itself
+            # This catches errors that shouldn't happen based on validation, but could (e.g., bug in tool fn).
+            execution_error_message = f"Exception during execution of tool '{function_name}': {type(e).__name__} - {e}"
+            logger.exception("Tool Execution Exception: %s", execution_error_message) # Logs the traceback too
+
+        metrics.observe_stage("tool", time.perf_counter() - tool_started, tool=function_name)
+        metrics.counter("tool_calls_total", tool=function_name, outcome="error" if execution_error_message else "ok").inc()
+
+    else: # Handle case where the model requested a tool that is NOT defined in 'available_tools'
+         execution_error_message = f"Error: Model requested unknown tool: {function_name}"
+         logger.error("Tool Request Error: %s", execution_error_message)
+
+
+    # --- Structure the final result dictionary for THIS tool call for the API list ---
+    # This dictionary must represent a FunctionResponse Part
+    # Structure: {"function_response": {"name": "tool_name", "response": dictionary_output}}
+    # The value associated with the 'response' key *must* be a dictionary (or can be empty dict {} on error/no result).
+
+    content_dict_for_api_response_field = {} # Default to empty dictionary
+
+    # Use the determined content dictionary (successful result dict or error dict)
+    if execution_error_message:
+        # If there was an execution error, put the error details into a dictionary for the API 'response' field
+        # The API expects a dictionary here for the Struct conversion.
+        content_dict_for_api_response_field = {"error": execution_error_message} # Report error details as a dictionary
+        logger.debug("Formatting Tool Error Result for API for tool '%s'", function_name)
+    elif tool_result_content_dict is not None and isinstance(tool_result_content_dict, dict):
+        # If execution was successful AND returned a valid dictionary, use it as the content for 'response'
+        # Ensure it's definitely a dictionary before using it.
+        content_dict_for_api_response_field = tool_result_content_dict # Use the tool's dictionary result
+        logger.debug("Formatting Tool Success Result for API for tool '%s', sending result dictionary.", function_name)
+    else:
+         # This block captures cases where tool was requested but we couldn't get a dictionary result or error.
+         # We still need to report *something* back. Report as an error dictionary.
+         problem_details = f"Tool '{function_name}' issue: Couldn't finalize dictionary result or error."
+         content_dict_for_api_response_field = {"error": problem_details} # Report the problem as a dictionary
+         logger.error("Internal Error Structuring Tool Result for API for tool '%s': %s", function_name, problem_details)
+
+
+    # Build the final dictionary structure for this single tool's output part for the API list
+    return {
+        "function_response": {
+            "name": function_name, # Use the function name requested by the model
+            "response": content_dict_for_api_response_field # **FIX:** Ensure this value is always a dictionary.
+        }
+    }
+
+
+# All tool calls from one model turn are dispatched concurrently through this executor
+tool_executor = ToolExecutor(
+    _execute_tool_call,
+    max_workers=int(os.getenv("TOOL_MAX_WORKERS", "8")),
+    default_timeout=float(os.getenv("TOOL_TIMEOUT_SECONDS", "10")),
+    timeouts=available_tools.timeouts(),
+)
+
+
+# --- Optional single-call fast path (TOOL_PREFETCH_ENABLED=1) ---
+# Tools registered with a `prefetch` matcher are run before the first model call when the matcher recognizes
+# the message, and their results are sent along with it, so the model can answer straight away. If it still
+# asks for tools, the turn simply continues on the usual two-call path. tool_prefetch_total{outcome} on
+# /metrics shows how often each path is taken.
+TOOL_PREFETCH_ENABLED = os.getenv("TOOL_PREFETCH_ENABLED", "0") == "1"
+
+
+def _planned_prefetch_calls(user_input):
+    if not TOOL_PREFETCH_ENABLED:
+        return []
+    tool_calls = prefetch_tool_calls(available_tools, user_input)
+    if not tool_calls:
+        metrics.counter("tool_prefetch_total", outcome="no_match").inc()
+    return tool_calls
+
+
+def _first_message(user_input, prefetch_calls, prefetch_outputs):
+    """Content of the first model call: the user's text, preceded by the prefetched results if any succeeded."""
+    if not prefetch_calls:
+        return user_input
+    context = prefetch_context(prefetch_calls, prefetch_outputs)
+    if context is None:
+        metrics.counter("tool_prefetch_total", outcome="no_result").inc()
+        return user_input
+    return [context, user_input]
+
+
+def _drop_prefetch_context(chat, user_turn_index, user_input):
+    # The prefetched results were only for this turn. Keep just the user's own words in the history,
+    # so they aren't resent (and counted against the history budget) on every later turn.
+    history = list(chat.history)
+    history[user_turn_index] = {"role": "user", "parts": [{"text": user_input}]}
+    chat.history = history
+
+
+# --- Helper to pull text and function calls out of one (possibly streamed) response chunk ---
+def _response_parts(response):
+    if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        return response.candidates[0].content.parts
+    return []
+
+
+# --- Bookkeeping of one agent turn, shared by _stream_agent_turn and asgi_app._stream_agent_turn_async ---
+# The two loops differ only in how they wait for the model and the tools. What is done with each streamed
+# chunk, the metrics recorded per model call, the fallback replies and the rollback all live here.
+class _AgentTurn:
+    def __init__(self, chat, user_input):
+        self.chat = chat
+        self.user_input = user_input
+        # Snapshot the history so an abandoned or failed turn can be undone.
+        # A half-consumed streaming response would otherwise leave the chat object unusable for the next turn.
+        self.history_before_turn = list(chat.history)
+        self.first_message = user_input
+        self.tool_calls = [] # Tool calls identified in the first response
+        self.yielded_any_text = False
+        self._stage = None
+        self._call_started = None
+        self._chunks_in_call = 0
+        self._text_in_call = False
+
+    def set_first_message(self, prefetch_calls, prefetch_outputs):
+        self.first_message = _first_message(self.user_input, prefetch_calls, prefetch_outputs)
+        return self.first_message
+
+    def start_call(self, stage):
+        """Call right before sending to the model; `stage` is "model_first_call" or "model_second_call"."""
+        self._stage = stage
+        self._call_started = time.perf_counter()
+        self._chunks_in_call = 0
+        self._text_in_call = False
+
+    def texts(self, chunk):
+        """The text to forward from one streamed chunk; function calls in the first response are collected."""
+        if self._chunks_in_call == 0:
+            metrics.observe_stage(f"{self._stage}_first_chunk", time.perf_counter() - self._call_started)
+        self._chunks_in_call += 1
+        texts = []
+        for part in _response_parts(chunk):
+            if part.function_call and self._stage == "model_first_call":
+                self.tool_calls.append(part.function_call)
+                logger.debug("Model Identified Tool Call: %s", part.function_call.name)
+            if part.text:
+                texts.append(part.text)
+        if texts:
+            self.yielded_any_text = self._text_in_call = True
+        return texts
+
+    def end_call(self):
+        """Call once a model response has been read in full; returns the fallback reply to send, if any."""
+        metrics.observe_stage(self._stage, time.perf_counter() - self._call_started)
+        if self._stage == "model_first_call":
+            logger.debug("Received response from Google Gemini API (First Call)")
+            if self.first_message is not self.user_input:
+                metrics.counter("tool_prefetch_total", outcome="fell_back" if self.tool_calls else "single_call").inc()
+            return []
+        logger.debug("Received Follow-up response from Google Gemini API after tool results")
+        if not self._text_in_call:
+            # Tool calls happened, but the second response didn't have text. Provide a fallback.
+            logger.warning("Model responded after tool use but provided no text in second turn")
+            self.yielded_any_text = True
+            return [NO_TEXT_AFTER_TOOLS_REPLY]
+        return []
+
+    def finish(self):
+        """Call when the turn is complete; returns the fallback reply to send, if any."""
+        if self.first_message is not self.user_input:
+            _drop_prefetch_context(self.chat, len(self.history_before_turn), self.user_input)
+        if not self.yielded_any_text:
+            # No text found in any step (first response, second response after tools)
+            logger.debug("No text response extracted from any part of the interaction flow.")
+            return [NO_TEXT_REPLY]
+        return []
+
+    def roll_back(self):
+        self.chat.history = self.history_before_turn
+
+    def fail(self, error):
+        """Rolls back a turn that raised an unexpected error; returns the reply describing it."""
+        # logger.exception includes the full traceback for detailed debugging
+        logger.exception("AN UNEXPECTED ERROR OCCURRED DURING AI INTERACTION FLOW: %s - %s", type(error).__name__, error)
+        metrics.counter("chat_turn_errors_total", error=type(error).__name__).inc()
+        # Keep the chat usable for the next turn even if the failure left a broken streamed response behind
+        self.roll_back()
+        # In a production application, you would return a generic message like "An internal server error occurred."
+        return f"An internal backend error occurred: {type(error).__name__} - {error}"
 
 
+# --- Generator that runs one agent turn and yields the reply text as it arrives ---
+# Both model calls are made with stream=True, so text deltas reach the caller while the model is
+# still generating, including during the follow-up turn after tool results are sent back.
+# `cancel_scope` is checked before each model call and between streamed chunks, and interrupts the wait
+# for tool results; a cancelled turn is rolled back and raises TurnCancelled.
+def _stream_agent_turn(chat, user_input, cancel_scope=None):
+    cancel_scope = cancel_scope or CancelScope(None)
+    turn = _AgentTurn(chat, user_input)
+
     try:
-        print(f"--- Processing User Message: {user_input} ---")
-        print(f"--- Sending message to Google Gemini API (First Call) ---")
+        cancel_scope.raise_if_cancelled() # Cancelled while queued behind an earlier turn of this session
+        logger.debug("Processing User Message: %s", user_input)
+        prefetch_calls = _planned_prefetch_calls(user_input)
+        prefetch_outputs = []
+        if prefetch_calls:
+            logger.debug("Prefetching %s tool call(s) before the first call", len(prefetch_calls))
+            with metrics.span("tool_prefetch"):
+                prefetch_outputs = tool_executor.run_all(prefetch_calls, cancel_scope=cancel_scope)
+        first_message = turn.set_first_message(prefetch_calls, prefetch_outputs)
+
+        logger.debug("Sending message to Google Gemini API (First Call, streaming)")
         # Send user message to the model. This is the primary AI interaction point.
-        # The response object might contain text, tool calls, or both.
-        response = chat.send_message(user_input)
-        print("--- Received response from Google Gemini API (First Call) ---")
-
-        # --- Process the model's response for tool calls and initial text ---
-        tool_calls_from_response = [] # Capture tool calls identified in the first response
-
-        # Iterate through response parts to find text and function calls.
-        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-             for part in response.candidates[0].content.parts:
-                 if part.function_call:
-                     # If the part is a function call, add it to our list of calls to execute
-                     tool_calls_from_response.append(part.function_call)
-                     print(f"--- Model Identified Tool Call: {part.function_call.name} ---")
-                 if part.text:
-                     # If the part is text, capture it from the first response
-                     initial_text_from_first_response += part.text # Concatenate text parts if there are multiple
-
-
-        # --- If tool calls were requested by the model in the first response, execute them and structure results for sending back ---
-        if tool_calls_from_response:
-            print(f"--- Executing {len(tool_calls_from_response)} Requested Tool Call(s) from first response ---")
-
-            for tool_call in tool_calls_from_response:
-                function_name = tool_call.name # Get the name of the function to call
-                function_args = tool_call.args # Get the arguments for the function call
-
-                print(f"--- Attempting to execute tool: {function_name} with args: {function_args} ---")
-
-                tool_result_content_dict = None # Initialize variable for tool's returned dictionary (the *content* for 'response' field)
-                execution_error_message = None # Initialize error message string
-
-
-                # Check if the requested tool name exists and is executable in our backend
-                if function_name in available_tools:
-                    try:
-                        tool_function = available_tools[function_name]
-
-                        # --- Execute the specific tool function based on name ---
-                        if function_name == "search_tool":
-                            # Validate and pass arguments expected by the search tool
-                             if 'query' in function_args and isinstance(function_args['query'], str):
-                                 # Call the search tool function - it *must* return a Python dictionary for its result
-                                 raw_result = tool_function(function_args['query'])
-
-                                 # **FIX:** Validate that the tool actually returned a dictionary as expected
-                                 if isinstance(raw_result, dict):
-                                      tool_result_content_dict = raw_result # Use the valid dictionary result (e.g., {"result": "..."})
-                                      print(f"--- Tool '{function_name}' executed successfully, returned dictionary. ---")
-                                 else:
-                                      # Handle case where tool returned something unexpected (not a dict)
-                                      execution_error_message = f"Tool '{function_name}' returned unexpected non-dict result type: {type(raw_result).__name__}. Value: {raw_result}"
-                                      print(f"--- Tool Execution Warning: {execution_error_message} ---")
-
-                             else:
-                                 # Handle invalid or missing arguments for the search tool
-                                 execution_error_message = f"Invalid arguments for tool '{function_name}'. Expected {{'query': 'string'}}. Received: {function_args}"
-                                 print(f"--- Tool Execution Error: {execution_error_message} ---")
-
-                        # Add logic here for other tools if you add them (copy the search_tool pattern)
-                        # ... elif function_name == "another_tool": ...
-                        #     ... call another tool function (which must return a dict) ...
-                        #     ... store result in tool_execution_result_dict ...
-
-
-                        # Handle the case where a known tool exists but no specific execution logic was written for it
-                        # If after attempting execution, tool_execution_result_dict is still None AND there was no execution error logged
-                        if tool_result_content_dict is None and execution_error_message is None:
-                             # This could happen if a new tool is added to available_tools but the handling 'if' block is missing.
-                             # **FIXED Syntax Error:** Ensuring this message construction is correct within the block.
-                             execution_error_message = f"Internal error: No specific execution logic defined for known tool '{function_name}' or it failed to set a dictionary result/error message."
-                             print(f"--- Internal Execution Logic Error: {execution_error_message} ---")
-
-
-                    except Exception as e: # Catch *unexpected* exceptions during the Python tool function call itself
-                        # This catches errors that shouldn't happen based on validation, but could (e.g., bug in tool fn).
-                        execution_error_message = f"Exception during execution of tool '{function_name}': {type(e).__name__} - {e}"
-                        tool_execution_result_dict = {"error": execution_error_message} # Report as error dictionary
-                        print(f"--- Tool Execution Exception: {execution_error_message} ---")
-                        traceback.print_exc() # Print exception traceback to server console
-
-                else: # Handle case where the model requested a tool that is NOT defined in 'available_tools'
-                     execution_error_message = f"Error: Model requested unknown tool: {function_name}"
-                     tool_execution_result_dict = {"error": execution_error_message} # Report as error dictionary
-                     print(f"--- Tool Request Error: {execution_error_message} ---")
-
-
-                # --- Structure the final result dictionary for THIS tool call for the API list ---
-                # This dictionary must represent a FunctionResponse Part
-                # Structure: {"function_response": {"name": "tool_name", "response": dictionary_output}}
-                # The value associated with the 'response' key *must* be a dictionary (or can be empty dict {} on error/no result).
-
-                content_dict_for_api_response_field = {} # Default to empty dictionary
-
-                # Use the determined content dictionary (successful result dict or error dict)
-                if execution_error_message:
-                    # If there was an execution error, put the error details into a dictionary for the API 'response' field
-                    # The API expects a dictionary here for the Struct conversion.
-                    content_dict_for_api_response_field = {"error": execution_error_message} # Report error details as a dictionary
-                    print(f"--- Formatting Tool Error Result for API for tool '{function_name}' ---")
-                elif tool_result_content_dict is not None and isinstance(tool_result_content_dict, dict):
-                    # If execution was successful AND returned a valid dictionary, use it as the content for 'response'
-                    # Ensure it's definitely a dictionary before using it.
-                    content_dict_for_api_response_field = tool_result_content_dict # Use the tool's dictionary result
-                    print(f"--- Formatting Tool Success Result for API for tool '{function_name}', sending result dictionary. ---")
-                else:
-                     # This block captures cases where tool was requested but we couldn't get a dictionary result or error.
-                     # We still need to report *something* back. Report as an error dictionary.
-                     problem_details = execution_error_message if execution_error_message else f"Tool '{function_name}' issue: Couldn't finalize dictionary result or error."
-                     content_dict_for_api_response_field = {"error": problem_details} # Report the problem as a dictionary
-                     print(f"--- Internal Error Structuring Tool Result for API for tool '{function_name}': {problem_details} ---")
-
-
-                # Build the final dictionary structure for this single tool's output part for the API list
-                api_formatted_output_part = {
-                    "function_response": {
-                        "name": function_name, # Use the function name requested by the model
-                        "response": content_dict_for_api_response_field # **FIX:** Ensure this value is always a dictionary.
-                    }
-                }
-                # Add this structured dictionary to the list that will be sent to the API
-                tool_outputs_for_api_list.append(api_formatted_output_part)
-                print(f"--- Added structured API output part for tool '{function_name}' to list ({'success' if 'result' in content_dict_for_api_response_field else 'error'}). ---")
-
-
-            # --- After executing all tool calls and structuring outputs, send the list back to the model ---
-            final_text_from_second_response = "" # Initialize before potential assignment
-
-            # Only send the tool results back if the list of formatted outputs is not empty
-            if tool_outputs_for_api_list:
-                print(f"--- Sending {len(tool_outputs_for_api_list)} structured tool output part(s) list back to Google Gemini API for follow-up ---")
-                # Send the LIST of structured tool output part dictionaries to the model.
-                # The API processes these results and should generate a final text response.
-                # The `send_message` method expecting a list of FunctionResponse-like dicts directly works here.
-                response_after_tools = chat.send_message(tool_outputs_for_api_list) # <-- Send the LIST directly
-
-                print("--- Received Follow-up response from Google Gemini API after tool results ---")
-
-                # Extract the final text from this SECOND response (the turn after tool use)
-                if response_after_tools.candidates and response_after_tools.candidates[0].content and response_after_tools.candidates[0].content.parts:
-                    final_text_parts = [part.text for part in response_after_tools.candidates[0].content.parts if part.text]
-                    final_text_from_second_response = "".join(final_text_parts)
-                    print(f"--- Final text found in second response: {final_text_from_second_response} ---")
-                else:
-                     # Case where model responded after tool use but with no text parts in the second turn
-                     print("--- Warning: Model responded after tool use but provided no text in second turn ---")
-                     # final_text_from_second_response remains empty, which is handled below
-
-
-        # --- Determine the final text to return based on the entire interaction flow ---
-        # Prioritize text found in the second response (after tool use) if tools were called AND text was found there
-        if final_text_from_second_response:
-             final_text_to_return = final_text_from_second_response
-             print("--- Using text from second response (after tool use) as final text ---")
-        # If no text from the second response, but tools were called, check for specific fallback text (e.g. no follow-up response)
-        elif tool_calls_from_response and not final_text_from_second_response:
-                 # This means tool calls happened, but the second response didn't have text.
-                 # This happens if the response_after_tools has no text parts. We should provide a fallback.
-                 final_text_to_return = "AI processed the tool output but did not provide a text follow-up response."
-                 print(f"--- No text in second response after tool use, providing fallback: {final_text_to_return} ---")
-
-        # If NO tool calls were requested initially (OR if tool handling failed before sending second message list)
-        # fall back to any initial text from the first response
-        elif initial_text_from_first_response:
-             final_text_to_return = initial_text_from_first_response
-             print("--- No tool calls processed or outputs sent, using initial text from first response as final text ---")
-        # If no text found in any step (first response, second response after tools), provide a default fallback
-        else:
-            # If no text extracted from either response part after checking both potential sources.
-             print("--- No text response extracted from any part of the interaction flow. ---")
-             final_text_to_return = "AI did not provide a text response." # Final fallback
-
+        # The streamed chunks might contain text, tool calls, or both.
+        turn.start_call("model_first_call")
+        response = chat.send_message(first_message, stream=True)
+        # Forward text immediately; function calls are collected to execute afterwards
+        for chunk in response:
+            cancel_scope.raise_if_cancelled()
+            yield from turn.texts(chunk)
+        yield from turn.end_call()
+
+        # --- If tool calls were requested by the model in the first response, execute them and send the results back ---
+        if turn.tool_calls:
+            logger.debug("Executing %s Requested Tool Call(s) from first response", len(turn.tool_calls))
+            # The calls run concurrently; results come back in the order the model requested them.
+            with metrics.span("tools_all"):
+                tool_outputs_for_api_list = tool_executor.run_all(turn.tool_calls, cancel_scope=cancel_scope)
+
+            logger.debug("Sending %s structured tool output part(s) list back to Google Gemini API for follow-up", len(tool_outputs_for_api_list))
+            # Send the LIST of structured tool output part dictionaries to the model.
+            # The API processes these results and should generate a final text response.
+            cancel_scope.raise_if_cancelled()
+            turn.start_call("model_second_call")
+            response_after_tools = chat.send_message(tool_outputs_for_api_list, stream=True) # <-- Send the LIST directly
+            for chunk in response_after_tools:
+                cancel_scope.raise_if_cancelled()
+                yield from turn.texts(chunk)
+            yield from turn.end_call()
+
+        yield from turn.finish()
+
+    except GeneratorExit:
+        # The consumer stopped reading (client disconnected). Undo the partial turn and stop.
+        logger.debug("Stream abandoned by client, rolling back this turn's chat history")
+        metrics.counter("chat_turns_cancelled_total", reason="abandoned").inc()
+        turn.roll_back()
+        raise
+
+    except TurnCancelled:
+        # Cancelled on request (barge-in). Leaving the streamed response unread abandons the model call.
+        logger.debug("Turn cancelled, rolling back this turn's chat history")
+        turn.roll_back()
+        raise
 
     except Exception as e:
-        # *** GENERIC UNEXPECTED ERROR HANDLING during the *overall* interaction flow ***
-        # This catches errors that happen outside of specific API calls or tool execution blocks
-        print(f"\n--- AN UNEXPECTED ERROR OCCURRED DURING AI INTERACTION FLOW ---")
-        print(f"Error Type: {type(e).__name__}")
-        print(f"Error Details: {e}")
-        # Print the full traceback for detailed debugging in the server console
-        traceback.print_exc()
-        print("--------------------------------------------------------\n")
-        # Return a more detailed error message to the frontend for debugging purposes
-        # In a production application, you would return a generic message like "An internal server error occurred."
-        final_text_to_return = f"An internal backend error occurred: {type(e).__name__} - {e}" # Provide specific error to frontend
+        # Errors outside of the specific API calls or tool execution blocks; the details go back to the frontend
+        yield turn.fail(e)
+
+
+# --- Optional response cache for standalone questions (RESPONSE_CACHE_ENABLED=1) ---
+# Only a session's first turn is looked up or stored: later turns depend on the conversation so far.
+def _cached_first_turn_reply(chat, user_input):
+    if response_cache is None or chat.history:
+        return None
+    cached_reply = response_cache.lookup(user_input)
+    if cached_reply is None:
+        return None
+    logger.debug("Response Cache Hit: answering without calling the model")
+    # Record the turn in the session's history so follow-up questions still have their context
+    chat.history = [
+        {"role": "user", "parts": [{"text": user_input}]},
+        {"role": "model", "parts": [{"text": cached_reply}]},
+    ]
+    return cached_reply
+
+
+def _remember_first_turn_reply(chat, user_input, reply, was_first_turn):
+    # A failed turn rolls the history back to empty, so only completed turns with a real answer are stored
+    if response_cache is None or not was_first_turn or not chat.history:
+        return
+    if reply in (NO_TEXT_REPLY, NO_TEXT_AFTER_TOOLS_REPLY):
+        return
+    response_cache.store(user_input, reply)
+
+
+# --- _stream_agent_turn with the response cache in front of it ---
+def _stream_turn_with_cache(chat, user_input, cancel_scope=None):
+    was_first_turn = not chat.history
+    cached_reply = _cached_first_turn_reply(chat, user_input)
+    if cached_reply is not None:
+        yield cached_reply
+        return
+
+    reply_parts = []
+    for text_delta in _stream_agent_turn(chat, user_input, cancel_scope):
+        reply_parts.append(text_delta)
+        yield text_delta
+    _remember_first_turn_reply(chat, user_input, "".join(reply_parts), was_first_turn)
+
+
+def _run_agent_turn(chat, user_input, cancel_scope=None):
+    # Non-streaming callers get the same turn, with the streamed text joined back together
+    final_text_to_return = "".join(_stream_turn_with_cache(chat, user_input, cancel_scope))
+    logger.debug("Returning final response to frontend: %s", final_text_to_return)
+    return final_text_to_return
 
 
-    # --- Return the determined final text response to the frontend ---
-    # This returns the value set by the logic in the try block (success text or error string)
-    print(f"--- Returning final response to frontend: {final_text_to_return} ---")
-    return final_text_to_return
+# --- Streaming variant of agent_chat_response ---
+# Yields text deltas as they arrive. The session lock is held until the generator is exhausted or closed.
+def agent_chat_stream(user_input, session_id):
+    if not genai_initialized or model is None or session_manager is None:
+        logger.error("Chat Request Failed: Google AI model failed to initialize")
+        yield MODEL_NOT_INITIALIZED_REPLY
+        return
+
+    session = session_manager.get(session_id)
+    with active_turns.track(session_id) as cancel_scope, session.lock:
+        yield from _stream_turn_with_cache(session.chat, user_input, cancel_scope)
+        session_manager.trim_history(session)
 
 
 # --- Flask Routes ---
@@ -320,7 +586,7 @@ def index():
         return send_from_directory(app.static_folder, 'index.html')
     else:
         # If index.html is not found, return a 404 error with a helpful message
-        print(f"Error: index.html not found at {index_path}")
+        logger.error("Error: index.html not found at %s", index_path)
         return f"Error: Frontend file (index.html) not found. Please ensure the 'static' directory exists next to app.py and contains index.html, style.css, and script.js.", 404
 
 
@@ -329,29 +595,144 @@ def index():
 # So, a separate route like @app.route('/static/<path:filename>') is usually not needed
 # when using the default static_folder setup.
 
-# Route to handle chat messages from the frontend via POST requests
-@app.route('/chat', methods=['POST'])
-def chat_endpoint():
+# --- Helper to validate a chat request body (shared with the asyncio serving path in asgi_app.py) ---
+# Returns (user_message, session_id, None) on success, or (None, None, (error_text, status_code)).
+def validate_chat_payload(data):
+    # Extract the 'message' field from the JSON data
+    user_message = data.get('message') if isinstance(data, dict) else None
+
+    # Validate that the 'message' field exists and is a non-empty string
+    if not user_message or not isinstance(user_message, str) or not user_message.strip():
+        logger.error("Chat Request Error: Invalid or empty message received")
+        return None, None, ("Invalid or empty message provided.", 400) # 400 Bad Request
+
+    # Each browser tab sends its own session id; hand out a new one if it's missing or malformed
+    session_id = data.get('session_id')
+    if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+        session_id = ChatSessionManager.new_session_id()
+
+    return user_message, session_id, None
+
+
+# --- Helper to validate the current Flask request ---
+# Returns (user_message, session_id, None) on success, or (None, None, error_response) to return as-is.
+def _parse_chat_request():
     # Ensure the incoming request data is in JSON format
     if not request.is_json:
-        print("--- Chat Request Error: Request is not JSON ---")
-        return jsonify({"response": "Request must be JSON"}), 415 # 415 Unsupported Media Type
+        logger.error("Chat Request Error: Request is not JSON")
+        return None, None, (jsonify({"response": "Request must be JSON"}), 415) # 415 Unsupported Media Type
 
     # Get the JSON data from the request body
-    data = request.get_json()
-    # Extract the 'message' field from the JSON data
-    user_message = data.get('message')
+    user_message, session_id, error = validate_chat_payload(request.get_json())
+    if error:
+        error_text, status_code = error
+        return None, None, (jsonify({"response": error_text}), status_code)
+    return user_message, session_id, None
 
-    # Validate that the 'message' field exists and is a non-empty string
-    if not user_message or not isinstance(user_message, str) or not user_message.strip():
-        print("--- Chat Request Error: Invalid or empty message received ---")
-        return jsonify({"response": "Invalid or empty message provided."}), 400 # 400 Bad Request
+
+# Route to handle chat messages from the frontend via POST requests
+@app.route('/chat', methods=['POST'])
+def chat_endpoint():
+    metrics.counter("chat_requests_total", endpoint="/chat").inc()
+    with metrics.span("request_parse"):
+        user_message, session_id, error_response = _parse_chat_request()
+    if error_response:
+        return error_response
 
     # Process the user message using the agentic AI logic
-    ai_response = agent_chat_response(user_message)
+    try:
+        with metrics.span("turn_total"):
+            ai_response = agent_chat_response(user_message, session_id)
+    except TurnCancelled:
+        return jsonify({"response": "", "session_id": session_id, "cancelled": True})
+
+    # Return the AI's response as a JSON object, along with the session id the client should keep using
+    with metrics.span("serialize"):
+        return jsonify({"response": ai_response, "session_id": session_id})
+
+
+# Formats one Server-Sent Event carrying a JSON payload
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+# Route to stream the reply as Server-Sent Events while the model is still generating
+# Each event is a JSON object on a `data:` line:
+#   {"type": "session", "session_id": "..."}  - sent first, so the client can keep the id
+#   {"type": "delta", "text": "..."}          - a piece of reply text, in order
+#   {"type": "done"}                          - the reply is complete
+#   {"type": "cancelled"}                     - the turn was cancelled (POST /chat/cancel) and rolled back; sent instead of "done"
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    metrics.counter("chat_requests_total", endpoint="/chat/stream").inc()
+    with metrics.span("request_parse"):
+        user_message, session_id, error_response = _parse_chat_request()
+    if error_response:
+        return error_response
+
+    def generate():
+        turn_started = time.perf_counter()
+        yield sse_event({"type": "session", "session_id": session_id})
+        try:
+            for text_delta in agent_chat_stream(user_message, session_id):
+                with metrics.span("serialize"):
+                    event = sse_event({"type": "delta", "text": text_delta})
+                yield event
+        except TurnCancelled:
+            yield sse_event({"type": "cancelled"})
+            return
+        yield sse_event({"type": "done"})
+        metrics.observe_stage("turn_total", time.perf_counter() - turn_started)
+
+    # X-Accel-Buffering stops reverse proxies (e.g. nginx) from buffering the stream
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Helper to validate a cancel request body (shared with asgi_app.py) ---
+# Returns (session_id, None) on success, or (None, (error_text, status_code)).
+def validate_cancel_payload(data):
+    session_id = data.get('session_id') if isinstance(data, dict) else None
+    if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+        return None, ("Invalid or missing session_id.", 400)
+    return session_id, None
+
+
+# Route to cancel the session's running turns (barge-in). The turns stop at their next cancellation
+# check, roll back their history and end with {"cancelled": true} / a "cancelled" event.
+@app.route('/chat/cancel', methods=['POST'])
+def chat_cancel_endpoint():
+    session_id, error = validate_cancel_payload(request.get_json(silent=True))
+    if error:
+        error_text, status_code = error
+        return jsonify({"response": error_text}), status_code
+    return jsonify({"cancelled": active_turns.cancel(session_id), "session_id": session_id})
+
+# --- Metrics ---
+
+# Cache and session-pool statistics are read at scrape time rather than counted on the request path
+def _cache_and_session_gauges():
+    gauges = {}
+    for name, value in tool_result_cache.stats().items():
+        gauges[(f"tool_cache_{name}", ())] = value
+    if response_cache is not None:
+        for name, value in response_cache.stats().items():
+            gauges[(f"response_cache_{name}", ())] = value
+    if session_manager is not None:
+        gauges[("chat_sessions_active", ())] = len(session_manager)
+    gauges[("chat_turns_active", ())] = len(active_turns)
+    if model is not None:
+        for name, value in model.stats().items():
+            gauges[(f"upstream_{name}", ())] = value
+    return gauges
+
+metrics.add_gauge_source(_cache_and_session_gauges)
+
+
+# Prometheus-style scrape endpoint: p50/p95/p99 per pipeline stage and per tool, plus counters and cache stats
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
 
-    # Return the AI's response as a JSON object
-    return jsonify({"response": ai_response})
 
 # --- Run the Flask app ---
 # This block only runs when the script is executed directly (not imported)
@@ -360,12 +741,12 @@ if __name__ == '__main__':
     # This check is mainly for providing an early warning if the structure is wrong.
     static_dir_path = os.path.join(os.path.dirname(__file__), 'static')
     if not os.path.exists(static_dir_path):
-       print(f"--- Warning: Static directory not found at {static_dir_path}. Ensure it exists and contains index.html, style.css, script.js. ---")
+       logger.warning("Static directory not found at %s. Ensure it exists and contains index.html, style.css, script.js.", static_dir_path)
     elif not os.path.exists(os.path.join(static_dir_path, 'index.html')):
-        print(f"--- Warning: index.html not found inside the static directory at {static_dir_path}. Ensure it exists. ---")
+        logger.warning("index.html not found inside the static directory at %s. Ensure it exists.", static_dir_path)
 
 
-    print("Starting Flask server...")
+    logger.info("Starting Flask server...")
     # Run the Flask development server.
     # debug=True enables debug mode (auto-reloads on code changes, provides debugger)
     # debug=True should ALWAYS be False in production for security and performance.
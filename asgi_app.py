@@ -0,0 +1,345 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from quart import Quart, Response, request, jsonify, send_from_directory, websocket
+
+import app as core # Model, session pool, tools and request validation are shared with the Flask app
+from cancellation import TurnCancelled
+from concurrency import CapacityExceeded, ConcurrencyLimiter
+from metrics import metrics
+from session_manager import ChatSessionManager
+from speech_pipeline import VoiceConversation, speech_engines_from_config
+
+logger = logging.getLogger(__name__)
+
+
+# --- asyncio serving mode ---
+# Run with an ASGI server, e.g.:  hypercorn asgi_app:asgi_app --bind 127.0.0.1:8000
+# Every chat turn runs as a coroutine on the event loop and awaits the async Gemini client, so a slow
+# model call holds no thread. Sessions are served one turn at a time (queued behind each other), and
+# when the global in-flight cap is reached, new requests get 429 with a Retry-After header.
+
+asgi_app = Quart(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+
+limiter = ConcurrencyLimiter(
+    max_in_flight=int(os.getenv("ASGI_MAX_IN_FLIGHT", "500")),
+    max_queued_per_session=int(os.getenv("ASGI_MAX_QUEUED_PER_SESSION", "4")),
+    retry_after_seconds=int(os.getenv("ASGI_RETRY_AFTER_SECONDS", "1")),
+)
+
+
+# --- Async generator that runs one agent turn and yields the reply text as it arrives ---
+# Same turn as app._stream_agent_turn (both drive an app._AgentTurn), but awaits the async model client
+# instead of blocking a thread.
+async def _stream_agent_turn_async(chat, user_input):
+    turn = core._AgentTurn(chat, user_input)
+
+    try:
+        logger.debug("[async] Processing User Message: %s", user_input)
+        prefetch_calls = core._planned_prefetch_calls(user_input)
+        prefetch_outputs = []
+        if prefetch_calls:
+            with metrics.span("tool_prefetch"):
+                prefetch_outputs = await core.tool_executor.run_all_async(prefetch_calls)
+        first_message = turn.set_first_message(prefetch_calls, prefetch_outputs)
+
+        turn.start_call("model_first_call")
+        response = await chat.send_message_async(first_message, stream=True)
+        async for chunk in response:
+            for text in turn.texts(chunk):
+                yield text
+        for text in turn.end_call():
+            yield text
+
+        if turn.tool_calls:
+            logger.debug("[async] Executing %s Requested Tool Call(s)", len(turn.tool_calls))
+            # Tools are plain blocking functions, so they run concurrently on the executor's thread pool
+            with metrics.span("tools_all"):
+                tool_outputs_for_api_list = await core.tool_executor.run_all_async(turn.tool_calls)
+
+            turn.start_call("model_second_call")
+            response_after_tools = await chat.send_message_async(tool_outputs_for_api_list, stream=True)
+            async for chunk in response_after_tools:
+                for text in turn.texts(chunk):
+                    yield text
+            for text in turn.end_call():
+                yield text
+
+        for text in turn.finish():
+            yield text
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client went away mid-turn. Undo the partial turn and let the cancellation propagate.
+        logger.debug("[async] Turn abandoned, rolling back this turn's chat history")
+        turn.roll_back()
+        raise
+
+    except Exception as e:
+        yield turn.fail(e)
+
+
+# --- _stream_agent_turn_async with the response cache in front of it (see app._stream_turn_with_cache) ---
+async def _stream_turn_with_cache_async(chat, user_input):
+    was_first_turn = not chat.history
+    cached_reply = core._cached_first_turn_reply(chat, user_input)
+    if cached_reply is not None:
+        yield cached_reply
+        return
+
+    reply_parts = []
+    async for text_delta in _stream_agent_turn_async(chat, user_input):
+        reply_parts.append(text_delta)
+        yield text_delta
+    core._remember_first_turn_reply(chat, user_input, "".join(reply_parts), was_first_turn)
+
+
+# --- Async version of app.agent_chat_stream ---
+# Must be called inside `limiter.acquire(session_id)`, which serializes turns of the same session.
+async def agent_chat_stream(user_input, session_id):
+    if not core.genai_initialized or core.model is None or core.session_manager is None:
+        yield core.MODEL_NOT_INITIALIZED_REPLY
+        return
+
+    session = core.session_manager.get(session_id)
+    async for text_delta in _stream_turn_with_cache_async(session.chat, user_input):
+        yield text_delta
+    core.session_manager.trim_history(session)
+
+
+# --- agent_chat_stream inside the session's turn slot; raises CapacityExceeded when the turn can't be admitted ---
+async def agent_chat_stream_in_turn_slot(user_input, session_id):
+    async with limiter.acquire(session_id):
+        async for text_delta in agent_chat_stream(user_input, session_id):
+            yield text_delta
+
+
+# --- Runs a turn's reply stream in its own task, so POST /chat/cancel can abort it ---
+# Cancelling the task aborts the pending model request and tool waits at once, and _stream_agent_turn_async
+# rolls the history back. The cancelled stream ends with TurnCancelled instead of taking the response down with it.
+async def cancellable_turn(text_deltas, session_id):
+    loop = asyncio.get_running_loop()
+    deltas = asyncio.Queue()
+    finished = object()
+
+    async def produce():
+        try:
+            async for text_delta in text_deltas:
+                deltas.put_nowait(text_delta)
+        finally:
+            deltas.put_nowait(finished)
+
+    with core.active_turns.track(session_id) as cancel_scope:
+        producer = asyncio.create_task(produce())
+        # cancel() may be called from any thread (e.g. the Flask app sharing the registry), so hop onto this loop
+        cancel_scope.add_callback(lambda: loop.call_soon_threadsafe(producer.cancel))
+        try:
+            while True:
+                text_delta = await deltas.get()
+                if text_delta is finished:
+                    break
+                yield text_delta
+            if producer.cancelled() and cancel_scope.cancelled:
+                raise TurnCancelled()
+            await producer # Re-raises what ended the turn early, e.g. CapacityExceeded
+        finally:
+            if not producer.done():
+                # The consumer went away (client disconnect, voice barge-in): abandon the turn
+                producer.cancel()
+                metrics.counter("chat_turns_cancelled_total", reason="abandoned").inc()
+
+
+# --- Speculative variant for the voice pipeline ---
+# Runs the turn on a throwaway copy of the session's chat, so a guess made on a partial transcript never touches
+# the real history. Only when `adopted` resolves (to the final transcript) is the copy's new turn committed to the
+# session, with the final transcript as the user's message. The session's turn slot is held only while the draft
+# streams and while committing, so a guess that is never confirmed (recognition ended without a final) can't
+# keep typed turns waiting.
+async def agent_chat_stream_speculative(user_input, session_id, adopted):
+    if not core.genai_initialized or core.model is None or core.session_manager is None:
+        yield core.MODEL_NOT_INITIALIZED_REPLY
+        return
+
+    async with limiter.acquire(session_id):
+        session = core.session_manager.get(session_id)
+        base_length = len(session.chat.history)
+        draft_chat = core.model.start_chat(history=list(session.chat.history))
+        async for text_delta in _stream_turn_with_cache_async(draft_chat, user_input):
+            yield text_delta
+        new_entries = list(draft_chat.history[base_length:])
+
+    final_text = await adopted
+    if not new_entries:
+        return
+    new_entries[0] = {"role": "user", "parts": [{"text": final_text}]}
+    try:
+        async with limiter.acquire(session_id):
+            session = core.session_manager.get(session_id)
+            if len(session.chat.history) != base_length:
+                # Another turn finished while waiting for the final transcript; this one goes after it
+                logger.debug("[async] Speculative turn for session %s committed after %s newer history entries",
+                             session_id, len(session.chat.history) - base_length)
+            session.chat.history = list(session.chat.history) + new_entries
+            core.session_manager.trim_history(session)
+    except CapacityExceeded as e:
+        # The reply has already been spoken; only its place in the history is lost
+        logger.warning("[async] Speculative turn for session %s not committed: %s", session_id, e.reason)
+
+
+# --- Helpers for the routes ---
+
+async def _parse_chat_request():
+    if not request.is_json:
+        return None, None, (jsonify({"response": "Request must be JSON"}), 415)
+    user_message, session_id, error = core.validate_chat_payload(await request.get_json())
+    if error:
+        error_text, status_code = error
+        return None, None, (jsonify({"response": error_text}), status_code)
+    return user_message, session_id, None
+
+
+def _too_many_requests(error):
+    logger.warning("[async] Rejecting request with 429: %s", error.reason)
+    metrics.counter("chat_requests_rejected_total", reason=error.reason).inc()
+    return jsonify({"response": f"{error.reason}. Please retry shortly."}), 429, {"Retry-After": str(error.retry_after)}
+
+
+# --- Routes (same API as the Flask app) ---
+
+@asgi_app.route('/')
+async def index():
+    if os.path.exists(os.path.join(asgi_app.static_folder, 'index.html')):
+        return await send_from_directory(asgi_app.static_folder, 'index.html')
+    return "Error: Frontend file (index.html) not found.", 404
+
+
+@asgi_app.route('/chat', methods=['POST'])
+async def chat_endpoint():
+    metrics.counter("chat_requests_total", endpoint="/chat").inc()
+    with metrics.span("request_parse"):
+        user_message, session_id, error_response = await _parse_chat_request()
+    if error_response:
+        return error_response
+
+    try:
+        with metrics.span("turn_total"):
+            turn = cancellable_turn(agent_chat_stream_in_turn_slot(user_message, session_id), session_id)
+            ai_response = "".join([text_delta async for text_delta in turn])
+    except CapacityExceeded as e:
+        return _too_many_requests(e)
+    except TurnCancelled:
+        return jsonify({"response": "", "session_id": session_id, "cancelled": True})
+
+    with metrics.span("serialize"):
+        return jsonify({"response": ai_response, "session_id": session_id})
+
+
+@asgi_app.route('/chat/stream', methods=['POST'])
+async def chat_stream_endpoint():
+    metrics.counter("chat_requests_total", endpoint="/chat/stream").inc()
+    with metrics.span("request_parse"):
+        user_message, session_id, error_response = await _parse_chat_request()
+    if error_response:
+        return error_response
+
+    # Decide on admission before the 200 status line goes out, so a saturated server can still answer 429
+    try:
+        limiter.check(session_id)
+    except CapacityExceeded as e:
+        return _too_many_requests(e)
+
+    async def generate():
+        turn_started = time.perf_counter()
+        yield core.sse_event({"type": "session", "session_id": session_id})
+        try:
+            async for text_delta in cancellable_turn(agent_chat_stream_in_turn_slot(user_message, session_id), session_id):
+                with metrics.span("serialize"):
+                    event = core.sse_event({"type": "delta", "text": text_delta})
+                yield event
+        except CapacityExceeded as e:
+            # Capacity ran out between the check above and the first chunk being sent
+            yield core.sse_event({"type": "delta", "text": f"{e.reason}. Please retry shortly."})
+        except TurnCancelled:
+            yield core.sse_event({"type": "cancelled"})
+            return
+        yield core.sse_event({"type": "done"})
+        metrics.observe_stage("turn_total", time.perf_counter() - turn_started)
+
+    return generate(), 200, {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+# --- Voice WebSocket ---
+# Speech engines are chosen once at startup; see speech_pipeline.py
+speech_recognizer, speech_synthesizer = speech_engines_from_config(
+    stt_engine=os.getenv("SPEECH_STT_ENGINE", "transcript"),
+    vosk_model_path=os.getenv("VOSK_MODEL_PATH") or None,
+    sample_rate=int(os.getenv("SPEECH_AUDIO_SAMPLE_RATE", "16000")),
+    tts_engine=os.getenv("SPEECH_TTS_ENGINE", "browser"),
+    tts_command=os.getenv("SPEECH_TTS_COMMAND", "espeak-ng"),
+    tts_voice=os.getenv("SPEECH_TTS_VOICE") or None,
+)
+SPEECH_SPECULATION_STABLE_SECONDS = float(os.getenv("SPEECH_SPECULATION_STABLE_MS", "300")) / 1000
+
+
+# Client -> server: JSON text messages, or binary audio frames (16-bit mono PCM) when server-side STT is enabled
+#   {"type": "partial", "text": "..."}   - interim transcript while the user is still speaking
+#   {"type": "final", "text": "..."}     - the finished utterance; starts (or confirms) the turn
+#   {"type": "cancel"}                   - barge-in, or recognition ended without a final: drop the pending guess
+#                                          and stop (and roll back) the reply in progress
+# Server -> client: JSON text messages, each `sentence` with audio followed by one binary message holding it
+#   {"type": "session", "session_id": "..."}
+#   {"type": "transcript", "text": "...", "final": bool}                    - only when recognizing audio here
+#   {"type": "delta", "text": "..."}                                        - reply text, as for /chat/stream
+#   {"type": "sentence", "index": n, "text": "...", "audio": mime or null}  - null: speak `text` client-side
+#   {"type": "done"} / {"type": "cancelled"} / {"type": "error", "message": "..."}
+@asgi_app.websocket('/ws/voice')
+async def voice_socket():
+    session_id = websocket.args.get("session_id")
+    if not isinstance(session_id, str) or not core.SESSION_ID_PATTERN.match(session_id):
+        session_id = ChatSessionManager.new_session_id()
+    metrics.counter("chat_requests_total", endpoint="/ws/voice").inc()
+
+    async def send_event(payload):
+        await websocket.send(json.dumps(payload))
+
+    conversation = VoiceConversation(
+        send_event=send_event,
+        send_audio=websocket.send,
+        stream_turn=lambda text: cancellable_turn(agent_chat_stream_in_turn_slot(text, session_id), session_id),
+        stream_speculative_turn=lambda text, adopted: agent_chat_stream_speculative(text, session_id, adopted),
+        recognizer=speech_recognizer,
+        synthesizer=speech_synthesizer,
+        stable_seconds=SPEECH_SPECULATION_STABLE_SECONDS,
+    )
+    await send_event({"type": "session", "session_id": session_id})
+    try:
+        while True:
+            await conversation.handle_message(await websocket.receive())
+    finally:
+        # Runs when the client disconnects (the handler is cancelled): abandon the turn in progress
+        conversation.close()
+
+
+@asgi_app.route('/chat/cancel', methods=['POST'])
+async def chat_cancel_endpoint():
+    session_id, error = core.validate_cancel_payload(await request.get_json(silent=True))
+    if error:
+        error_text, status_code = error
+        return jsonify({"response": error_text}), status_code
+    return jsonify({"cancelled": core.active_turns.cancel(session_id), "session_id": session_id})
+
+
+# The admission limiter's state is reported alongside the shared metrics
+metrics.add_gauge_source(lambda: {("asgi_turns_in_flight", ()): limiter.in_flight})
+
+
+@asgi_app.route('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    # Quart's built-in runner is fine for local testing; use hypercorn/uvicorn for real deployments
+    asgi_app.run(port=8000, host='127.0.0.1')
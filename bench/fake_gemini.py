@@ -0,0 +1,242 @@
+import asyncio
+import math
+import random
+import threading
+import time
+
+from upstream import TokenBucket
+
+
+# --- Latency distributions ---
+def parse_latency(spec):
+    """
+    Parses a latency spec into a callable `sample(rng) -> seconds`:
+      "fixed:0.2"           always 200 ms
+      "uniform:0.1,0.5"     uniformly between 100 and 500 ms
+      "lognormal:0.3,0.5"   median 300 ms, sigma 0.5 (long right tail, like real model latency)
+    A bare number is treated as "fixed:<number>".
+    """
+    kind, _, params = str(spec).partition(":")
+    if not params:
+        kind, params = "fixed", kind
+    values = [float(value) for value in params.split(",")]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda rng: rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    raise ValueError(f"Invalid latency spec {spec!r}; expected fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+
+
+# --- Quota error, shaped like google.api_core.exceptions.ResourceExhausted ---
+class FakeRateLimitError(Exception):
+    code = 429
+
+
+# --- Minimal stand-ins for the response/content types the app reads ---
+class FakeFunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __bool__(self):
+        return bool(self.name)
+
+
+class FakeFunctionResponse:
+    def __init__(self, name, response):
+        self.name = name
+        self.response = response
+
+    def __bool__(self):
+        return bool(self.name)
+
+
+class FakePart:
+    def __init__(self, text="", function_call=None, function_response=None):
+        self.text = text
+        self.function_call = function_call
+        self.function_response = function_response
+
+
+class FakeContent:
+    def __init__(self, role, parts):
+        self.role = role
+        self.parts = parts
+
+
+class FakeCandidate:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChunk:
+    def __init__(self, parts):
+        self.candidates = [FakeCandidate(FakeContent("model", parts))]
+
+    @property
+    def text(self):
+        return "".join(part.text for part in self.candidates[0].content.parts if part.text)
+
+
+def _to_content(content):
+    """Converts the dict form accepted by the real `chat.history` setter ({"role", "parts": [...]})."""
+    if isinstance(content, FakeContent):
+        return content
+    if not isinstance(content, dict):
+        # An object with the same shape (e.g. a real genai Content proto)
+        return FakeContent(content.role, [_to_part(part) for part in content.parts])
+    return FakeContent(content.get("role", "user"), [_to_part(part) for part in content.get("parts", [])])
+
+
+def _to_part(part):
+    if isinstance(part, FakePart):
+        return part
+    if isinstance(part, str):
+        return FakePart(text=part)
+    if not isinstance(part, dict):
+        return FakePart(
+            text=part.text or "",
+            function_call=FakeFunctionCall(part.function_call.name, dict(part.function_call.args)) if part.function_call else None,
+            function_response=FakeFunctionResponse(part.function_response.name, part.function_response.response) if part.function_response else None,
+        )
+    function_call = part.get("function_call")
+    function_response = part.get("function_response")
+    return FakePart(
+        text=part.get("text", ""),
+        function_call=FakeFunctionCall(function_call["name"], function_call.get("args", {})) if function_call else None,
+        function_response=FakeFunctionResponse(function_response["name"], function_response.get("response", {})) if function_response else None,
+    )
+
+
+# --- Stand-in for genai.GenerativeModel ---
+class FakeGenerativeModel:
+    """
+    Local, deterministic replacement for genai.GenerativeModel with the same start_chat() interface,
+    used by the benchmarks (and usable in tests) via app.install_model(FakeGenerativeModel(...)).
+
+    Every model call waits `first_chunk_latency` before the first streamed chunk and `chunk_interval`
+    between the following `chunks_per_reply` chunks. With probability `tool_call_probability` the reply to a
+    user message is `tool_calls_per_turn` calls to `tool_name` (with `{tool_arg: <user message>}`) instead of
+    text; the model then answers the tool results with text. A user message sent together with prefetched tool
+    results (extra text parts in front of it) is answered directly, except with probability
+    `prefetch_fallback_probability` of the tool-using turns. Latencies are specs for parse_latency().
+    With `quota_rps` set, calls beyond that many per second (bursts of up to `quota_burst`) fail at once with
+    a 429 FakeRateLimitError, like the real API's per-minute quota.
+    All randomness comes from a `seed`ed generator, so runs are repeatable.
+    """
+
+    def __init__(self, model_name="fake-gemini", tools=None, first_chunk_latency="fixed:0.2", chunk_interval="fixed:0.02",
+                 chunks_per_reply=5, tool_call_probability=0.0, tool_calls_per_turn=1, tool_name="search_tool",
+                 tool_arg="query", prefetch_fallback_probability=0.0, quota_rps=0.0, quota_burst=None, seed=0):
+        self.model_name = model_name
+        self.tools = tools
+        self.first_chunk_latency = parse_latency(first_chunk_latency)
+        self.chunk_interval = parse_latency(chunk_interval)
+        self.chunks_per_reply = max(1, chunks_per_reply)
+        self.tool_call_probability = tool_call_probability
+        self.tool_calls_per_turn = max(1, tool_calls_per_turn)
+        self.tool_name = tool_name
+        self.tool_arg = tool_arg
+        self.prefetch_fallback_probability = prefetch_fallback_probability
+        self._quota = TokenBucket(quota_rps, quota_burst) if quota_rps > 0 else None
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.calls = 0 # Model calls answered, across all chats
+        self.rate_limited_calls = 0 # Calls rejected with a 429
+
+    def start_chat(self, history=None):
+        with self._rng_lock:
+            chat_seed = self._rng.getrandbits(64)
+        return FakeChatSession(self, history, random.Random(chat_seed))
+
+    def _count_call(self):
+        if self._quota is not None and not self._quota.try_acquire():
+            with self._rng_lock:
+                self.rate_limited_calls += 1
+            raise FakeRateLimitError("429 Resource has been exhausted (e.g. check quota).")
+        with self._rng_lock:
+            self.calls += 1
+
+
+class FakeChatSession:
+    """Stand-in for genai.ChatSession: send_message() / send_message_async(), optionally streamed."""
+
+    def __init__(self, model, history, rng):
+        self.model = model
+        self._rng = rng
+        self._history = [_to_content(content) for content in history or []]
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = [_to_content(content) for content in history]
+
+    def _plan_reply(self, content):
+        """Records the request in the history and returns (reply parts split into chunks, delays before each chunk)."""
+        self.model._count_call()
+        texts = [content] if isinstance(content, str) else [part for part in content if isinstance(part, str)]
+        if texts:
+            # A user message, possibly preceded by prefetched tool results
+            request = FakeContent("user", [FakePart(text=text) for text in texts])
+            message = texts[-1]
+            tool_call_probability = self.model.tool_call_probability
+            if len(texts) > 1:
+                tool_call_probability *= self.model.prefetch_fallback_probability
+            if self._rng.random() < tool_call_probability:
+                calls = [FakePart(function_call=FakeFunctionCall(self.model.tool_name, {self.model.tool_arg: message}))
+                         for _ in range(self.model.tool_calls_per_turn)]
+                chunks = [calls]
+            else:
+                chunks = self._text_chunks(f"Simulated answer to '{message}'.")
+        else:
+            request = _to_content({"role": "user", "parts": list(content)})
+            names = ", ".join(part.function_response.name for part in request.parts if part.function_response)
+            chunks = self._text_chunks(f"Simulated answer using the results of {names or 'the tools'}.")
+
+        delays = [self.model.first_chunk_latency(self._rng)]
+        delays += [self.model.chunk_interval(self._rng) for _ in chunks[1:]]
+        self._history.append(request)
+        return chunks, delays
+
+    def _text_chunks(self, text):
+        words = text.split(" ")
+        per_chunk = math.ceil(len(words) / self.model.chunks_per_reply)
+        pieces = [" ".join(words[start:start + per_chunk]) for start in range(0, len(words), per_chunk)]
+        return [[FakePart(text=piece if index == 0 else " " + piece)] for index, piece in enumerate(pieces)]
+
+    def _finish(self, chunks):
+        self._history.append(FakeContent("model", [part for chunk in chunks for part in chunk]))
+
+    def send_message(self, content, stream=False, **kwargs):
+        chunks, delays = self._plan_reply(content)
+        if not stream:
+            time.sleep(sum(delays))
+            self._finish(chunks)
+            return FakeChunk([part for chunk in chunks for part in chunk])
+
+        def stream_chunks():
+            for parts, delay in zip(chunks, delays):
+                time.sleep(delay)
+                yield FakeChunk(parts)
+            self._finish(chunks)
+        return stream_chunks()
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        chunks, delays = self._plan_reply(content)
+        if not stream:
+            await asyncio.sleep(sum(delays))
+            self._finish(chunks)
+            return FakeChunk([part for chunk in chunks for part in chunk])
+
+        async def stream_chunks():
+            for parts, delay in zip(chunks, delays):
+                await asyncio.sleep(delay)
+                yield FakeChunk(parts)
+            self._finish(chunks)
+        return stream_chunks()
@@ -0,0 +1,369 @@
+"""
+Offline load test for the chat endpoints.
+
+Starts the app in-process with the fake Gemini backend from bench/fake_gemini.py (or targets a running
+server with --url), drives /chat or /chat/stream at a fixed concurrency (closed loop) or at a Poisson
+arrival rate (open loop), and reports throughput, latency percentiles and memory per session.
+
+    python -m bench.load_test --concurrency 32 --requests 2000
+    python -m bench.load_test --rate 200 --duration 30 --stream --server asgi
+    python -m bench.load_test --concurrency 16 --requests 500 --tool-probability 0.5 --trace-memory --json
+    python -m bench.load_test --rate 150 --duration 20 --quota-rps 100 --upstream-rps 90 --sessions 0 --coalesce
+
+In open-loop mode latency is measured from the time a request was *scheduled* to be sent, so time spent
+waiting behind a saturated server is counted instead of hidden.
+"""
+import argparse
+import asyncio
+import gc
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from bench.fake_gemini import FakeGenerativeModel
+
+PROMPTS = [
+    "What's the weather in London?",
+    "What is the capital of France?",
+    "Tell me about artificial intelligence.",
+    "Who is the president of the United States?",
+    "What is the capital of India?",
+    "What's the current date?",
+]
+
+
+# --- Server under test ---
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class InProcessServer:
+    """Runs the Flask app (threaded werkzeug server) or the ASGI app (hypercorn) on a background thread."""
+
+    def __init__(self, kind, model):
+        import app as core
+        core.install_model(model)
+        self.core = core
+        self.kind = kind
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._thread = None
+        self._stop = None
+
+    def start(self):
+        if self.kind == "flask":
+            from werkzeug.serving import make_server
+            self._server = make_server("127.0.0.1", self.port, self.core.app, threaded=True)
+            logging.getLogger("werkzeug").setLevel(logging.WARNING) # No access log line per request
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        else:
+            self._thread = threading.Thread(target=self._serve_asgi, daemon=True)
+            self._ready = threading.Event()
+        self._thread.start()
+        if self.kind == "asgi":
+            self._ready.wait()
+        _wait_for_port(self.port)
+
+    def _serve_asgi(self):
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        from asgi_app import asgi_app
+        config = Config()
+        config.bind = [f"127.0.0.1:{self.port}"]
+        config.loglevel = "WARNING"
+        self._loop = asyncio.new_event_loop()
+        self._stop = asyncio.Event()
+        self._ready.set()
+        self._loop.run_until_complete(serve(asgi_app, config, shutdown_trigger=self._stop.wait))
+
+    def stop(self):
+        if self.kind == "flask":
+            self._server.shutdown()
+        else:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(timeout=5)
+
+    def session_count(self):
+        return len(self.core.session_manager)
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+# --- One request ---
+class RequestResult:
+    __slots__ = ("status", "latency", "first_delta", "error")
+
+    def __init__(self, status, latency, first_delta=None, error=None):
+        self.status = status
+        self.latency = latency # Seconds from (scheduled) send to the complete reply
+        self.first_delta = first_delta # Seconds to the first text delta (streaming only)
+        self.error = error
+
+
+def send_chat(base_url, message, session_id, stream, started=None):
+    """POSTs one chat message; `started` (perf_counter) lets open-loop callers count scheduling delay."""
+    started = time.perf_counter() if started is None else started
+    target = urlsplit(base_url)
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=120)
+    path = "/chat/stream" if stream else "/chat"
+    body = json.dumps({"message": message, "session_id": session_id})
+    try:
+        connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        first_delta = None
+        if stream and response.status == 200:
+            # Read Server-Sent Events line by line so the first delta is timed when it arrives
+            for line in response:
+                if line.startswith(b"data:"):
+                    event = json.loads(line[5:])
+                    if event.get("type") == "delta" and first_delta is None:
+                        first_delta = time.perf_counter() - started
+                    elif event.get("type") == "done":
+                        break
+        else:
+            response.read()
+        return RequestResult(response.status, time.perf_counter() - started, first_delta)
+    except Exception as e:
+        return RequestResult(None, time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+    finally:
+        connection.close()
+
+
+def _request_args(index, sessions):
+    return PROMPTS[index % len(PROMPTS)], f"bench-{index % sessions if sessions else index}"
+
+
+# --- Load generators ---
+def run_closed_loop(base_url, concurrency, total_requests, sessions, stream):
+    """`concurrency` clients each send their next request as soon as the previous reply is complete."""
+    results = []
+    next_index = iter(range(total_requests))
+    index_lock = threading.Lock()
+
+    def client():
+        while True:
+            with index_lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            results.append(send_chat(base_url, *_request_args(index, sessions), stream))
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_open_loop(base_url, rate, duration, sessions, stream, max_clients, seed):
+    """Requests arrive as a Poisson process at `rate` per second for `duration` seconds, whatever the server does."""
+    rng = random.Random(seed)
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_clients) as pool:
+        start = time.perf_counter()
+        scheduled = start
+        index = 0
+        while True:
+            scheduled += rng.expovariate(rate)
+            if scheduled - start >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send_chat, base_url, *_request_args(index, sessions), stream, scheduled))
+            index += 1
+    return [future.result() for future in futures]
+
+
+# --- Report ---
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    rank = q * (len(sorted_values) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(results, elapsed):
+    latencies = sorted(result.latency for result in results if result.status == 200)
+    first_deltas = sorted(result.first_delta for result in results if result.first_delta is not None)
+    statuses = {}
+    for result in results:
+        key = str(result.status) if result.status is not None else "error"
+        statuses[key] = statuses.get(key, 0) + 1
+
+    report = {
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "statuses": statuses,
+        "latency_ms": {name: round(percentile(latencies, q) * 1000, 2)
+                       for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+    }
+    if first_deltas:
+        report["first_delta_ms"] = {name: round(percentile(first_deltas, q) * 1000, 2)
+                                    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+    errors = [result.error for result in results if result.error]
+    if errors:
+        report["first_error"] = errors[0]
+    return report
+
+
+def _print_report(report):
+    print(f"requests:     {report['requests']} in {report['elapsed_seconds']}s  ({report['throughput_rps']} ok/s)")
+    print(f"statuses:     {report['statuses']}")
+    print("latency ms:   " + "  ".join(f"{name}={value}" for name, value in report["latency_ms"].items()))
+    if "first_delta_ms" in report:
+        print("1st delta ms: " + "  ".join(f"{name}={value}" for name, value in report["first_delta_ms"].items()))
+    if "sessions" in report:
+        print(f"sessions:     {report['sessions']}")
+    if "memory_per_session_kib" in report:
+        print(f"memory:       {report['memory_per_session_kib']} KiB/session (traced)")
+    if "model_calls" in report:
+        print(f"model calls:  {report['model_calls']} (+{report['coalesced_calls']} coalesced)")
+    if "rate_limited_calls" in report:
+        print(f"429s:         {report['rate_limited_calls']} calls, {report['rate_limited_turns']} failed turns")
+    if "first_error" in report:
+        print(f"first error:  {report['first_error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_argument_group("target")
+    target.add_argument("--url", help="Benchmark an already running server instead of starting one in-process")
+    target.add_argument("--server", choices=("flask", "asgi"), default="flask", help="In-process server to start")
+    target.add_argument("--stream", action="store_true", help="Use /chat/stream and also report time to first delta")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--concurrency", type=int, default=16, help="Closed loop: number of concurrent clients")
+    load.add_argument("--requests", type=int, default=500, help="Closed loop: total requests")
+    load.add_argument("--rate", type=float, help="Open loop: mean arrivals per second (Poisson); overrides --concurrency")
+    load.add_argument("--duration", type=float, default=10.0, help="Open loop: seconds to keep sending")
+    load.add_argument("--max-clients", type=int, default=1000, help="Open loop: maximum requests in flight on the client side")
+    load.add_argument("--sessions", type=int, default=100,
+                      help="Distinct session ids to spread requests over; 0 starts a new session for every request")
+
+    fake = parser.add_argument_group("fake model (in-process only)")
+    fake.add_argument("--first-chunk-latency", default="lognormal:0.3,0.4", help="fixed:S | uniform:LOW,HIGH | lognormal:MEDIAN,SIGMA")
+    fake.add_argument("--chunk-interval", default="fixed:0.02")
+    fake.add_argument("--chunks", type=int, default=5, help="Streamed chunks per text reply")
+    fake.add_argument("--tool-probability", type=float, default=0.3, help="Chance a user message is answered with tool calls")
+    fake.add_argument("--tool-calls", type=int, default=1, help="Tool calls per tool-using turn")
+    fake.add_argument("--prefetch-fallback", type=float, default=0.0,
+                      help="Chance the model still calls the tool when prefetched results were sent along")
+    fake.add_argument("--quota-rps", type=float, default=0.0, help="Model calls per second before the fake answers 429 (0: no quota)")
+    fake.add_argument("--quota-burst", type=float, help="Burst allowed by the quota (default: --quota-rps)")
+    fake.add_argument("--seed", type=int, default=0)
+    fake.add_argument("--tool-prefetch", action="store_true",
+                      help="Enable the single-call fast path (TOOL_PREFETCH_ENABLED) to compare it with the two-call path")
+
+    upstream = parser.add_argument_group("upstream dispatcher (in-process only)")
+    upstream.add_argument("--upstream-rps", type=float, default=0.0, help="UPSTREAM_REQUESTS_PER_SECOND: client-side limit (0: none)")
+    upstream.add_argument("--upstream-burst", type=float, help="UPSTREAM_BURST: burst allowed by the client-side limit (default: --upstream-rps)")
+    upstream.add_argument("--upstream-retries", type=int, default=3, help="UPSTREAM_MAX_RETRIES: retries of a call answered with 429")
+    upstream.add_argument("--coalesce", action="store_true", help="UPSTREAM_COALESCE_ENABLED: share calls between identical first messages")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--trace-memory", action="store_true", help="Measure memory per session with tracemalloc (slows the server)")
+    output.add_argument("--json", action="store_true", help="Print the report as JSON")
+    output.add_argument("--max-p99-ms", type=float, help="Exit with status 1 if p99 latency exceeds this (regression gate)")
+    args = parser.parse_args(argv)
+
+    server = None
+    model = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        # Keep the server's per-request logging out of the measurement unless asked for
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ["UPSTREAM_REQUESTS_PER_SECOND"] = str(args.upstream_rps)
+        if args.upstream_burst is not None:
+            os.environ["UPSTREAM_BURST"] = str(args.upstream_burst)
+        os.environ["UPSTREAM_MAX_RETRIES"] = str(args.upstream_retries)
+        os.environ["UPSTREAM_COALESCE_ENABLED"] = "1" if args.coalesce else "0"
+        model = FakeGenerativeModel(
+            first_chunk_latency=args.first_chunk_latency,
+            chunk_interval=args.chunk_interval,
+            chunks_per_reply=args.chunks,
+            tool_call_probability=args.tool_probability,
+            tool_calls_per_turn=args.tool_calls,
+            prefetch_fallback_probability=args.prefetch_fallback,
+            quota_rps=args.quota_rps,
+            quota_burst=args.quota_burst,
+            seed=args.seed,
+        )
+        server = InProcessServer(args.server, model)
+        server.core.TOOL_PREFETCH_ENABLED = args.tool_prefetch
+        server.start()
+        base_url = server.url
+
+    if args.trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    try:
+        if args.rate:
+            results = run_open_loop(base_url, args.rate, args.duration, args.sessions, args.stream, args.max_clients, args.seed)
+        else:
+            results = run_closed_loop(base_url, args.concurrency, args.requests, args.sessions, args.stream)
+        elapsed = time.perf_counter() - started
+
+        report = summarize(results, elapsed)
+        report["mode"] = f"open loop, {args.rate}/s" if args.rate else f"closed loop, concurrency {args.concurrency}"
+        if server is not None:
+            report["server"] = args.server
+            report["sessions"] = server.session_count()
+            report["model_calls"] = model.calls
+            if args.quota_rps:
+                report["rate_limited_calls"] = model.rate_limited_calls
+                # Turns that failed because retries ran out (their reply is an error message, still with status 200)
+                report["rate_limited_turns"] = server.core.metrics.counter("chat_turn_errors_total", error="FakeRateLimitError").value()
+            report["coalesced_calls"] = server.core.metrics.counter("upstream_requests_total", outcome="coalesced").value()
+            report["tool_prefetch"] = args.tool_prefetch
+            if args.trace_memory:
+                gc.collect()
+                memory_growth = tracemalloc.get_traced_memory()[0] - memory_before
+                tracemalloc.stop()
+                # Includes everything the server retained (session histories, caches, metrics), amortized per session
+                report["memory_per_session_kib"] = round(memory_growth / max(1, report["sessions"]) / 1024, 2)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+    if args.max_p99_ms is not None and report["latency_ms"]["p99"] > args.max_p99_ms:
+        print(f"p99 latency {report['latency_ms']['p99']} ms exceeds --max-p99-ms {args.max_p99_ms}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
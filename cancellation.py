@@ -0,0 +1,87 @@
+import threading
+from contextlib import contextmanager
+
+from metrics import metrics
+
+
+class TurnCancelled(Exception):
+    """Raised inside a turn that was cancelled on request (e.g. the user barged in); its history has been rolled back."""
+
+
+# --- Cancellation handle for one running turn ---
+class CancelScope:
+    """
+    Set by ActiveTurns.cancel(). Threaded turns check it between streamed chunks and while waiting on tools
+    (raise_if_cancelled); asyncio turns register a callback that cancels their task (add_callback).
+    Callbacks run on the thread that calls cancel(), so asyncio callers must hop onto their loop.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Calls `callback()` when the scope is cancelled, or right away if it already is."""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self._cancelled:
+            raise TurnCancelled()
+
+
+# --- Registry of the turns currently running, per session ---
+class ActiveTurns:
+    """Lets a request other than the one running a turn (e.g. POST /chat/cancel) cancel it. Thread-safe."""
+
+    def __init__(self):
+        self._scopes = {} # session_id -> set of CancelScope
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, session_id):
+        """Registers a turn for `session_id` for the duration of the `with` block and yields its CancelScope."""
+        scope = CancelScope(session_id)
+        with self._lock:
+            self._scopes.setdefault(session_id, set()).add(scope)
+        try:
+            yield scope
+        finally:
+            with self._lock:
+                scopes = self._scopes.get(session_id)
+                if scopes is not None:
+                    scopes.discard(scope)
+                    if not scopes:
+                        del self._scopes[session_id]
+
+    def cancel(self, session_id):
+        """Cancels every running or queued turn of `session_id`; returns how many there were."""
+        with self._lock:
+            scopes = list(self._scopes.get(session_id, ()))
+        for scope in scopes:
+            scope.cancel()
+        if scopes:
+            metrics.counter("chat_turns_cancelled_total", reason="cancel_request").inc(len(scopes))
+        return len(scopes)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(scopes) for scopes in self._scopes.values())
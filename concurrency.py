@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class CapacityExceeded(Exception):
+    """Raised when a request can't be admitted; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# --- Admission control for the asyncio serving path ---
+class ConcurrencyLimiter:
+    """
+    Caps the number of chat turns admitted at once across the whole process (`max_in_flight`),
+    and queues turns from the same session behind each other so they run one at a time.
+    A session may have at most `max_queued_per_session` turns admitted (running + waiting).
+    Admission never waits: when either cap is reached, CapacityExceeded is raised immediately
+    so the caller can answer 429 with a Retry-After header.
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, max_in_flight=500, max_queued_per_session=4, retry_after_seconds=1):
+        self.max_in_flight = max_in_flight
+        self.max_queued_per_session = max_queued_per_session
+        self.retry_after_seconds = retry_after_seconds
+        self.in_flight = 0
+        self._session_queues = {} # session_id -> [asyncio.Lock, number of admitted turns]
+
+    def check(self, session_id):
+        """Raises CapacityExceeded if a turn for `session_id` would not be admitted right now."""
+        if self.in_flight >= self.max_in_flight:
+            raise CapacityExceeded("Server is at capacity", self.retry_after_seconds)
+        queue = self._session_queues.get(session_id)
+        if queue is not None and queue[1] >= self.max_queued_per_session:
+            raise CapacityExceeded("Too many pending messages for this session", self.retry_after_seconds)
+
+    @asynccontextmanager
+    async def acquire(self, session_id):
+        """Admits one turn (or raises CapacityExceeded), then waits for the session's earlier turns to finish."""
+        self.check(session_id)
+        queue = self._session_queues.setdefault(session_id, [asyncio.Lock(), 0])
+        self.in_flight += 1
+        queue[1] += 1
+        try:
+            async with queue[0]:
+                yield
+        finally:
+            self.in_flight -= 1
+            queue[1] -= 1
+            if queue[1] == 0:
+                # No turns left for this session; drop its lock so idle sessions cost nothing
+                self._session_queues.pop(session_id, None)
@@ -0,0 +1,207 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(content):
+    """Rough token count for one history entry (about 4 characters per token), without calling the API."""
+    characters = 0
+    for part in content.parts:
+        if part.text:
+            characters += len(part.text)
+        if part.function_call:
+            characters += len(part.function_call.name) + len(_to_json(part.function_call.args))
+        if part.function_response:
+            characters += len(part.function_response.name) + len(_to_json(part.function_response.response))
+    return characters // 4 + 4 # Small fixed overhead for role and part framing
+
+
+def _estimate_dict_tokens(content):
+    """estimate_tokens for the plain {"role", "parts": [...]} entries built by the compactor."""
+    characters = 0
+    for part in content["parts"]:
+        characters += len(part.get("text", ""))
+        for key, payload_key in (("function_call", "args"), ("function_response", "response")):
+            if key in part:
+                characters += len(part[key]["name"]) + len(_to_json(part[key][payload_key]))
+    return characters // 4 + 4
+
+
+def _to_json(value):
+    try:
+        return json.dumps(_plain(value), default=str, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _plain(value):
+    # Proto maps and repeated fields from the API behave like dicts and lists but aren't JSON-serializable
+    if hasattr(value, "keys"):
+        return {str(key): _plain(value[key]) for key in value.keys()}
+    if isinstance(value, (list, tuple)) or (hasattr(value, "__iter__") and not isinstance(value, (str, bytes))):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _shorten(text, limit):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def is_user_text_turn(content):
+    """True for an entry that starts a turn: a user message, as opposed to tool results sent back to the model."""
+    return content.role == "user" and not any(part.function_response for part in content.parts)
+
+
+def _has_tool_parts(content):
+    return any(part.function_call or part.function_response for part in content.parts)
+
+
+# --- Keeps a session's history small enough that every turn's request stays roughly the same size ---
+class HistoryCompactor:
+    """
+    Applied to a session after each completed turn:
+      - the last `keep_recent_turns` turns are kept exactly as they are;
+      - in older turns, tool results are shortened to at most `max_summary_chars` characters (a
+        {"result": ...} response keeps just its "result"), so bulky tool results aren't resent every turn.
+        The calls and results stay function_call / function_response parts, so the model's own replies
+        are never rewritten;
+      - if the history is still over `token_budget` (estimated), the oldest turns are dropped;
+      - if the recent turns alone are over the budget (e.g. a short session with large tool results),
+        their tool results are shortened too, and older turns dropped, down to the latest turn, which is
+        always kept as it is.
+
+    Token counts are cached per session and only new history entries are counted on each call. The session
+    also records how much of its history is already compacted, so each turn only collapses the turn that
+    has just left the recent window and the history is rewritten only when something changed; the cost per
+    turn doesn't grow with the length of the conversation.
+    """
+
+    def __init__(self, keep_recent_turns=6, token_budget=8000, max_summary_chars=300):
+        self.keep_recent_turns = keep_recent_turns
+        self.token_budget = token_budget
+        self.max_summary_chars = max_summary_chars
+
+    def compact(self, entry):
+        """Must be called while holding `entry.lock`, after a turn has completed."""
+        history = entry.chat.history
+        token_counts = self._update_token_counts(entry, history)
+        total_tokens = sum(token_counts)
+        # A rollback may have cut into the compacted part; what is left of it is still compacted
+        compacted = min(entry.history_compacted_length, len(history))
+        first_recent = self._recent_window_start(history)
+
+        if total_tokens <= self.token_budget and not any(_has_tool_parts(content) for content in history[compacted:first_recent]):
+            # Nothing to do; usually this only looks at the turn that just left the recent window
+            entry.history_compacted_length = max(compacted, first_recent)
+            return
+
+        turn_starts = [index for index, content in enumerate(history) if is_user_text_turn(content)]
+        if not turn_starts:
+            return
+        old_turn_count = sum(1 for start in turn_starts if start < first_recent)
+        # [entries, token counts] per turn; anything before the first user message stays with the first turn
+        turn_bounds = list(zip([0] + turn_starts[1:], turn_starts[1:] + [len(history)]))
+        turns = [[history[start:end], token_counts[start:end]] for start, end in turn_bounds]
+        done_turns = sum(1 for _, end in turn_bounds if end <= compacted) # Compacted on earlier calls
+        changed = False
+
+        def collapse(turn_index):
+            nonlocal total_tokens, changed
+            contents, counts = turns[turn_index]
+            if turn_index >= done_turns and any(_has_tool_parts(content) for content in contents):
+                collapsed = self._collapse_turn(contents)
+                collapsed_counts = [_estimate_dict_tokens(content) for content in collapsed]
+                total_tokens += sum(collapsed_counts) - sum(counts)
+                turns[turn_index] = [collapsed, collapsed_counts]
+                changed = True
+
+        for turn_index in range(old_turn_count):
+            collapse(turn_index)
+        compacted_turns = max(old_turn_count, done_turns)
+
+        # Drop the oldest turns until the estimated total fits the budget
+        dropped = 0
+        while dropped < old_turn_count and total_tokens > self.token_budget:
+            total_tokens -= sum(turns[dropped][1])
+            dropped += 1
+        if total_tokens > self.token_budget:
+            # The recent turns alone are over budget: shorten their tool results too, then drop turns
+            # until the budget is met, always keeping the latest turn as it is
+            for turn_index in range(old_turn_count, len(turns) - 1):
+                collapse(turn_index)
+            compacted_turns = max(compacted_turns, len(turns) - 1)
+            while dropped < len(turns) - 1 and total_tokens > self.token_budget:
+                total_tokens -= sum(turns[dropped][1])
+                dropped += 1
+        entry.history_compacted_length = sum(len(contents) for contents, _ in turns[dropped:compacted_turns])
+        if not changed and not dropped:
+            return
+
+        turns = turns[dropped:]
+        new_history = [content for contents, _ in turns for content in contents]
+        entry.chat.history = new_history
+        entry.history_token_counts = [count for _, counts in turns for count in counts]
+        logger.debug("History Compaction: session %s now has %s entries, ~%s tokens", entry.session_id, len(new_history), total_tokens)
+
+    def _recent_window_start(self, history):
+        """Index of the first entry of the last `keep_recent_turns` turns; 0 if there aren't more turns than that."""
+        if self.keep_recent_turns <= 0:
+            return len(history)
+        remaining = self.keep_recent_turns
+        for index in range(len(history) - 1, -1, -1):
+            if is_user_text_turn(history[index]):
+                remaining -= 1
+                if remaining == 0:
+                    return index
+        return 0
+
+    def _update_token_counts(self, entry, history):
+        counts = entry.history_token_counts
+        if counts is None:
+            counts = []
+        elif len(counts) > len(history):
+            # The history was rolled back to an earlier prefix (a cancelled or failed turn); the counts of
+            # that prefix still hold. Every other change appends entries or goes through compact() itself.
+            counts = counts[:len(history)]
+        for content in history[len(counts):]:
+            counts.append(estimate_tokens(content))
+        entry.history_token_counts = counts
+        return counts
+
+    def _collapse_turn(self, turn):
+        """
+        [user text, model call(s) (+ text), user result(s), ..., model text]
+          -> [user text, model call(s), user shortened result(s), model text]
+        """
+        user_content = turn[0]
+        calls = []
+        results = []
+        reply_texts = []
+        for content in turn[1:]:
+            for part in content.parts:
+                if part.function_call:
+                    calls.append({"function_call": {"name": part.function_call.name, "args": _plain(part.function_call.args)}})
+                if part.function_response:
+                    response = _plain(part.function_response.response)
+                    if isinstance(response, dict) and "result" in response:
+                        response = response["result"] # {"result": "...", "passages": [...]} -> "..."
+                    elif isinstance(response, dict) and "error" in response:
+                        response = response["error"]
+                    text = response if isinstance(response, str) else _to_json(response)
+                    results.append({"function_response": {
+                        "name": part.function_response.name,
+                        "response": {"result": _shorten(text, self.max_summary_chars)},
+                    }})
+                if part.text and content.role == "model":
+                    reply_texts.append(part.text)
+
+        user_text = "".join(part.text for part in user_content.parts if part.text)
+        collapsed = [{"role": "user", "parts": [{"text": user_text}]}]
+        if calls and len(calls) == len(results):
+            collapsed.append({"role": "model", "parts": calls})
+            collapsed.append({"role": "user", "parts": results})
+        if reply_texts:
+            collapsed.append({"role": "model", "parts": [{"text": "".join(reply_texts)}]})
+        return collapsed
@@ -0,0 +1,478 @@
+import argparse
+import array
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; without it scoring runs in pure Python and embeddings are disabled
+    np = None
+
+from response_cache import STOPWORDS as _CACHE_STOPWORDS, embed_text, normalize_message
+
+logger = logging.getLogger(__name__)
+
+# BM25 parameters (the usual defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant used to combine the BM25 and embedding rankings
+RRF_K = 60
+# Words that are neither indexed nor searched for: they match almost every passage, so a passage matching
+# only them (or only the common words of a query) would otherwise be returned as a confident answer
+STOPWORDS = _CACHE_STOPWORDS | frozenset("what whats who whom whose which when where why how about".split())
+
+
+def tokenize(text):
+    return [word for word in normalize_message(text).split() if word not in STOPWORDS]
+
+
+def _passage_text(passage):
+    """The text that is indexed for a passage: its title (if any) followed by its text."""
+    title = passage.get("title")
+    return f"{title} {passage['text']}" if title else passage["text"]
+
+
+def _idf(document_frequency, documents):
+    return math.log(1.0 + (documents - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+# --- Fixed-width arrays stored as raw native-endian files ---
+# The same files are read through numpy.memmap when NumPy is installed and through a memoryview otherwise;
+# either way they are memory-mapped, so opening an index costs no parsing and pages load on first use.
+_NUMPY_TYPES = {"i": "int32", "q": "int64", "f": "float32"}
+
+
+def _write_array(path, typecode, values):
+    with open(path, "wb") as file:
+        if np is not None and isinstance(values, np.ndarray):
+            values.astype(_NUMPY_TYPES[typecode], copy=False).tofile(file)
+        elif isinstance(values, array.array) and values.typecode == typecode:
+            values.tofile(file)
+        else:
+            array.array(typecode, values).tofile(file)
+
+
+def _map_array(path, typecode):
+    if os.path.getsize(path) == 0: # mmap can't map empty files
+        return np.zeros(0, dtype=_NUMPY_TYPES[typecode]) if np is not None else array.array(typecode)
+    if np is not None:
+        return np.memmap(path, dtype=_NUMPY_TYPES[typecode], mode="r")
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+def _top_k(scores_by_document, k):
+    """[(score, document)] for the `k` best scores, best first."""
+    return heapq.nlargest(k, ((score, document) for document, score in scores_by_document.items()))
+
+
+# --- Immutable on-disk segment ---
+class _DiskSegment:
+    """
+    One flushed batch of passages. Files in the segment directory:
+      meta.json           {"documents", "total_length", "dimensions"}
+      vocab.json          term -> term number
+      offsets.q           postings of term t are entries offsets[t]..offsets[t+1] of docs.i / tfs.i
+      docs.i, tfs.i       postings: document number within the segment and term frequency
+      lengths.i           token count of each document
+      passages.jsonl      one JSON passage per line, located through passage_offsets.q
+      embeddings.f        documents x dimensions float32 matrix (only if built with embeddings)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        self.documents = meta["documents"]
+        self.total_length = meta["total_length"]
+        self.dimensions = meta.get("dimensions", 0)
+        with open(os.path.join(path, "vocab.json")) as file:
+            self._vocab = json.load(file)
+        self._offsets = _map_array(os.path.join(path, "offsets.q"), "q")
+        self._docs = _map_array(os.path.join(path, "docs.i"), "i")
+        self._tfs = _map_array(os.path.join(path, "tfs.i"), "i")
+        self._lengths = _map_array(os.path.join(path, "lengths.i"), "i")
+        self._passage_offsets = _map_array(os.path.join(path, "passage_offsets.q"), "q")
+        with open(os.path.join(path, "passages.jsonl"), "rb") as file:
+            self._passages = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.documents else b""
+        self._embeddings = None
+        if self.dimensions and np is not None:
+            self._embeddings = _map_array(os.path.join(path, "embeddings.f"), "f").reshape(self.documents, self.dimensions)
+
+    @staticmethod
+    def write(path, segment):
+        """Writes the in-memory `segment` (a _MemorySegment) to the new directory `path`."""
+        os.makedirs(path)
+        vocab = {}
+        offsets = array.array("q", [0])
+        docs = array.array("i")
+        tfs = array.array("i")
+        for term_number, (term, (term_documents, term_tfs)) in enumerate(sorted(segment.postings.items())):
+            vocab[term] = term_number
+            docs.extend(term_documents)
+            tfs.extend(term_tfs)
+            offsets.append(len(docs))
+
+        passage_offsets = array.array("q", [0])
+        with open(os.path.join(path, "passages.jsonl"), "wb") as file:
+            for passage in segment.passages():
+                line = json.dumps(passage, ensure_ascii=False).encode("utf-8") + b"\n"
+                file.write(line)
+                passage_offsets.append(passage_offsets[-1] + len(line))
+
+        _write_array(os.path.join(path, "offsets.q"), "q", offsets)
+        _write_array(os.path.join(path, "docs.i"), "i", docs)
+        _write_array(os.path.join(path, "tfs.i"), "i", tfs)
+        _write_array(os.path.join(path, "lengths.i"), "i", segment.lengths)
+        _write_array(os.path.join(path, "passage_offsets.q"), "q", passage_offsets)
+        if segment.dimensions:
+            _write_array(os.path.join(path, "embeddings.f"), "f", segment.embedding_matrix())
+        with open(os.path.join(path, "vocab.json"), "w") as file:
+            json.dump(vocab, file, separators=(",", ":"))
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump({"documents": segment.documents, "total_length": segment.total_length, "dimensions": segment.dimensions}, file)
+
+    def document_frequency(self, term):
+        term_number = self._vocab.get(term)
+        if term_number is None:
+            return 0
+        return int(self._offsets[term_number + 1] - self._offsets[term_number])
+
+    def bm25_top(self, term_idfs, average_length, k):
+        postings = []
+        for term, idf in term_idfs:
+            term_number = self._vocab.get(term)
+            if term_number is not None:
+                postings.append((int(self._offsets[term_number]), int(self._offsets[term_number + 1]), idf))
+        if not postings:
+            return []
+
+        if np is None:
+            scores = {}
+            for start, end, idf in postings:
+                for document, tf in zip(self._docs[start:end], self._tfs[start:end]):
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[document] / average_length)
+                    scores[document] = scores.get(document, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            return _top_k(scores, k)
+
+        scores = np.zeros(self.documents, dtype=np.float32)
+        for start, end, idf in postings:
+            documents = self._docs[start:end]
+            tfs = self._tfs[start:end].astype(np.float32)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[documents] / average_length)
+            scores[documents] += idf * tfs * (BM25_K1 + 1) / (tfs + norms) # A term lists each document once
+        return _numpy_top_k(scores, k)
+
+    def embedding_top(self, query_vector, k):
+        if self._embeddings is None or not self.documents:
+            return []
+        return _numpy_top_k(self._embeddings @ query_vector, k)
+
+    def passage(self, document):
+        start, end = int(self._passage_offsets[document]), int(self._passage_offsets[document + 1])
+        return json.loads(self._passages[start:end])
+
+
+def _numpy_top_k(scores, k):
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+    return sorted(((float(scores[document]), int(document)) for document in candidates), reverse=True)
+
+
+# --- In-memory segment receiving new passages until it is flushed ---
+class _MemorySegment:
+    def __init__(self, dimensions=0):
+        self.dimensions = dimensions
+        self.documents = 0
+        self.total_length = 0
+        # term -> (documents, tfs); int arrays rather than lists of tuples keep millions of postings
+        # compact and out of the garbage collector's way
+        self.postings = {}
+        self.lengths = array.array("i")
+        self._passages = []
+        # Rows are written into spare capacity, so searches get the matrix as a view instead of a copy
+        self._embeddings = np.zeros((0, dimensions), dtype=np.float32) if dimensions else None
+        self._embedding_count = 0
+
+    def add(self, passage):
+        document = self.documents
+        tokens = tokenize(_passage_text(passage))
+        self.lengths.append(len(tokens))
+        self._passages.append(passage)
+        if self.dimensions:
+            if self._embedding_count == len(self._embeddings):
+                grown = np.zeros((max(64, 2 * len(self._embeddings)), self.dimensions), dtype=np.float32)
+                grown[:self._embedding_count] = self._embeddings[:self._embedding_count]
+                self._embeddings = grown
+            self._embeddings[self._embedding_count] = embed_text(normalize_message(_passage_text(passage)), self.dimensions)
+            self._embedding_count += 1
+        # Postings go in last: a search running concurrently may see them right away
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_postings = self.postings.get(token)
+            if term_postings is None:
+                term_postings = self.postings[token] = (array.array("i"), array.array("i"))
+            term_postings[0].append(document)
+            term_postings[1].append(count)
+        self.documents += 1
+        self.total_length += len(tokens)
+
+    def document_frequency(self, term):
+        term_postings = self.postings.get(term)
+        return len(term_postings[0]) if term_postings else 0
+
+    def bm25_top(self, term_idfs, average_length, k):
+        scores = {}
+        for term, idf in term_idfs:
+            term_postings = self.postings.get(term)
+            if term_postings is None:
+                continue
+            for document, tf in zip(*term_postings):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[document] / average_length)
+                scores[document] = scores.get(document, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return _top_k(scores, k)
+
+    def embedding_top(self, query_vector, k):
+        if not self._embedding_count:
+            return []
+        return _numpy_top_k(self.embedding_matrix() @ query_vector, k)
+
+    def embedding_matrix(self):
+        count = self._embedding_count # Read first: rows below it are complete in whichever array is current
+        return self._embeddings[:count]
+
+    def passage(self, document):
+        return self._passages[document]
+
+    def passages(self):
+        return self._passages
+
+
+# --- Passage retrieval for search_tool ---
+class KnowledgeBase:
+    """
+    BM25 retrieval over passages ({"text": ..., optional "title" and "id"}), optionally fused with a
+    similarity search over hashed embeddings (response_cache.embed_text) when `embedding_dimensions` is set
+    and NumPy is installed.
+
+    The index is a list of immutable segments plus one in-memory segment. add() only touches the in-memory
+    segment, which is written out as a new segment once it holds `flush_threshold` passages, so adding
+    passages never rebuilds the existing index. Segments live in `path` (a directory; listed in
+    manifest.json) and are memory-mapped when opened, so a large index is ready to serve without
+    being parsed. Without a `path` everything stays in memory. compact() merges all segments into one.
+    Searches may run concurrently with each other and with add().
+
+    A passage is only returned if it contains at least `min_coverage` of the query's words, weighted by IDF
+    (rare words count more, and words the index has never seen count the most), so "capital of germany"
+    finds nothing rather than the best-scoring passage about some other capital.
+    """
+
+    def __init__(self, path=None, embedding_dimensions=0, flush_threshold=10000, min_coverage=0.6):
+        self.path = path
+        self.flush_threshold = flush_threshold
+        self.min_coverage = min_coverage
+        self._lock = threading.Lock() # Guards the segment list and the in-memory segment
+        self._segments = []
+        self._next_segment_number = 1
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            manifest = self._read_manifest()
+            # An existing index keeps the embedding setting it was built with
+            embedding_dimensions = manifest.get("dimensions", embedding_dimensions) if manifest["segments"] else embedding_dimensions
+            self._segments = [_DiskSegment(os.path.join(path, name)) for name in manifest["segments"]]
+            self._next_segment_number = manifest.get("next_segment", 1)
+        self._index_dimensions = embedding_dimensions # Recorded in the manifest even while embeddings are off
+        if embedding_dimensions and np is None:
+            logger.warning("Knowledge Base: NumPy is not installed; embedding search disabled")
+            embedding_dimensions = 0
+        self.embedding_dimensions = embedding_dimensions
+        self._memory = _MemorySegment(embedding_dimensions)
+
+    def __len__(self):
+        with self._lock:
+            return sum(segment.documents for segment in self._segments) + self._memory.documents
+
+    def add(self, passages):
+        """Adds passages; they are searchable as soon as this returns."""
+        with self._lock:
+            for passage in passages:
+                self._memory.add(passage)
+            if self.path is not None and self._memory.documents >= self.flush_threshold:
+                self._flush_locked()
+
+    def flush(self):
+        """Writes the passages added since the last flush as a new segment (no-op without a `path`)."""
+        with self._lock:
+            if self.path is not None and self._memory.documents:
+                self._flush_locked()
+
+    def compact(self):
+        """Merges every segment (and unflushed passages) into a single segment, for faster searches."""
+        if self.path is None:
+            return
+        with self._lock:
+            merged = _MemorySegment(self.embedding_dimensions)
+            for segment in self._segments:
+                for document in range(segment.documents):
+                    merged.add(segment.passage(document))
+            for passage in self._memory.passages():
+                merged.add(passage)
+            old_names = [os.path.basename(segment.path) for segment in self._segments]
+            self._segments = [self._write_segment_locked(merged)] if merged.documents else []
+            self._memory = _MemorySegment(self.embedding_dimensions)
+            self._write_manifest_locked()
+        for name in old_names:
+            _remove_segment(os.path.join(self.path, name))
+
+    def search(self, query, top_k=3):
+        """
+        Returns up to `top_k` of the best passages that cover enough of the query (possibly none) as dicts
+        with an added "score", best first. The score is the BM25 score, or the reciprocal-rank-fusion score
+        when embeddings are enabled.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            segments = self._segments + [self._memory]
+        documents = sum(segment.documents for segment in segments)
+        if not documents:
+            return []
+        average_length = max(1.0, sum(segment.total_length for segment in segments) / documents)
+
+        # Collection-wide statistics, so scores from different segments are comparable
+        term_weights = {}
+        term_idfs = []
+        for term in terms:
+            document_frequency = sum(segment.document_frequency(term) for segment in segments)
+            term_weights[term] = _idf(document_frequency, documents)
+            if document_frequency:
+                term_idfs.append((term, term_weights[term]))
+        if not term_idfs:
+            return []
+        required_weight = self.min_coverage * sum(term_weights.values())
+
+        def relevant(ranked):
+            # Best first, skipping passages that miss too much of the query
+            found = []
+            for score, (segment_index, document) in ranked:
+                passage = segments[segment_index].passage(document)
+                passage_terms = set(tokenize(_passage_text(passage)))
+                if sum(weight for term, weight in term_weights.items() if term in passage_terms) >= required_weight:
+                    found.append(dict(passage, score=round(score, 4)))
+                    if len(found) == top_k:
+                        break
+            return found
+
+        candidates = max(top_k, 1) * 4
+        bm25_ranking = heapq.nlargest(candidates, (
+            (score, segment_index, document)
+            for segment_index, segment in enumerate(segments)
+            for score, document in segment.bm25_top(term_idfs, average_length, candidates)
+        ))
+        if not self.embedding_dimensions:
+            return relevant((score, (segment_index, document)) for score, segment_index, document in bm25_ranking)
+
+        query_vector = embed_text(normalize_message(query), self.embedding_dimensions)
+        embedding_ranking = heapq.nlargest(candidates, (
+            (score, segment_index, document)
+            for segment_index, segment in enumerate(segments)
+            for score, document in segment.embedding_top(query_vector, candidates)
+        ))
+        fused = {}
+        for ranking in (bm25_ranking, embedding_ranking):
+            for rank, (_, segment_index, document) in enumerate(ranking):
+                key = (segment_index, document)
+                fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+        return relevant(sorted(((score, key) for key, score in fused.items()), reverse=True))
+
+    def _flush_locked(self):
+        self._segments.append(self._write_segment_locked(self._memory))
+        self._memory = _MemorySegment(self.embedding_dimensions)
+        self._write_manifest_locked()
+
+    def _write_segment_locked(self, segment):
+        name = f"segment-{self._next_segment_number:06d}"
+        self._next_segment_number += 1
+        started = time.perf_counter()
+        _DiskSegment.write(os.path.join(self.path, name), segment)
+        logger.info("Knowledge Base: wrote %s (%s passages) in %.2fs", name, segment.documents, time.perf_counter() - started)
+        return _DiskSegment(os.path.join(self.path, name))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, "manifest.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"segments": []}
+
+    def _write_manifest_locked(self):
+        manifest = {
+            "segments": [os.path.basename(segment.path) for segment in self._segments],
+            "next_segment": self._next_segment_number,
+            "dimensions": self._index_dimensions,
+        }
+        # Written to a temporary file and renamed, so a crash never leaves a half-written manifest
+        temporary_path = os.path.join(self.path, "manifest.json.tmp")
+        with open(temporary_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temporary_path, os.path.join(self.path, "manifest.json"))
+
+
+def _remove_segment(path):
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+
+def read_passages(path):
+    """Reads passages from a JSON Lines file: one {"text": ..., "title": ..., "id": ...} object per line."""
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+# --- Command line: build or extend an index ahead of time ---
+#   python knowledge_base.py add INDEX_DIR passages.jsonl [--embedding-dimensions 256]
+#   python knowledge_base.py compact INDEX_DIR
+#   python knowledge_base.py search INDEX_DIR "capital of france"
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build, extend and query a knowledge base index for search_tool.")
+    parser.add_argument("command", choices=("add", "compact", "search"))
+    parser.add_argument("index", help="Index directory (KNOWLEDGE_BASE_PATH)")
+    parser.add_argument("argument", nargs="?", help="add: JSON Lines file of passages; search: the query")
+    parser.add_argument("--embedding-dimensions", type=int, default=0, help="Also build hashed embeddings (new index only)")
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    knowledge_base = KnowledgeBase(args.index, embedding_dimensions=args.embedding_dimensions)
+    if args.command == "add":
+        batch = []
+        for passage in read_passages(args.argument):
+            batch.append(passage)
+            if len(batch) == 1000:
+                knowledge_base.add(batch)
+                batch = []
+        knowledge_base.add(batch)
+        knowledge_base.flush()
+        print(f"{len(knowledge_base)} passages in {args.index}")
+    elif args.command == "compact":
+        knowledge_base.compact()
+        print(f"{len(knowledge_base)} passages in {args.index}")
+    else:
+        started = time.perf_counter()
+        for result in knowledge_base.search(args.argument, args.top_k):
+            print(json.dumps(result, ensure_ascii=False))
+        print(f"({(time.perf_counter() - started) * 1000:.1f} ms)")
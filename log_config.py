@@ -0,0 +1,32 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+
+_listener = None
+
+
+def setup_logging(level=None):
+    """
+    Sends all log records through an in-memory queue to a background listener thread, which does the
+    actual (blocking) writes to stderr. Logging from a request thread only formats the record and
+    enqueues it. The level defaults to the LOG_LEVEL environment variable (INFO if unset).
+    Safe to call more than once; only the first call installs the handlers.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s"))
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # Flush whatever is still queued on shutdown
@@ -0,0 +1,206 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Histogram bucket upper bounds in seconds: 0.25 ms up to ~2 minutes, each bucket 25% wider than the last
+_BUCKET_BOUNDS = []
+_bound = 0.00025
+while _bound < 120:
+    _BUCKET_BOUNDS.append(_bound)
+    _bound *= 1.25
+_BUCKET_BOUNDS = tuple(_BUCKET_BOUNDS)
+
+
+# --- Per-thread shards shared by Histogram and Counter ---
+class _ThreadShards:
+    """
+    Gives each thread its own mutable shard, so recording a value takes no lock and never contends
+    with other request threads. Shards of threads that have exited are folded into `retired` whenever
+    a new shard is created or the values are read, so thread-per-request servers don't grow the list.
+    """
+
+    def __init__(self, make_shard, fold):
+        self._make_shard = make_shard
+        self._fold = fold # fold(into, shard) adds `shard` into `into`
+        self._local = threading.local()
+        self._live = [] # (thread, shard)
+        self._retired = make_shard()
+        self._lock = threading.Lock() # Only taken when a thread records its first value, and on reads
+
+    def local(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._make_shard()
+            self._local.shard = shard
+            with self._lock:
+                self._fold_dead_locked()
+                self._live.append((threading.current_thread(), shard))
+        return shard
+
+    def merged(self):
+        with self._lock:
+            self._fold_dead_locked()
+            total = self._make_shard()
+            self._fold(total, self._retired)
+            for _, shard in self._live:
+                self._fold(total, shard)
+        return total
+
+    def _fold_dead_locked(self):
+        still_alive = []
+        for thread, shard in self._live:
+            if thread.is_alive():
+                still_alive.append((thread, shard))
+            else:
+                self._fold(self._retired, shard)
+        self._live = still_alive
+
+
+def _new_histogram_shard():
+    return [[0] * (len(_BUCKET_BOUNDS) + 1), 0.0] # [bucket counts (+ overflow bucket), sum]
+
+
+def _fold_histogram_shard(into, shard):
+    into_counts, shard_counts = into[0], shard[0]
+    for index, count in enumerate(shard_counts):
+        into_counts[index] += count
+    into[1] += shard[1]
+
+
+# --- Fixed-bucket latency histogram ---
+class Histogram:
+    def __init__(self):
+        self._shards = _ThreadShards(_new_histogram_shard, _fold_histogram_shard)
+
+    def observe(self, seconds):
+        shard = self._shards.local()
+        shard[0][bisect.bisect_left(_BUCKET_BOUNDS, seconds)] += 1
+        shard[1] += seconds
+
+    def snapshot(self):
+        """Returns (merged bucket counts, total count, sum of observed values)."""
+        counts, total_sum = self._shards.merged()
+        return counts, sum(counts), total_sum
+
+
+def quantile(counts, total, q):
+    """Estimates the q-quantile from merged bucket counts, interpolating linearly inside the bucket."""
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = _BUCKET_BOUNDS[index - 1] if index > 0 else 0.0
+            upper = _BUCKET_BOUNDS[index] if index < len(_BUCKET_BOUNDS) else _BUCKET_BOUNDS[-1]
+            return lower + (upper - lower) * ((rank - seen) / count)
+        seen += count
+    return _BUCKET_BOUNDS[-1]
+
+
+def _fold_counter_shard(into, shard):
+    into[0] += shard[0]
+
+
+# --- Monotonic counter ---
+class Counter:
+    def __init__(self):
+        self._shards = _ThreadShards(lambda: [0], _fold_counter_shard)
+
+    def inc(self, amount=1):
+        self._shards.local()[0] += amount
+
+    def value(self):
+        return self._shards.merged()[0]
+
+
+# --- Registry of all metrics, rendered in the Prometheus text format by /metrics ---
+class MetricsRegistry:
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self._histograms = {} # (name, sorted label items) -> Histogram
+        self._counters = {} # (name, sorted label items) -> Counter
+        self._gauge_sources = [] # callables returning {(name, label items): value}
+        self._lock = threading.Lock() # Only taken when a new metric/label combination is first seen
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def add_gauge_source(self, source):
+        """`source()` is called on every scrape and returns {(metric name, ((label, value), ...)): number}."""
+        self._gauge_sources.append(source)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Times the `with` block on the monotonic clock and records it under stage_duration_seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started, **labels)
+
+    def observe_stage(self, stage, seconds, **labels):
+        """For stages that can't be wrapped in a `with` block, e.g. ones spanning yields of a generator."""
+        self.histogram("stage_duration_seconds", stage=stage, **labels).observe(seconds)
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        declared = set()
+        for (name, label_items), histogram in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {name} summary")
+                declared.add(name)
+            counts, total, total_sum = histogram.snapshot()
+            for q in self.QUANTILES:
+                lines.append(f"{name}{_format_labels(label_items + (('quantile', str(q)),))} {quantile(counts, total, q):.6f}")
+            lines.append(f"{name}_sum{_format_labels(label_items)} {total_sum:.6f}")
+            lines.append(f"{name}_count{_format_labels(label_items)} {total}")
+
+        for (name, label_items), counter in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(label_items)} {counter.value()}")
+
+        for source in self._gauge_sources:
+            for (name, label_items), value in sorted(source().items()):
+                if name not in declared:
+                    lines.append(f"# TYPE {name} gauge")
+                    declared.add(name)
+                lines.append(f"{name}{_format_labels(label_items)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(label_items):
+    if not label_items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in label_items) + "}"
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide registry used by the app
+metrics = MetricsRegistry()
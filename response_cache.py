@@ -0,0 +1,155 @@
+import re
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; without it only exact (normalized) repeats are served from the cache
+    np = None
+
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def normalize_message(text):
+    """Lowercases, drops punctuation and collapses whitespace: "What's  the capital of France?" -> "what s the capital of france"."""
+    return " ".join(_WORD_PATTERN.findall(text.casefold()))
+
+
+# Words that don't change what a question asks for; everything else is a content word
+STOPWORDS = frozenset("""
+a an the and or but of in on at to for from by with about as into than then so
+is are was were be been being am do does did has have had will would can could shall should may might must
+i me my we our you your he him his she her it its they them their this that these those there here
+s t d ll re ve m please tell say give know like
+""".split())
+
+
+def content_words(normalized_text):
+    """The words of a normalized message minus STOPWORDS: {"weather", "london", "weekend"} for "what s the weather in london this weekend"."""
+    return frozenset(word for word in normalized_text.split() if word not in STOPWORDS)
+
+
+def embed_text(normalized_text, dimensions=512):
+    """
+    Cheap local embedding: hashed word unigrams, word bigrams and character trigrams, L2-normalized.
+    crc32 is used instead of hash() so vectors are stable across processes.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    words = normalized_text.split()
+    features = list(words)
+    features += [f"{first} {second}" for first, second in zip(words, words[1:])]
+    padded = f" {normalized_text} "
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    for feature in features:
+        vector[zlib.crc32(feature.encode("utf-8")) % dimensions] += 1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+# --- Cache of answers to standalone questions ---
+class ResponseCache:
+    """
+    Maps context-free questions to the reply the model gave, so a repeat of the same question
+    (or a close paraphrase) is answered without calling the model.
+
+    Lookups first try an exact match on the normalized text, then a nearest-neighbour search over the
+    embeddings of all cached questions (one matrix-vector product); a neighbour counts as a hit when its
+    cosine similarity is at least `similarity_threshold` *and* it has exactly the same content words
+    (content_words()). The hashed embedding alone can't tell "weather in London this weekend" from
+    "weather in Madrid this weekend", so the fuzzy match only absorbs differences in wording, word order,
+    punctuation and stopwords. Entries expire after `ttl_seconds`, and when the cache holds `max_entries`
+    the least recently used entry is overwritten.
+    """
+
+    def __init__(self, max_entries=5000, similarity_threshold=0.92, ttl_seconds=3600, dimensions=512):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.dimensions = dimensions
+        self._lock = threading.Lock()
+        self._slot_by_text = {} # normalized question -> row index
+        self._texts = [None] * max_entries
+        self._content_words = [None] * max_entries
+        self._replies = [None] * max_entries
+        self._expires_at = [0.0] * max_entries
+        self._size = 0 # Rows in use: always the first `_size` rows
+        if np is not None:
+            self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+            self._last_used = np.zeros(max_entries, dtype=np.float64)
+        else:
+            self._vectors = None
+            self._last_used = [0.0] * max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_message):
+        normalized = normalize_message(user_message)
+        if not normalized:
+            return None
+        query_vector = embed_text(normalized, self.dimensions) if np is not None else None
+        now = time.monotonic()
+
+        with self._lock:
+            slot = self._slot_by_text.get(normalized)
+            if slot is None and query_vector is not None and self._size:
+                similarities = self._vectors[:self._size] @ query_vector
+                query_words = content_words(normalized)
+                # Most similar first, among the neighbours above the threshold
+                for candidate in np.argsort(-similarities):
+                    if similarities[candidate] < self.similarity_threshold:
+                        break
+                    if self._content_words[candidate] == query_words:
+                        slot = int(candidate)
+                        break
+
+            if slot is None or self._expires_at[slot] <= now:
+                self.misses += 1
+                return None
+
+            self._last_used[slot] = now
+            self.hits += 1
+            return self._replies[slot]
+
+    def store(self, user_message, reply):
+        normalized = normalize_message(user_message)
+        if not normalized:
+            return
+        query_vector = embed_text(normalized, self.dimensions) if np is not None else None
+        now = time.monotonic()
+
+        with self._lock:
+            slot = self._slot_by_text.get(normalized)
+            if slot is None:
+                if self._size < self.max_entries:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    # Full: overwrite the least recently used row
+                    if np is not None:
+                        slot = int(np.argmin(self._last_used[:self._size]))
+                    else:
+                        slot = min(range(self._size), key=self._last_used.__getitem__)
+                    del self._slot_by_text[self._texts[slot]]
+                self._slot_by_text[normalized] = slot
+                self._texts[slot] = normalized
+                self._content_words[slot] = content_words(normalized)
+                if query_vector is not None:
+                    self._vectors[slot] = query_vector
+
+            self._replies[slot] = reply
+            self._expires_at[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._size,
+            }
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from history_manager import is_user_text_turn
+
+logger = logging.getLogger(__name__)
+
+
+# --- A single client's conversation state ---
+class ChatSessionEntry:
+    """
+    Holds one client's Gemini chat object plus the lock that serializes turns on it.
+    The Gemini chat object is not thread-safe, so every turn must run while holding `lock`.
+    """
+
+    def __init__(self, session_id, chat):
+        self.session_id = session_id
+        self.chat = chat
+        self.lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.history_token_counts = None # Per-entry token estimates cached by the history compactor
+        self.history_compacted_length = 0 # Leading history entries the history compactor is done with
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+
+# --- Bounded pool of chat sessions keyed by client session id ---
+class ChatSessionManager:
+    """
+    Keeps at most `max_sessions` chat sessions, evicting the least recently used one when full
+    and any session idle for longer than `idle_ttl_seconds`.
+    `chat_factory` is called with no arguments to create a fresh chat object for a new session.
+    `history_compactor`, if given, is applied to a session's history after every turn (see history_manager.py).
+    """
+
+    def __init__(self, chat_factory, max_sessions=1000, idle_ttl_seconds=1800, max_history_messages=40,
+                 history_compactor=None):
+        self._chat_factory = chat_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_history_messages = max_history_messages
+        self.history_compactor = history_compactor
+        self._sessions = OrderedDict() # session_id -> ChatSessionEntry, least recently used first
+        self._pool_lock = threading.Lock() # Guards _sessions only, never held during a model call
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def get(self, session_id):
+        """Returns the session for `session_id`, creating it if it doesn't exist (or was evicted)."""
+        with self._pool_lock:
+            self._evict_idle_locked()
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions.move_to_end(session_id)
+                entry.touch()
+                return entry
+
+            # Evict least recently used sessions to make room. A session evicted while a turn is
+            # running on it stays alive for that turn; it is only dropped from the pool.
+            while len(self._sessions) >= self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                logger.debug("Session Pool: evicted least recently used session %s", evicted_id)
+
+            entry = ChatSessionEntry(session_id, self._chat_factory())
+            self._sessions[session_id] = entry
+            return entry
+
+    def remove(self, session_id):
+        with self._pool_lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._pool_lock:
+            return len(self._sessions)
+
+    def _evict_idle_locked(self):
+        if not self.idle_ttl_seconds:
+            return
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        # The OrderedDict is in LRU order, so stop at the first session that is still fresh.
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_used >= cutoff:
+                break
+            del self._sessions[oldest_id]
+            logger.debug("Session Pool: evicted idle session %s", oldest_id)
+
+    def trim_history(self, entry):
+        """
+        Compacts the session's history (if a compactor is configured), then caps it at
+        `max_history_messages` entries. Must be called while holding `entry.lock`, after a turn has completed.
+        """
+        if self.history_compactor is not None:
+            self.history_compactor.compact(entry)
+        if not self.max_history_messages:
+            return
+        history = entry.chat.history
+        if len(history) <= self.max_history_messages:
+            return
+
+        start = len(history) - self.max_history_messages
+        # Only cut at the start of a plain user turn, so the kept history never opens with
+        # a model reply or with tool results whose function call was cut away.
+        while start < len(history) and not is_user_text_turn(history[start]):
+            start += 1
+        entry.chat.history = history[start:]
+        # Keep the compactor's per-entry token counts aligned with the entries that are left
+        if entry.history_token_counts is not None:
+            entry.history_token_counts = entry.history_token_counts[start:]
+        entry.history_compacted_length = max(0, entry.history_compacted_length - start)
+
@@ -0,0 +1,333 @@
+import asyncio
+import json
+import logging
+import re
+import shutil
+import time
+
+try:
+    import vosk
+except ImportError: # Vosk is optional; without it the client sends transcripts instead of audio
+    vosk = None
+
+from cancellation import TurnCancelled
+from concurrency import CapacityExceeded
+from metrics import metrics
+from response_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+
+_SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+
+
+def split_complete_sentences(text):
+    """Splits every complete sentence off the front of `text`; returns (sentences, trailing partial sentence)."""
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    return sentences, text[start:]
+
+
+# --- Speech-to-text engines ---
+class VoskSpeechRecognizer:
+    """
+    Offline recognizer for raw audio frames (16-bit little-endian mono PCM at `sample_rate`).
+    The model is loaded once; every connection gets its own recognizer stream from new_stream().
+    """
+
+    def __init__(self, model_path, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self._model = vosk.Model(model_path)
+
+    def new_stream(self):
+        return _VoskStream(vosk.KaldiRecognizer(self._model, self.sample_rate))
+
+
+class _VoskStream:
+    def __init__(self, recognizer):
+        self._recognizer = recognizer
+        self._last_partial = ""
+
+    async def accept_audio(self, frame):
+        """Feeds one audio frame; returns a list of (transcript, is_final) updates, possibly empty."""
+        # Decoding is CPU-bound, so it runs on the default executor instead of the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._accept, frame)
+
+    def _accept(self, frame):
+        if self._recognizer.AcceptWaveform(frame):
+            self._last_partial = ""
+            text = json.loads(self._recognizer.Result()).get("text", "")
+            return [(text, True)] if text else []
+        partial = json.loads(self._recognizer.PartialResult()).get("partial", "")
+        if partial and partial != self._last_partial:
+            self._last_partial = partial
+            return [(partial, False)]
+        return []
+
+
+# --- Text-to-speech engines ---
+class BrowserSpeechSynthesis:
+    """No server-side audio: the client speaks the text of each `sentence` event itself (speechSynthesis)."""
+    content_type = None
+
+    async def synthesize(self, text):
+        return None
+
+
+class EspeakSpeechSynthesis:
+    """Offline synthesis with the espeak-ng (or espeak) command line tool; returns one WAV file per sentence."""
+    content_type = "audio/wav"
+
+    def __init__(self, command="espeak-ng", voice=None, words_per_minute=None):
+        self.command = command
+        self.options = []
+        if voice:
+            self.options += ["-v", voice]
+        if words_per_minute:
+            self.options += ["-s", str(words_per_minute)]
+
+    async def synthesize(self, text):
+        process = await asyncio.create_subprocess_exec(
+            self.command, "--stdout", *self.options, text,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        audio, _ = await process.communicate()
+        if process.returncode != 0:
+            logger.warning("Speech Synthesis Error: %s exited with status %s", self.command, process.returncode)
+            return None
+        return audio
+
+
+def speech_engines_from_config(stt_engine="transcript", vosk_model_path=None, sample_rate=16000,
+                               tts_engine="browser", tts_command="espeak-ng", tts_voice=None):
+    """Returns (recognizer or None, synthesizer), falling back to client-side speech when an engine is unavailable."""
+    recognizer = None
+    if stt_engine == "vosk":
+        if vosk is None or not vosk_model_path:
+            logger.warning("Speech Config: SPEECH_STT_ENGINE=vosk needs the vosk package and VOSK_MODEL_PATH; accepting transcripts only")
+        else:
+            recognizer = VoskSpeechRecognizer(vosk_model_path, sample_rate)
+
+    synthesizer = BrowserSpeechSynthesis()
+    if tts_engine == "espeak":
+        if shutil.which(tts_command) is None:
+            logger.warning("Speech Config: %s not found on PATH; the browser will synthesize speech", tts_command)
+        else:
+            synthesizer = EspeakSpeechSynthesis(tts_command, tts_voice)
+    return recognizer, synthesizer
+
+
+# --- A turn started on a stable partial transcript before the user finished speaking ---
+class SpeculativeTurn:
+    def __init__(self, text):
+        self.text = text
+        self.normalized_text = normalize_message(text)
+        self.deltas = asyncio.Queue() # Reply text, buffered until the final transcript confirms the guess
+        self.adopted = asyncio.get_running_loop().create_future()
+        self.failed = False
+        self.task = None
+
+    async def buffered_deltas(self):
+        while True:
+            text_delta = await self.deltas.get()
+            if text_delta is None:
+                return
+            yield text_delta
+
+
+# --- One voice WebSocket connection ---
+class VoiceConversation:
+    """
+    Turns transcripts (sent by the client, or recognized here from audio frames) into replies that are
+    streamed back as text deltas and, sentence by sentence, as synthesized speech.
+
+    When a partial transcript hasn't changed for `stable_seconds`, the turn is started speculatively on a
+    copy of the session's chat (`stream_speculative_turn`). If the final transcript matches (ignoring case and
+    punctuation) the buffered reply is adopted, so the user only waits for what's left of the model call;
+    otherwise the guess is cancelled and the turn runs normally (`stream_turn`).
+
+    `stream_turn(text)` and `stream_speculative_turn(text, adopted_future)` are async generators of reply text
+    supplied by the serving app; `adopted_future` resolves to the final transcript when the guess is adopted; `send_event(dict)` and `send_audio(bytes)` write to the socket.
+    Must be used from the event loop thread.
+    """
+
+    def __init__(self, send_event, send_audio, stream_turn, stream_speculative_turn, recognizer=None,
+                 synthesizer=None, stable_seconds=0.3):
+        self._send_event = send_event
+        self._send_audio = send_audio
+        self._stream_turn = stream_turn
+        self._stream_speculative_turn = stream_speculative_turn
+        self._audio_stream = recognizer.new_stream() if recognizer is not None else None
+        self._synthesizer = synthesizer or BrowserSpeechSynthesis()
+        self.stable_seconds = stable_seconds
+        self._last_partial = None
+        self._stability_timer = None
+        self._speculation = None
+        self._turn_task = None # Replies are spoken one after another, in the order the user finished speaking
+
+    async def handle_message(self, message):
+        if isinstance(message, bytes):
+            if self._audio_stream is None:
+                await self._send_event({"type": "error", "message": "Audio input is not enabled on this server; send transcripts instead."})
+                return
+            for text, is_final in await self._audio_stream.accept_audio(message):
+                await self._send_event({"type": "transcript", "text": text, "final": is_final})
+                await (self.on_final(text) if is_final else self.on_partial(text))
+            return
+
+        try:
+            event = json.loads(message)
+        except ValueError:
+            event = None
+        if isinstance(event, dict) and event.get("type") == "cancel":
+            await self.cancel()
+            return
+        if not isinstance(event, dict) or not isinstance(event.get("text"), str):
+            await self._send_event({"type": "error", "message": "Expected a JSON object with 'type' and 'text'."})
+            return
+        if event.get("type") == "partial":
+            await self.on_partial(event["text"])
+        elif event.get("type") == "final":
+            await self.on_final(event["text"])
+        else:
+            await self._send_event({"type": "error", "message": f"Unknown message type: {event.get('type')!r}"})
+
+    async def on_partial(self, text):
+        normalized = normalize_message(text)
+        if not normalized or normalized == self._last_partial:
+            return
+        self._last_partial = normalized
+        self._cancel_stability_timer()
+        if self._speculation is not None and self._speculation.normalized_text != normalized:
+            # The user kept talking; the guess is out of date
+            self._discard_speculation()
+        if self.stable_seconds > 0:
+            self._stability_timer = asyncio.create_task(self._speculate_when_stable(text))
+
+    async def on_final(self, text):
+        final_received = time.perf_counter()
+        self._cancel_stability_timer()
+        self._last_partial = None
+        normalized = normalize_message(text)
+        if not normalized:
+            return
+
+        speculation, self._speculation = self._speculation, None
+        if speculation is not None and speculation.normalized_text == normalized and not speculation.failed:
+            logger.debug("Voice Turn: speculative reply adopted for %r", text)
+            metrics.counter("speech_speculation_total", outcome="adopted").inc()
+            speculation.adopted.set_result(text)
+            reply = speculation.buffered_deltas()
+        else:
+            if speculation is not None:
+                self._discard(speculation)
+                speculation = None
+            reply = self._stream_turn(text)
+
+        previous_turn = self._turn_task
+        self._turn_task = asyncio.create_task(self._speak_reply(reply, previous_turn, final_received, speculation))
+
+    async def cancel(self):
+        """Barge-in: drops the pending guess and stops the replies being generated or spoken; their turns roll back."""
+        self._cancel_stability_timer()
+        self._last_partial = None
+        self._discard_speculation()
+        if self._turn_task is not None:
+            # Cancelling the latest reply also cancels the earlier ones it is queued behind
+            self._turn_task.cancel()
+            self._turn_task = None
+        await self._send_event({"type": "cancelled"})
+
+    def close(self):
+        """Called when the socket closes; abandons pending work (turns in progress roll their history back)."""
+        self._cancel_stability_timer()
+        self._discard_speculation()
+        if self._turn_task is not None:
+            self._turn_task.cancel()
+
+    async def _speculate_when_stable(self, text):
+        await asyncio.sleep(self.stable_seconds)
+        self._stability_timer = None
+        if self._speculation is None:
+            logger.debug("Voice Turn: starting speculative turn on stable partial %r", text)
+            speculation = SpeculativeTurn(text)
+            speculation.task = asyncio.create_task(self._run_speculation(speculation))
+            self._speculation = speculation
+
+    async def _run_speculation(self, speculation):
+        try:
+            async for text_delta in self._stream_speculative_turn(speculation.text, speculation.adopted):
+                speculation.deltas.put_nowait(text_delta)
+        except CapacityExceeded:
+            speculation.failed = True # Not worth a 429 to the user; the final transcript will be answered normally
+        finally:
+            speculation.deltas.put_nowait(None)
+
+    def _cancel_stability_timer(self):
+        if self._stability_timer is not None:
+            self._stability_timer.cancel()
+            self._stability_timer = None
+
+    def _discard_speculation(self):
+        speculation, self._speculation = self._speculation, None
+        if speculation is not None:
+            self._discard(speculation)
+
+    def _discard(self, speculation):
+        logger.debug("Voice Turn: discarding speculative turn for %r", speculation.text)
+        metrics.counter("speech_speculation_total", outcome="discarded").inc()
+        speculation.task.cancel()
+
+    async def _speak_reply(self, reply, previous_turn, final_received, adopted_speculation=None):
+        if previous_turn is not None:
+            await asyncio.gather(previous_turn, return_exceptions=True)
+
+        sentences = asyncio.Queue()
+        speaker = asyncio.create_task(self._speak_sentences(sentences, final_received))
+        try:
+            unspoken = ""
+            async for text_delta in reply:
+                await self._send_event({"type": "delta", "text": text_delta})
+                complete, unspoken = split_complete_sentences(unspoken + text_delta)
+                for sentence in complete:
+                    sentences.put_nowait(sentence)
+            if unspoken.strip():
+                sentences.put_nowait(unspoken.strip())
+        except CapacityExceeded as e:
+            await self._send_event({"type": "error", "message": f"{e.reason}. Please retry shortly."})
+        except TurnCancelled:
+            # Cancelled through POST /chat/cancel rather than over this socket
+            speaker.cancel()
+            await self._send_event({"type": "cancelled"})
+            return
+        except asyncio.CancelledError:
+            speaker.cancel()
+            if adopted_speculation is not None:
+                # Stops the adopted guess before it commits its history to the session, if it hasn't yet
+                adopted_speculation.task.cancel()
+            raise
+        finally:
+            sentences.put_nowait(None)
+        await speaker
+        await self._send_event({"type": "done"})
+
+    async def _speak_sentences(self, sentences, final_received):
+        # Synthesis of one sentence overlaps with generation of the next, and audio goes out in reply order
+        index = 0
+        while True:
+            sentence = await sentences.get()
+            if sentence is None:
+                return
+            audio = await self._synthesizer.synthesize(sentence)
+            if index == 0:
+                metrics.observe_stage("speech_first_sentence", time.perf_counter() - final_received)
+            await self._send_event({"type": "sentence", "index": index, "text": sentence,
+                                    "audio": self._synthesizer.content_type if audio else None})
+            if audio:
+                await self._send_audio(audio)
+            index += 1
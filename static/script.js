@@ -11,11 +11,17 @@ document.addEventListener('DOMContentLoaded', () => {
     let isListening = false;
     let isSpeaking = false;
     let recognition = null; // Variable to hold the SpeechRecognition instance
+    let partialSent = false; // Partial transcripts were sent for the current utterance, but no final one yet
     let synth = null; // Variable to hold the SpeechSynthesis instance
 
     // Flag to remember if the voice button was explicitly disabled due to a non-recoverable error like permissions
     let isVoiceButtonPermanentlyDisabled = false;
 
+    // Session id that ties this tab to its own conversation history on the backend.
+    // Kept in sessionStorage so a page reload continues the same conversation, while other tabs get their own.
+    const SESSION_STORAGE_KEY = 'chatSessionId';
+    let sessionId = sessionStorage.getItem(SESSION_STORAGE_KEY);
+
     console.log("DOM fully loaded. Initializing chatbot.");
 
     // --- Helper Function to Update Button States ---
@@ -89,15 +95,16 @@ document.addEventListener('DOMContentLoaded', () => {
             voiceButton.ariaLabel = "Voice input disabled"; // Update for accessibility
             voiceButton.title = "Voice input disabled"; // Update tooltip
         } else {
-            voiceButton.disabled = shouldBeDisabled;
+            // Stays enabled while the bot is speaking, so the user can interrupt it (barge-in)
+            voiceButton.disabled = isListening;
             if (isListening) {
                 voiceButton.classList.add('listening'); // Adds pulse effect via CSS
                 voiceButton.ariaLabel = "Stop Speaking";
                 voiceButton.title = "Stop Speaking";
             } else {
                 voiceButton.classList.remove('listening'); // Removes pulse effect
-                voiceButton.ariaLabel = "Start Speaking";
-                voiceButton.title = "Start Speaking";
+                voiceButton.ariaLabel = isSpeaking ? "Interrupt and Start Speaking" : "Start Speaking";
+                voiceButton.title = voiceButton.ariaLabel;
             }
         }
 
@@ -131,7 +138,7 @@ document.addEventListener('DOMContentLoaded', () => {
             recognition = new SpeechRecognition();
             recognition.continuous = false; // Stop listening after a single phrase
             recognition.lang = 'en-US'; // Set language (adjust as needed)
-            recognition.interimResults = false; // Only return final results
+            recognition.interimResults = true; // Interim results are streamed to the voice WebSocket while the user speaks
             recognition.maxAlternatives = 1; // Get only the most likely result
             console.log("SpeechRecognition initialized.");
 
@@ -154,10 +161,24 @@ document.addEventListener('DOMContentLoaded', () => {
                 console.log('--- Event: Voice recognition result. ---');
                 // recognition.onend will handle resetting isListening state and button state
 
-                const transcript = event.results[0][0].transcript;
+                // With interim results on, this fires repeatedly while the user speaks and once more with the final result
+                const result = event.results[event.results.length - 1];
+                const transcript = result[0].transcript;
+
+                if (!result.isFinal) {
+                    // Lets the backend start on the reply before the user has finished speaking (no-op without a socket)
+                    sendVoiceEvent({ type: 'partial', text: transcript });
+                    partialSent = true;
+                    return;
+                }
+                partialSent = false;
                 console.log(`Recognized: "${transcript}"`);
 
-                sendMessage(transcript, 'voice'); // Send transcribed text
+                if (voiceSocket && voiceSocket.readyState === WebSocket.OPEN) {
+                    startVoiceReply(transcript); // Reply streams back over the voice WebSocket
+                } else {
+                    sendMessage(transcript, 'voice'); // Send transcribed text
+                }
             };
 
             recognition.onerror = (event) => {
@@ -201,6 +222,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 isListening = false;
                 updateButtonStatesRevised(); // Update buttons to reflect no longer listening
 
+                if (partialSent) {
+                    // Ended (stopped, no-speech, error) without a final result: drop the guess started on the partials
+                    partialSent = false;
+                    sendVoiceEvent({ type: 'cancel' });
+                }
+
                  // isVoiceButtonPermanentlyDisabled is handled within updateButtonStatesRevised.
             };
 
@@ -259,53 +286,269 @@ document.addEventListener('DOMContentLoaded', () => {
         chatBox.appendChild(messageContainer); // Append container to chat box
 
         chatBox.scrollTop = chatBox.scrollHeight; // Auto-scroll
+
+        return messageBubble; // Returned so streamed replies can keep appending to the same bubble
     }
 
 
-    // --- Function to speak the bot's text response ---
-    function speakResponse(text) {
-        // Check availability and permanent disability before speaking
-        if (!synth || !SpeechSynthesisUtterance || !text || text.trim() === '' || isVoiceButtonPermanentlyDisabled) {
-            console.warn("speakResponse called but TTS unavailable/empty/disabled.");
-            // Add non-empty text to chat even if not speaking
-            if (text && text.trim() !== '') addMessage(text, 'bot');
-            // Ensure state is updated as speaking is skipped
-            isSpeaking = false; // Must be false if we skip speaking
-            updateButtonStatesRevised(); // Re-enable buttons as speech isn't happening
-            return;
+    // --- Helper function to add an "AI is thinking..." indicator ---
+    function addTypingIndicator() {
+        const typingIndicatorContainer = document.createElement('div'); // Container
+        typingIndicatorContainer.classList.add('message', 'bot-message'); // Match message structure
+        const typingIndicatorBubble = document.createElement('div'); // Bubble
+        typingIndicatorBubble.classList.add('message-bubble', 'typing'); // Add typing class
+        typingIndicatorBubble.textContent = 'AI is thinking...';
+        typingIndicatorContainer.appendChild(typingIndicatorBubble);
+        chatBox.appendChild(typingIndicatorContainer); // Add container to chat box
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+
+    // --- Helper function to remove the most recent "AI is thinking..." indicator ---
+    function removeTypingIndicator() {
+        // Need to find the latest one (could be multiple if user spammed before response)
+        const indicators = chatBox.querySelectorAll('.message.bot-message .message-bubble.typing');
+        if (indicators.length > 0) {
+            // Remove the last one found (most recent)
+            const lastIndicatorContainer = indicators[indicators.length - 1].closest('.message');
+            if (lastIndicatorContainer && chatBox.contains(lastIndicatorContainer)) {
+                chatBox.removeChild(lastIndicatorContainer);
+            }
+        }
+    }
+
+
+    // --- Sentence-by-sentence speech for streamed replies ---
+
+    // Number of utterances queued with speechSynthesis that haven't finished yet
+    let pendingUtterances = 0;
+    // Bumped when the user cancels speech, so sentences still arriving for that reply are not spoken
+    let speechGeneration = 0;
+
+    // Splits off every complete sentence (ending in . ! or ?, followed by whitespace) from the front of `text`.
+    // Returns the complete sentences and the trailing partial sentence still waiting for more text.
+    function splitCompleteSentences(text) {
+        const sentences = [];
+        const sentenceEnd = /[.!?]+["')\]]*\s+/g;
+        let start = 0;
+        let match;
+        while ((match = sentenceEnd.exec(text)) !== null) {
+            sentences.push(text.slice(start, match.index + match[0].length).trim());
+            start = match.index + match[0].length;
         }
+        return { sentences: sentences.filter(sentence => sentence !== ''), rest: text.slice(start) };
+    }
 
-        // Stop ongoing speech before starting new
-        synth.cancel(); // Should trigger onend/onerror for previous
+    // Queues one sentence for speech. speechSynthesis plays queued utterances in order, so the first
+    // sentence starts playing while later ones are still being generated by the backend.
+    function speakSentence(text) {
+        if (!synth || !SpeechSynthesisUtterance || isVoiceButtonPermanentlyDisabled || text.trim() === '') {
+            return;
+        }
 
-        const utterance = new SpeechSynthesisUtterance(text);
+        const utterance = new SpeechSynthesisUtterance(text.trim());
         utterance.lang = 'en-US';
+        utterance.onstart = () => {
+            if (!isSpeaking) {
+                console.log('--- Event: Bot started speaking. ---');
+                isSpeaking = true;
+                updateButtonStatesRevised();
+            }
+        };
+        const onUtteranceFinished = () => {
+            pendingUtterances = Math.max(0, pendingUtterances - 1);
+            if (pendingUtterances === 0 && isSpeaking) {
+                console.log('--- Event: Bot finished speaking queued sentences. ---');
+                isSpeaking = false;
+                updateButtonStatesRevised();
+            }
+        };
+        utterance.onend = onUtteranceFinished;
+        utterance.onerror = onUtteranceFinished; // Also fires with 'interrupted' when speech is cancelled
 
-        // Add text to chat box immediately
-        addMessage(text, 'bot');
+        pendingUtterances++;
+        synth.speak(utterance);
+        console.log(`Queued sentence for speech: "${text.trim()}"`);
+    }
 
-        // Start speech
-        synth.speak(utterance); // Triggers onstart
-        console.log(`Attempting to speak: "${text}"`);
 
-         // State handled by onstart, onend, onerror.
+    // --- Voice WebSocket (only available when served by asgi_app.py) ---
+    // Interim transcripts are streamed to /ws/voice so the backend can start on the reply before the user
+    // has finished speaking. The reply comes back as text deltas plus one `sentence` event per complete
+    // sentence, followed by its audio when the server synthesizes speech. If the socket can't be opened
+    // (e.g. the Flask server), voice input falls back to sendMessage and /chat/stream.
+    let voiceSocket = null;
+    let voiceSocketUnavailable = false;
+    let voiceReply = null; // { bubble, text, speechGeneration } for the reply streaming over the socket
+    let audioSentencesExpected = 0; // `sentence` events whose binary audio message hasn't arrived yet
+    const audioQueue = []; // Server-synthesized sentences waiting to be played, in order
+    let playingAudio = null;
+
+    function connectVoiceSocket() {
+        if (voiceSocketUnavailable || (voiceSocket && voiceSocket.readyState <= WebSocket.OPEN)) return;
+        const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+        const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : '';
+        const socket = new WebSocket(`${scheme}://${location.host}/ws/voice${query}`);
+        let opened = false;
+        socket.onopen = () => {
+            opened = true;
+            console.log('Voice WebSocket connected.');
+        };
+        socket.onerror = () => {
+            if (!opened) {
+                // No WebSocket route on this server; don't try again on every voice input
+                voiceSocketUnavailable = true;
+                console.log('Voice WebSocket unavailable, using /chat/stream for voice input.');
+            }
+        };
+        socket.onclose = () => {
+            if (voiceSocket === socket) voiceSocket = null;
+        };
+        socket.onmessage = (message) => handleVoiceSocketMessage(message.data);
+        voiceSocket = socket;
+    }
 
-         // **WORKAROUND:** Fallback timeout
-         const wordCount = text.split(/\s+/).filter(word => word.length > 0).length;
-         const estimatedDurationMs = Math.max(wordCount * 200, 2000); // Min 2s
+    function sendVoiceEvent(event) {
+        if (voiceSocket && voiceSocket.readyState === WebSocket.OPEN) {
+            voiceSocket.send(JSON.stringify(event));
+        }
+    }
 
-         console.log(`Setting fallback timeout check for speaking state in ~${estimatedDurationMs}ms.`);
+    function startVoiceReply(transcript) {
+        if (transcript.trim() === '') return;
+        addMessage(transcript, 'user');
+        addTypingIndicator();
+        // Stop anything still being spoken from a previous reply before the new one starts
+        if (synth) synth.cancel();
+        stopAudioPlayback();
+        voiceReply = { bubble: null, text: '', speechGeneration: speechGeneration };
+        sendVoiceEvent({ type: 'final', text: transcript });
+    }
 
-         setTimeout(() => {
-             // Check if we are *still* marked speaking AND browser API thinks it's speaking AND NOT listening
-             if (isSpeaking && synth.speaking && !isListening) {
-                  console.warn("Fallback Timeout: Synth seems stuck. Forcing state reset and buttons re-enable.");
-                  isSpeaking = false;
-                  updateButtonStatesRevised(); // Use revised update
-             } else {
-                 // console.log("Fallback Timeout check passed or state already correct.");
-             }
-         }, estimatedDurationMs + 1000); // Buffer
+    function handleVoiceSocketMessage(data) {
+        if (data instanceof Blob) {
+            // Audio for the `sentence` event just before it
+            if (audioSentencesExpected > 0) {
+                audioSentencesExpected--;
+                if (voiceReply && voiceReply.speechGeneration === speechGeneration) queueAudio(data);
+            }
+            return;
+        }
+
+        const event = JSON.parse(data);
+        if (event.type === 'session') {
+            if (typeof event.session_id === 'string' && event.session_id !== sessionId) {
+                sessionId = event.session_id;
+                sessionStorage.setItem(SESSION_STORAGE_KEY, sessionId);
+            }
+        } else if (event.type === 'delta' && voiceReply && typeof event.text === 'string') {
+            if (!voiceReply.bubble) {
+                removeTypingIndicator();
+                voiceReply.bubble = addMessage('', 'bot');
+            }
+            voiceReply.text += event.text;
+            voiceReply.bubble.textContent = voiceReply.text;
+            chatBox.scrollTop = chatBox.scrollHeight;
+        } else if (event.type === 'sentence') {
+            if (event.audio) {
+                audioSentencesExpected++;
+            } else if (voiceReply && voiceReply.speechGeneration === speechGeneration) {
+                speakSentence(event.text); // The server has no TTS engine; speak it here
+            }
+        } else if (event.type === 'done') {
+            if (voiceReply && voiceReply.text.trim() === '') {
+                removeTypingIndicator();
+                addMessage("AI provided an empty response.", 'bot');
+            }
+            voiceReply = null;
+        } else if (event.type === 'error') {
+            console.error('Voice WebSocket error:', event.message);
+            removeTypingIndicator();
+            addMessage(`Sorry, an error occurred: ${event.message}`, 'bot');
+        }
+    }
+
+    function queueAudio(blob) {
+        audioQueue.push(blob);
+        if (!playingAudio) playNextAudio();
+    }
+
+    function playNextAudio() {
+        const blob = audioQueue.shift();
+        if (!blob) {
+            playingAudio = null;
+            if (isSpeaking && pendingUtterances === 0) {
+                isSpeaking = false;
+                updateButtonStatesRevised();
+            }
+            return;
+        }
+        const url = URL.createObjectURL(blob);
+        const audio = new Audio(url);
+        const onAudioFinished = () => {
+            URL.revokeObjectURL(url);
+            if (playingAudio === audio) playNextAudio();
+        };
+        audio.onended = onAudioFinished;
+        audio.onerror = onAudioFinished;
+        playingAudio = audio;
+        if (!isSpeaking) {
+            isSpeaking = true;
+            updateButtonStatesRevised();
+        }
+        audio.play().catch(onAudioFinished);
+    }
+
+    function stopAudioPlayback() {
+        audioQueue.length = 0;
+        if (playingAudio) {
+            playingAudio.pause();
+            playingAudio = null;
+            if (isSpeaking && pendingUtterances === 0) {
+                isSpeaking = false;
+                updateButtonStatesRevised();
+            }
+        }
+    }
+
+
+    // --- Barge-in: stop the reply being spoken and cancel the work behind it on the server ---
+
+    // AbortController of the /chat/stream request currently streaming a reply, if any
+    let activeRequest = null;
+
+    function cancelActiveReply() {
+        speechGeneration++; // Don't speak sentences of the cancelled reply that are still streaming in
+        pendingUtterances = 0;
+        if (synth) synth.cancel();
+        stopAudioPlayback();
+        if (isSpeaking) {
+            isSpeaking = false;
+            updateButtonStatesRevised();
+        }
+
+        const replyInProgress = activeRequest !== null || voiceReply !== null;
+        if (activeRequest) {
+            activeRequest.abort(); // Closing the stream abandons the turn on the server too
+            activeRequest = null;
+        }
+        if (voiceReply) {
+            voiceReply = null;
+            sendVoiceEvent({ type: 'cancel' });
+        }
+        if (replyInProgress) {
+            removeTypingIndicator();
+            // The server only notices a closed stream when it next writes to it; this stops the
+            // model call and tools right away and rolls the conversation back to before the question
+            if (sessionId) {
+                fetch('/chat/cancel', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ session_id: sessionId }),
+                    keepalive: true
+                }).catch(error => console.warn('Cancel request failed:', error));
+            }
+        }
     }
 
 
@@ -331,29 +574,31 @@ document.addEventListener('DOMContentLoaded', () => {
         console.log(`Processing message to send to backend (Source: ${source}): "${message}"`);
 
         // Disable input and buttons via state update - Speaking state takes precedence
-        // UI becomes disabled by updateButtonStatesRevised when isSpeaking becomes true via speakResponse later
+        // UI becomes disabled by updateButtonStatesRevised when isSpeaking becomes true via speakSentence later
         // or implicitly when isListening is true.
         // No need to manually disable here unless we *must* guarantee immediate visual change before fetch.
         // For now, rely on state changes (listening/speaking) to disable buttons.
 
 
         // Add thinking indicator
-        const typingIndicatorContainer = document.createElement('div'); // Container
-        typingIndicatorContainer.classList.add('message', 'bot-message'); // Match message structure
-        const typingIndicatorBubble = document.createElement('div'); // Bubble
-        typingIndicatorBubble.classList.add('message-bubble', 'typing'); // Add typing class
-        typingIndicatorBubble.textContent = 'AI is thinking...';
-        typingIndicatorContainer.appendChild(typingIndicatorBubble);
-        chatBox.appendChild(typingIndicatorContainer); // Add container to chat box
-        chatBox.scrollTop = chatBox.scrollHeight;
+        addTypingIndicator();
 
 
+        // Bubble that streamed text is appended to; created when the first delta arrives
+        let botBubble = null;
+        let fullText = '';
+        let unspokenText = ''; // Text received but not yet handed to speech synthesis
+        const speechGenerationAtStart = speechGeneration;
+        const requestController = new AbortController();
+        activeRequest = requestController;
+
         try {
-            console.log(`Fetching response from backend endpoint: /chat`);
-            const response = await fetch('/chat', {
+            console.log(`Fetching streamed response from backend endpoint: /chat/stream`);
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ message: message })
+                body: JSON.stringify({ message: message, session_id: sessionId }),
+                signal: requestController.signal
             });
             console.log(`Received HTTP response status from backend: ${response.status}`);
 
@@ -362,47 +607,79 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(`HTTP error! status: ${response.status}, body: ${errorText}`);
             }
 
-            const data = await response.json();
-            console.log("Received response data from backend:", data);
-
-            // Remove thinking indicator
-            // Need to find the latest one (could be multiple if user spammed before response)
-            const indicators = chatBox.querySelectorAll('.message.bot-message .message-bubble.typing');
-             if (indicators.length > 0) {
-                 // Remove the last one found (most recent)
-                 const lastIndicatorContainer = indicators[indicators.length - 1].closest('.message');
-                 if(lastIndicatorContainer && chatBox.contains(lastIndicatorContainer)) {
-                      chatBox.removeChild(lastIndicatorContainer);
-                 }
-             }
+            // Stop anything still being spoken from a previous reply before the new one starts
+            if (synth) synth.cancel();
+
+            // Read Server-Sent Events off the body as they arrive. Events are separated by a blank line.
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let sseBuffer = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                sseBuffer += decoder.decode(value, { stream: true });
+
+                let eventEnd;
+                while ((eventEnd = sseBuffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = sseBuffer.slice(0, eventEnd);
+                    sseBuffer = sseBuffer.slice(eventEnd + 2);
+
+                    const dataLine = rawEvent.split('\n').find(line => line.startsWith('data: '));
+                    if (!dataLine) continue;
+                    const event = JSON.parse(dataLine.slice('data: '.length));
+
+                    if (event.type === 'session') {
+                        // The backend assigns a session id on the first message; remember it for the rest of the conversation
+                        if (typeof event.session_id === 'string' && event.session_id !== sessionId) {
+                            sessionId = event.session_id;
+                            sessionStorage.setItem(SESSION_STORAGE_KEY, sessionId);
+                        }
+                    } else if (event.type === 'delta' && typeof event.text === 'string') {
+                        if (!botBubble) {
+                            // First text of the reply: swap the thinking indicator for a real message bubble
+                            removeTypingIndicator();
+                            botBubble = addMessage('', 'bot');
+                        }
+                        fullText += event.text;
+                        botBubble.textContent = fullText;
+                        chatBox.scrollTop = chatBox.scrollHeight;
+
+                        // Speak each sentence as soon as it is complete, rather than waiting for the whole reply
+                        unspokenText += event.text;
+                        const { sentences, rest } = splitCompleteSentences(unspokenText);
+                        unspokenText = rest;
+                        if (speechGeneration === speechGenerationAtStart) sentences.forEach(speakSentence);
+                    }
+                }
+            }
 
+            // Speak whatever is left after the last sentence boundary
+            if (unspokenText.trim() !== '' && speechGeneration === speechGenerationAtStart) {
+                speakSentence(unspokenText);
+            }
 
-            // Process the response text
-            if (data && typeof data.response === 'string' && data.response.trim() !== '') {
-                 // speakResponse handles adding text to chat & updates state/buttons
-                 speakResponse(data.response);
-            } else {
-                 console.error("Backend response missing/invalid 'response' text:", data);
-                 const errorMessage = (data && typeof data.response === 'string') ? "AI provided an empty response." : "Received an unexpected AI response structure.";
-                 addMessage(errorMessage, 'bot'); // Add error message text
-
-                 // No text to speak, manually update state and buttons
-                 isSpeaking = false; // Ensure state is false
-                 updateButtonStatesRevised(); // Re-enable buttons
-                 console.log("Backend response empty/invalid, manually re-enabled buttons.");
+            if (fullText.trim() === '') {
+                removeTypingIndicator();
+                console.error("Backend stream ended without any response text.");
+                addMessage("AI provided an empty response.", 'bot');
+
+                // No text to speak, manually update state and buttons
+                isSpeaking = false; // Ensure state is false
+                updateButtonStatesRevised(); // Re-enable buttons
+                console.log("Backend response empty, manually re-enabled buttons.");
             }
 
         } catch (error) {
+            if (error.name === 'AbortError') {
+                // Cancelled by the user (barge-in); cancelActiveReply has already cleaned up
+                console.log('Reply request aborted.');
+                return;
+            }
             console.error('Error during sendMessage fetch/processing:', error);
 
-             // Remove thinking indicator on error
-             const indicators = chatBox.querySelectorAll('.message.bot-message .message-bubble.typing');
-              if (indicators.length > 0) {
-                  const lastIndicatorContainer = indicators[indicators.length - 1].closest('.message');
-                  if(lastIndicatorContainer && chatBox.contains(lastIndicatorContainer)) {
-                       chatBox.removeChild(lastIndicatorContainer);
-                  }
-              }
+            // Remove thinking indicator on error
+            removeTypingIndicator();
 
             // Manually update state and buttons on error
             const errorMessage = `Sorry, an error occurred: ${error.message}`;
@@ -410,6 +687,8 @@ document.addEventListener('DOMContentLoaded', () => {
             isSpeaking = false; // Ensure state is false
             updateButtonStatesRevised(); // Re-enable buttons
             console.log("Fetch/Processing error, manually re-enabled buttons.");
+        } finally {
+            if (activeRequest === requestController) activeRequest = null;
         }
         // Button states are managed by state updates within event handlers and catch blocks calling updateButtonStatesRevised().
     }
@@ -453,24 +732,24 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // --- Handle cases when a process is ALREADY active ---
 
-        // If speaking, cancel speech. User will need to click again after it cancels and buttons re-enable.
-        if (isSpeaking) {
-             console.log("Bot is speaking, cancelling speech. Click again to start listening.");
-             synth.cancel(); // Should trigger synth.onend/onerror
-             // State update and re-enable happens via event handler.
-             return; // Exit handler
-
         // If listening, stop recognition. Recognition.onend will handle state.
-        } else if (isListening) {
+        if (isListening) {
             console.log("Stopping voice recognition due to button click.");
             recognition.stop(); // Triggers recognition.onend
              // State update and re-enable happens via recognition.onend.
             return; // Exit handler
         }
 
-        // --- If not listening or speaking (and not permanently disabled) ---
+        // Barge-in: if the bot is speaking or still working on a reply, stop it (server-side too) and listen right away
+        if (isSpeaking || activeRequest || voiceReply) {
+            console.log("Interrupting the current reply to start listening.");
+            cancelActiveReply();
+        }
+
+        // --- If not listening (and not permanently disabled) ---
         // Attempt to start voice recognition
         console.log("Attempting to start voice recognition.");
+        connectVoiceSocket(); // Opens (or keeps) the voice WebSocket, if the server has one
         try {
            // Start recognition. This triggers recognition.onstart if successful.
            // The recognition.onstart handler will update states and disable buttons.
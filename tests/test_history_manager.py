@@ -0,0 +1,93 @@
+import pytest
+
+from bench.fake_gemini import FakeGenerativeModel
+from history_manager import HistoryCompactor, estimate_tokens
+from session_manager import ChatSessionEntry
+
+
+def tool_turn(number, result_chars=2000):
+    return [
+        {"role": "user", "parts": [{"text": f"question {number}"}]},
+        {"role": "model", "parts": [{"function_call": {"name": "search_tool", "args": {"query": f"query {number}"}}}]},
+        {"role": "user", "parts": [{"function_response": {"name": "search_tool", "response": {
+            "result": "r" * result_chars, "passages": ["p" * result_chars]}}}]},
+        {"role": "model", "parts": [{"text": f"answer {number}"}]},
+    ]
+
+
+def plain_turn(number):
+    return [
+        {"role": "user", "parts": [{"text": f"question {number}"}]},
+        {"role": "model", "parts": [{"text": f"answer {number}"}]},
+    ]
+
+
+@pytest.fixture
+def entry():
+    return ChatSessionEntry("session", FakeGenerativeModel().start_chat(history=[]))
+
+
+@pytest.fixture
+def collapsed_turns(monkeypatch):
+    calls = []
+    original = HistoryCompactor._collapse_turn
+
+    def counting_collapse(self, turn):
+        calls.append(turn)
+        return original(self, turn)
+
+    monkeypatch.setattr(HistoryCompactor, "_collapse_turn", counting_collapse)
+    return calls
+
+
+def complete_turn(compactor, entry, turn):
+    """Appends a finished turn, compacts, and returns whether the compactor rewrote the history."""
+    entry.chat.history = list(entry.chat.history) + turn
+    history = entry.chat.history
+    compactor.compact(entry)
+    return entry.chat.history is not history
+
+
+def test_each_turn_collapses_only_the_turn_leaving_the_recent_window(entry, collapsed_turns):
+    compactor = HistoryCompactor(keep_recent_turns=2, token_budget=10**9)
+    collapses_per_turn = []
+    for number in range(12):
+        before = len(collapsed_turns)
+        complete_turn(compactor, entry, tool_turn(number))
+        collapses_per_turn.append(len(collapsed_turns) - before)
+    assert collapses_per_turn == [0, 0] + [1] * 10
+
+
+def test_steady_state_turn_does_not_collapse_or_rewrite(entry, collapsed_turns):
+    compactor = HistoryCompactor(keep_recent_turns=2, token_budget=10**9)
+    for number in range(6):
+        complete_turn(compactor, entry, tool_turn(number))
+    for number in range(6, 9):
+        # Plain turns push the last tool turns out of the window; each of those is collapsed once
+        complete_turn(compactor, entry, plain_turn(number))
+    collapsed_before = len(collapsed_turns)
+    for number in range(9, 15):
+        assert not complete_turn(compactor, entry, plain_turn(number))
+    assert len(collapsed_turns) == collapsed_before
+
+
+def test_collapsed_turn_keeps_call_and_shortened_result(entry):
+    compactor = HistoryCompactor(keep_recent_turns=1, token_budget=10**9, max_summary_chars=50)
+    complete_turn(compactor, entry, tool_turn(0))
+    complete_turn(compactor, entry, plain_turn(1))
+
+    call, result, reply = entry.chat.history[1:4]
+    assert call.parts[0].function_call.name == "search_tool"
+    assert result.parts[0].function_response.response == {"result": "r" * 47 + "..."}
+    assert reply.parts[0].text == "answer 0"
+    assert entry.history_token_counts == [estimate_tokens(content) for content in entry.chat.history]
+
+
+def test_budget_is_enforced_with_fewer_turns_than_the_recent_window(entry):
+    compactor = HistoryCompactor(keep_recent_turns=6, token_budget=500)
+    complete_turn(compactor, entry, tool_turn(0, result_chars=4000))
+    complete_turn(compactor, entry, tool_turn(1, result_chars=4000))
+
+    history = entry.chat.history
+    assert [content.parts[0].text for content in history if content.parts[0].text] == ["question 1", "answer 1"]
+    assert history[2].parts[0].function_response.response["result"] == "r" * 4000 # The latest turn is kept as is
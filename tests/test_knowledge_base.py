@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+import knowledge_base as knowledge_base_module
+from knowledge_base import KnowledgeBase, np, tokenize
+
+PASSAGES = [
+    {"title": "weather in london", "text": "It's currently cloudy with a chance of rain in London."},
+    {"title": "capital of france", "text": "The capital of France is Paris."},
+    {"title": "capital of india", "text": "The capital of India is New Delhi."},
+    {"title": "current date", "text": "The current date is May 2, 2025."},
+]
+EMBEDDING_DIMENSIONS = [0, 64] if np is not None else [0]
+
+
+@pytest.fixture(params=EMBEDDING_DIMENSIONS)
+def knowledge_base(request):
+    knowledge_base = KnowledgeBase(embedding_dimensions=request.param)
+    knowledge_base.add(PASSAGES)
+    return knowledge_base
+
+
+@pytest.mark.parametrize("query", ["weather in paris", "capital of germany", "president of france"])
+def test_passages_covering_too_little_of_the_query_are_not_returned(knowledge_base, query):
+    assert knowledge_base.search(query) == []
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("What's the weather in London?", "It's currently cloudy with a chance of rain in London."),
+    ("what is the capital of france", "The capital of France is Paris."),
+])
+def test_matching_passage_is_returned_first(knowledge_base, query, expected):
+    assert knowledge_base.search(query)[0]["text"] == expected
+
+
+def test_tokenize_drops_stopwords():
+    assert tokenize("What is the capital of France?") == ["capital", "france"]
+
+
+# --- On-disk index ---
+
+def segment_names(path):
+    return sorted(name for name in os.listdir(path) if name.startswith("segment-"))
+
+
+def texts(results):
+    return [result["text"] for result in results]
+
+
+def test_flushed_segments_are_memory_mapped_on_reopen(tmp_path):
+    knowledge_base = KnowledgeBase(str(tmp_path), flush_threshold=2)
+    knowledge_base.add(PASSAGES[:2])
+    knowledge_base.add(PASSAGES[2:])
+    assert segment_names(tmp_path) == ["segment-000001", "segment-000002"]
+
+    reopened = KnowledgeBase(str(tmp_path))
+    assert len(reopened) == len(PASSAGES)
+    assert texts(reopened.search("capital of india")) == ["The capital of India is New Delhi."]
+
+
+def test_incremental_add_writes_a_new_segment(tmp_path):
+    first = KnowledgeBase(str(tmp_path))
+    first.add(PASSAGES)
+    first.flush()
+    existing = segment_names(tmp_path)
+
+    knowledge_base = KnowledgeBase(str(tmp_path))
+    knowledge_base.add([{"id": "zebra", "text": "Zebras are striped."}])
+    assert texts(knowledge_base.search("zebras")) == ["Zebras are striped."] # Searchable before the flush
+    knowledge_base.flush()
+    assert segment_names(tmp_path) == existing + ["segment-000002"]
+    reopened = KnowledgeBase(str(tmp_path))
+    assert len(reopened) == len(PASSAGES) + 1
+    assert reopened.search("zebras")[0]["id"] == "zebra"
+
+
+def test_compact_merges_segments(tmp_path):
+    knowledge_base = KnowledgeBase(str(tmp_path), flush_threshold=1)
+    for passage in PASSAGES:
+        knowledge_base.add([passage])
+    before = [texts(knowledge_base.search(passage["title"])) for passage in PASSAGES]
+
+    knowledge_base.compact()
+    assert segment_names(tmp_path) == ["segment-000005"]
+    reopened = KnowledgeBase(str(tmp_path))
+    assert len(reopened) == len(PASSAGES)
+    assert [texts(reopened.search(passage["title"])) for passage in PASSAGES] == before
+
+
+@pytest.mark.skipif(np is None, reason="NumPy is not installed")
+def test_pure_python_scoring_matches_numpy(tmp_path, monkeypatch):
+    knowledge_base = KnowledgeBase(str(tmp_path), embedding_dimensions=64)
+    knowledge_base.add(PASSAGES)
+    knowledge_base.flush()
+    queries = [passage["title"] for passage in PASSAGES] + ["weather in paris"]
+    expected = [knowledge_base.search(query) for query in queries]
+
+    # An index built with embeddings is still searched (BM25 only) and extended without NumPy
+    monkeypatch.setattr(knowledge_base_module, "np", None)
+    without_numpy = KnowledgeBase(str(tmp_path))
+    assert without_numpy.embedding_dimensions == 0
+    assert [texts(without_numpy.search(query)) for query in queries] == [texts(results) for results in expected]
+    without_numpy.add([{"text": "Zebras are striped."}])
+    without_numpy.flush()
+    assert texts(without_numpy.search("zebras")) == ["Zebras are striped."]
+
+    monkeypatch.setattr(knowledge_base_module, "np", np)
+    assert KnowledgeBase(str(tmp_path)).embedding_dimensions == 64 # The manifest keeps the index's setting
+
+
+@pytest.mark.skipif(np is None, reason="NumPy is not installed")
+def test_unflushed_embeddings_grow_in_place():
+    knowledge_base = KnowledgeBase(embedding_dimensions=64)
+    passages = [{"id": str(number), "text": f"passage number {number} about topic{number}"} for number in range(200)]
+    knowledge_base.add(passages)
+    assert knowledge_base._memory.embedding_matrix().shape == (200, 64)
+    assert knowledge_base.search("topic150")[0]["id"] == "150"
@@ -0,0 +1,34 @@
+import pytest
+
+from response_cache import ResponseCache, content_words, normalize_message
+
+# Questions that look alike to the hashed embedding but ask for something else
+DIFFERENT_QUESTIONS = [
+    ("What will the weather be like in London this weekend?", "What will the weather be like in Madrid this weekend?"),
+    ("Who won the world cup final in 2018?", "Who won the world cup final in 2014?"),
+    ("How does a car engine work?", "How does a jet engine work?"),
+]
+
+
+@pytest.mark.parametrize("cached_question, other_question", DIFFERENT_QUESTIONS)
+def test_different_content_words_miss(cached_question, other_question):
+    cache = ResponseCache()
+    cache.store(cached_question, "cached answer")
+    assert cache.lookup(other_question) is None
+
+
+@pytest.mark.parametrize("cached_question, other_question", DIFFERENT_QUESTIONS)
+def test_different_content_words_miss_with_low_threshold(cached_question, other_question):
+    cache = ResponseCache(similarity_threshold=0.5)
+    cache.store(cached_question, "cached answer")
+    assert cache.lookup(other_question) is None
+
+
+def test_repeat_with_different_case_and_punctuation_hits():
+    cache = ResponseCache()
+    cache.store("What is the capital of France?", "Paris.")
+    assert cache.lookup("what is the capital of france") == "Paris."
+
+
+def test_content_words_drop_stopwords():
+    assert content_words(normalize_message("What's the weather in London?")) == {"what", "weather", "london"}
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+
+import pytest
+
+from bench.fake_gemini import FakeGenerativeModel
+from upstream import TokenBucket, UpstreamDispatcher
+
+
+def reply_text(history):
+    return "".join(part.text for part in history[-1].parts if part.text)
+
+
+def coalescing_dispatcher(**model_options):
+    model = FakeGenerativeModel(first_chunk_latency="fixed:0.1", chunk_interval="fixed:0.01", **model_options)
+    return model, UpstreamDispatcher(model, coalesce=True)
+
+
+# --- Coalescing, threaded callers ---
+
+def test_identical_streamed_requests_make_one_call():
+    model, dispatcher = coalescing_dispatcher()
+    chats = [dispatcher.start_chat(history=[]) for _ in range(4)]
+    ready = threading.Barrier(len(chats))
+    replies = {}
+
+    def ask(index):
+        ready.wait()
+        replies[index] = "".join(chunk.text for chunk in chats[index].send_message("same question", stream=True))
+
+    threads = [threading.Thread(target=ask, args=(index,)) for index in range(len(chats))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert model.calls == 1
+    assert set(replies.values()) == {"Simulated answer to 'same question'."}
+    for chat in chats:
+        assert [content.role for content in chat.history] == ["user", "model"]
+    assert dispatcher.stats() == {"coalescing": 0}
+
+
+def test_history_is_appended_only_after_the_whole_reply_is_read():
+    model, dispatcher = coalescing_dispatcher()
+    leader, follower = dispatcher.start_chat(history=[]), dispatcher.start_chat(history=[])
+    leader_chunks = leader.send_message("same question", stream=True)
+    follower_chunks = follower.send_message("same question", stream=True)
+
+    next(leader_chunks)
+    next(follower_chunks)
+    assert leader.history == [] and follower.history == []
+
+    leader_chunks.close() # Abandoned part-way, e.g. on barge-in
+    list(follower_chunks)
+    assert leader.history == []
+    assert reply_text(follower.history) == "Simulated answer to 'same question'."
+    assert model.calls == 1
+
+
+# --- Coalescing, asyncio callers ---
+
+def test_identical_async_requests_make_one_call():
+    model, dispatcher = coalescing_dispatcher()
+    chats = [dispatcher.start_chat(history=[]) for _ in range(3)]
+
+    async def ask(chat):
+        return "".join([chunk.text async for chunk in await chat.send_message_async("same question", stream=True)])
+
+    async def main():
+        return await asyncio.gather(*(ask(chat) for chat in chats))
+
+    assert set(asyncio.run(main())) == {"Simulated answer to 'same question'."}
+    assert model.calls == 1
+    assert all(len(chat.history) == 2 for chat in chats)
+
+
+def test_cancelled_async_leader_keeps_its_history_unchanged():
+    model, dispatcher = coalescing_dispatcher()
+    leader, follower = dispatcher.start_chat(history=[]), dispatcher.start_chat(history=[])
+
+    async def ask(chat):
+        return [chunk.text async for chunk in await chat.send_message_async("same question", stream=True)]
+
+    async def main():
+        leading = asyncio.ensure_future(ask(leader))
+        following = asyncio.ensure_future(ask(follower))
+        await asyncio.sleep(0.05)
+        leading.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leading
+        return await following
+
+    assert "".join(asyncio.run(main())) == "Simulated answer to 'same question'."
+    assert leader.history == []
+    assert len(follower.history) == 2
+    assert model.calls == 1
+
+
+def test_non_streamed_identical_requests_make_one_call():
+    model, dispatcher = coalescing_dispatcher()
+    chats = [dispatcher.start_chat(history=[]) for _ in range(3)]
+
+    async def main():
+        return await asyncio.gather(*(chat.send_message_async("same question") for chat in chats))
+
+    assert {response.text for response in asyncio.run(main())} == {"Simulated answer to 'same question'."}
+    assert model.calls == 1
+    assert all(len(chat.history) == 2 for chat in chats)
+
+
+# --- Quota errors ---
+
+def test_rate_limited_call_is_retried():
+    model = FakeGenerativeModel(first_chunk_latency="fixed:0", quota_rps=10, quota_burst=1)
+    dispatcher = UpstreamDispatcher(model, retry_base_seconds=0.05, max_retries=5)
+    chat = dispatcher.start_chat(history=[])
+
+    chat.send_message("first")
+    response = chat.send_message("second") # The fake's quota allows one call per 0.1s
+
+    assert response.text == "Simulated answer to 'second'."
+    assert model.rate_limited_calls >= 1
+    assert model.calls == 2
+
+
+def test_rate_limited_call_pauses_the_bucket():
+    model = FakeGenerativeModel(first_chunk_latency="fixed:0", quota_rps=10, quota_burst=1)
+    dispatcher = UpstreamDispatcher(model, requests_per_second=100, retry_base_seconds=0.05, max_retries=5)
+    chat = dispatcher.start_chat(history=[])
+
+    chat.send_message("first")
+    chat.send_message("second")
+
+    assert model.rate_limited_calls >= 1
+    assert dispatcher._bucket.pauses >= 1
+
+
+def test_paused_bucket_hands_out_no_tokens_until_the_pause_ends():
+    bucket = TokenBucket(rate=100, burst=5)
+    bucket.pause(0.2)
+    assert not bucket.try_acquire()
+    assert bucket.reserve() >= 0.19
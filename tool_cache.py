@@ -0,0 +1,173 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# --- Argument normalization ---
+# Calls that differ only in letter case, surrounding/repeated whitespace or key order share a cache entry.
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def make_cache_key(tool_name, kwargs):
+    return tool_name + ":" + json.dumps(_normalize(kwargs), sort_keys=True, separators=(",", ":"), default=str)
+
+
+# --- Optional on-disk tier so cached results survive restarts ---
+class _SqliteTier:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        # Drop whatever expired while the server was down
+        self._conn.execute("DELETE FROM tool_cache WHERE expires_at <= ?", (time.time(),))
+        self._conn.commit()
+
+    def get(self, key):
+        """Returns (serialized value, seconds left) or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM tool_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        seconds_left = row[1] - time.time() # Wall clock, since monotonic time doesn't survive a restart
+        if seconds_left <= 0:
+            return None
+        return row[0], seconds_left
+
+    def put(self, key, serialized, ttl):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tool_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, serialized, time.time() + ttl),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# --- TTL + LRU cache for tool results ---
+class ToolResultCache:
+    """
+    Caches tool results keyed on (tool name, normalized arguments).
+
+    Entries expire after the tool's TTL, and the least recently used entries are evicted once the
+    serialized size of all entries exceeds `max_bytes`. Concurrent identical calls are collapsed:
+    the first caller runs the tool and the others wait for its result. Only dictionary results are
+    cached; exceptions are passed to every waiting caller and nothing is stored.
+    With `disk_path` set, results are also written to a sqlite file and read back after a restart.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, disk_path=None):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (result, size in bytes, expires_at monotonic), least recently used first
+        self._in_flight = {} # key -> Future shared by callers waiting on the same computation
+        self._lock = threading.Lock()
+        self._disk = _SqliteTier(disk_path) if disk_path else None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def call(self, tool_name, kwargs, compute, ttl):
+        """Returns the cached result for this call, or runs `compute()` (once for concurrent callers) and caches it."""
+        key = make_cache_key(tool_name, kwargs)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._drop_locked(key)
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                future = Future()
+                self._in_flight[key] = future
+                is_leader = True
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = self._load_from_disk(key)
+            if result is None:
+                with self._lock:
+                    self.misses += 1
+                result = compute()
+                if isinstance(result, dict):
+                    self._store(key, result, ttl, write_to_disk=True)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _load_from_disk(self, key):
+        if self._disk is None:
+            return None
+        stored = self._disk.get(key)
+        if stored is None:
+            return None
+        serialized, seconds_left = stored
+        result = json.loads(serialized)
+        with self._lock:
+            self.disk_hits += 1
+        self._store(key, result, seconds_left, write_to_disk=False)
+        return result
+
+    def _store(self, key, result, ttl, write_to_disk):
+        serialized = json.dumps(result, default=str)
+        size = len(serialized)
+        if size > self.max_bytes:
+            return # Never let one oversized result flush the whole cache
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            self._entries[key] = (result, size, time.monotonic() + ttl)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._drop_locked(oldest_key)
+                self.evictions += 1
+        if write_to_disk and self._disk is not None:
+            self._disk.put(key, serialized, ttl)
+
+    def _drop_locked(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+            }
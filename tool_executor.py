@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+
+from cancellation import TurnCancelled
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# --- Runs all tool calls from one model turn concurrently ---
+class ToolExecutor:
+    """
+    Dispatches every tool call of a model turn onto a shared thread pool at once and collects the
+    FunctionResponse parts in the original call order.
+
+    `execute_one(tool_call)` runs a single call and returns its FunctionResponse part dictionary.
+    Each call gets `timeouts[name]` seconds (or `default_timeout`), counted from dispatch. A call that
+    runs out of time is reported as a structured {"error": ...} response instead of holding up the turn;
+    if it hasn't started yet it is cancelled, otherwise its result is simply discarded when it finishes
+    (Python threads can't be interrupted). The same applies to every call of a turn that is cancelled.
+    """
+
+    def __init__(self, execute_one, max_workers=8, default_timeout=10.0, timeouts=None):
+        self._execute_one = execute_one
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def timeout_for(self, function_name):
+        return self.timeouts.get(function_name, self.default_timeout)
+
+    def run_all(self, tool_calls, cancel_scope=None):
+        """
+        Blocking version for the threaded (Flask) serving path. If `cancel_scope` is cancelled while waiting,
+        calls that haven't started are cancelled and TurnCancelled is raised at once.
+        """
+        dispatched_at = time.monotonic()
+        futures = [self._pool.submit(self._execute_one, tool_call) for tool_call in tool_calls]
+
+        # Resolved by the scope's callback, so waiting below wakes up as soon as the turn is cancelled
+        cancelled = Future()
+        if cancel_scope is not None:
+            cancel_scope.add_callback(lambda: cancelled.set_result(None))
+
+        tool_outputs = []
+        for tool_call, future in zip(tool_calls, futures):
+            deadline = dispatched_at + self.timeout_for(tool_call.name)
+            wait([future, cancelled], timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if cancelled.done():
+                for pending in futures:
+                    pending.cancel()
+                raise TurnCancelled()
+            try:
+                tool_outputs.append(future.result(timeout=0))
+            except FutureTimeoutError:
+                future.cancel()
+                tool_outputs.append(self._timeout_response(tool_call))
+        return tool_outputs
+
+    async def run_all_async(self, tool_calls):
+        """
+        Coroutine version for the asyncio serving path; tools still run on the thread pool.
+        Cancelling the awaiting task cancels calls that haven't started and stops waiting for the rest.
+        """
+        loop = asyncio.get_running_loop()
+
+        async def run_one(tool_call):
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(self._pool, self._execute_one, tool_call),
+                    timeout=self.timeout_for(tool_call.name),
+                )
+            except asyncio.TimeoutError:
+                return self._timeout_response(tool_call)
+
+        # gather keeps results in the order the calls were passed in
+        return await asyncio.gather(*(run_one(tool_call) for tool_call in tool_calls))
+
+    def _timeout_response(self, tool_call):
+        error_message = f"Tool '{tool_call.name}' timed out after {self.timeout_for(tool_call.name):g} seconds."
+        logger.warning("Tool Execution Timeout: %s", error_message)
+        metrics.counter("tool_calls_total", tool=tool_call.name, outcome="timeout").inc()
+        return {
+            "function_response": {
+                "name": tool_call.name,
+                "response": {"error": error_message},
+            }
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,78 @@
+import json
+from collections import namedtuple
+
+from response_cache import normalize_message
+
+# A tool call made by the server rather than requested by the model; has the same .name/.args as a FunctionCall
+ToolCall = namedtuple("ToolCall", ["name", "args"])
+
+PREFETCH_CONTEXT_HEADER = (
+    "Tool results fetched in advance for the next message. Answer from them if they are enough; "
+    "otherwise call tools as usual."
+)
+
+
+# --- Local matcher for a tool's known queries ---
+class PhraseMatcher:
+    """
+    Decides, without calling the model, which call a lookup tool would most likely get for a user message.
+    Matches when one of the `known_queries` appears as a phrase (whole words, in order) in the normalized
+    message, and returns `{argument: <longest matching query>}`. One-word queries only match a message
+    consisting of just that word, so e.g. "hi" doesn't match every sentence containing it.
+    Used as the `prefetch=` option of a registered tool.
+    """
+
+    def __init__(self, known_queries, argument="query"):
+        self.argument = argument
+        self._phrases_by_first_word = {} # first word -> [word tuple], longest first
+        for query in known_queries:
+            words = tuple(normalize_message(query).split())
+            if words:
+                self._phrases_by_first_word.setdefault(words[0], []).append(words)
+        for phrases in self._phrases_by_first_word.values():
+            phrases.sort(key=len, reverse=True)
+
+    def __call__(self, user_message):
+        words = normalize_message(user_message).split()
+        best = None
+        for start, word in enumerate(words):
+            for phrase in self._phrases_by_first_word.get(word, ()):
+                if len(phrase) == 1 and len(words) != 1:
+                    continue
+                if tuple(words[start:start + len(phrase)]) == phrase:
+                    if best is None or len(phrase) > len(best):
+                        best = phrase
+                    break # Phrases are longest first
+        if best is None:
+            return None
+        return {self.argument: " ".join(best)}
+
+
+def prefetch_tool_calls(registry, user_message):
+    """The calls to make ahead of the first model call: one per tool whose `prefetch` matcher matches the message."""
+    tool_calls = []
+    for registered_tool in registry:
+        matcher = registered_tool.options.get("prefetch")
+        if matcher is None:
+            continue
+        args = matcher(user_message)
+        if args is not None:
+            tool_calls.append(ToolCall(registered_tool.name, args))
+    return tool_calls
+
+
+def prefetch_context(tool_calls, tool_outputs):
+    """
+    Renders the successful prefetched results as a text part to send ahead of the user message,
+    or returns None when none succeeded (the turn then runs exactly as without prefetching).
+    """
+    lines = []
+    for tool_call, tool_output in zip(tool_calls, tool_outputs):
+        response = tool_output["function_response"]["response"]
+        if "error" in response:
+            continue
+        arguments = ", ".join(f"{name}={value!r}" for name, value in tool_call.args.items())
+        lines.append(f"{tool_call.name}({arguments}) -> {json.dumps(response, default=str)}")
+    if not lines:
+        return None
+    return PREFETCH_CONTEXT_HEADER + "\n" + "\n".join(lines)
@@ -0,0 +1,233 @@
+import inspect
+import typing
+
+
+class ToolArgumentError(ValueError):
+    """Raised when the model calls a tool with arguments that don't match its declaration."""
+
+
+# Python annotation -> Gemini schema type
+_SCHEMA_TYPES = {
+    str: "STRING",
+    int: "INTEGER",
+    float: "NUMBER",
+    bool: "BOOLEAN",
+    dict: "OBJECT",
+}
+
+
+# --- One registered tool: the Python function plus everything derived from its signature ---
+class RegisteredTool:
+    def __init__(self, name, function, declaration, validate_args, timeout, options):
+        self.name = name
+        self.function = function
+        self.declaration = declaration # FunctionDeclaration dict sent to Gemini
+        self.validate_args = validate_args # Compiled once: raw model args -> keyword arguments
+        self.timeout = timeout # Seconds, or None for the executor's default
+        self.options = options # Extra per-tool settings passed to the decorator (used by other layers)
+
+
+# --- Decorator-based registry of the tools the model may call ---
+class ToolRegistry:
+    """
+    Maps tool names to RegisteredTool objects. Register a tool with:
+
+        @available_tools.tool(timeout=5)
+        def search_tool(query: str):
+            \"\"\"Searches the web for information.
+
+            Args:
+                query: The search query.
+            \"\"\"
+
+    The Gemini function declaration is derived from the signature's type annotations and the docstring
+    (first paragraph as the description, `Args:` lines as parameter descriptions), and the argument
+    validator is compiled at registration time, so dispatching a call is a single dictionary lookup.
+    """
+
+    def __init__(self):
+        self._tools = {}
+
+    def tool(self, name=None, description=None, timeout=None, **options):
+        def register(function):
+            tool_name = name or function.__name__
+            if tool_name in self._tools:
+                raise ValueError(f"Tool '{tool_name}' is already registered")
+            declaration, validate_args = _compile_tool(tool_name, function, description)
+            self._tools[tool_name] = RegisteredTool(tool_name, function, declaration, validate_args, timeout, options)
+            return function
+        return register
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def __getitem__(self, name):
+        return self._tools[name]
+
+    def __iter__(self):
+        return iter(self._tools.values())
+
+    def __len__(self):
+        return len(self._tools)
+
+    def gemini_tools(self):
+        """The `tools=` argument for genai.GenerativeModel."""
+        return [{"function_declarations": [registered.declaration for registered in self._tools.values()]}]
+
+    def timeouts(self):
+        """Per-tool timeouts for tools that set one, keyed by name."""
+        return {registered.name: registered.timeout for registered in self._tools.values() if registered.timeout is not None}
+
+
+# --- Declaration and validator compilation ---
+
+def _compile_tool(tool_name, function, description):
+    signature = inspect.signature(function)
+    type_hints = typing.get_type_hints(function)
+    summary, param_docs = _parse_docstring(inspect.getdoc(function) or "")
+
+    properties = {}
+    required = []
+    checks = [] # (param name, required?, type label, converter) in signature order
+    for param in signature.parameters.values():
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            raise TypeError(f"Tool '{tool_name}': *args/**kwargs parameters can't be declared to the model")
+        annotation, is_optional = _unwrap_optional(type_hints.get(param.name, str))
+        schema = _schema_for(tool_name, param.name, annotation)
+        if param.name in param_docs:
+            schema["description"] = param_docs[param.name]
+        properties[param.name] = schema
+
+        is_required = param.default is param.empty and not is_optional
+        if is_required:
+            required.append(param.name)
+        checks.append((param.name, is_required) + _converter_for(annotation))
+
+    parameters = {"type": "OBJECT", "properties": properties}
+    if required:
+        parameters["required"] = required
+    declaration = {
+        "name": tool_name,
+        "description": description or summary or tool_name,
+        "parameters": parameters,
+    }
+    return declaration, _build_validator(tool_name, tuple(checks), frozenset(properties))
+
+
+def _build_validator(tool_name, checks, known_names):
+    def validate_args(raw_args):
+        # Gemini passes a proto map; a plain dict copy is cheaper to work with and safe to mutate
+        args = dict(raw_args) if raw_args is not None else {}
+        unknown = args.keys() - known_names
+        if unknown:
+            raise ToolArgumentError(f"Unexpected argument(s) for tool '{tool_name}': {sorted(unknown)}")
+        kwargs = {}
+        for param_name, is_required, type_label, convert in checks:
+            if param_name not in args:
+                if is_required:
+                    raise ToolArgumentError(f"Missing required argument '{param_name}' for tool '{tool_name}'")
+                continue
+            value = convert(args[param_name])
+            if value is _INVALID:
+                raise ToolArgumentError(
+                    f"Invalid argument '{param_name}' for tool '{tool_name}': expected {type_label}, "
+                    f"got {type(args[param_name]).__name__}"
+                )
+            kwargs[param_name] = value
+        return kwargs
+    return validate_args
+
+
+_INVALID = object()
+
+
+def _converter_for(annotation):
+    """Returns (type label, converter); the converter returns the accepted value or _INVALID."""
+    origin = typing.get_origin(annotation) or annotation
+    if origin is str:
+        return "string", lambda value: value if isinstance(value, str) else _INVALID
+    if origin is bool:
+        return "boolean", lambda value: value if isinstance(value, bool) else _INVALID
+    if origin is int:
+        # Struct values arrive from the API as floats, so accept whole-number floats for integers
+        def to_int(value):
+            if isinstance(value, bool):
+                return _INVALID
+            if isinstance(value, int):
+                return value
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            return _INVALID
+        return "integer", to_int
+    if origin is float:
+        return "number", lambda value: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else _INVALID
+    if origin is list:
+        # Repeated values arrive as proto sequences rather than lists
+        return "array", lambda value: list(value) if not isinstance(value, (str, bytes, dict)) and hasattr(value, "__iter__") else _INVALID
+    if origin is dict:
+        return "object", lambda value: dict(value) if hasattr(value, "keys") else _INVALID
+    raise TypeError(f"Unsupported tool parameter type: {annotation!r}")
+
+
+def _schema_for(tool_name, param_name, annotation):
+    origin = typing.get_origin(annotation) or annotation
+    if origin is list:
+        item_args = typing.get_args(annotation)
+        item_type = _SCHEMA_TYPES.get(item_args[0] if item_args else str)
+        if item_type is None:
+            raise TypeError(f"Tool '{tool_name}': unsupported list item type for parameter '{param_name}'")
+        return {"type": "ARRAY", "items": {"type": item_type}}
+    schema_type = _SCHEMA_TYPES.get(origin)
+    if schema_type is None:
+        raise TypeError(f"Tool '{tool_name}': unsupported type {annotation!r} for parameter '{param_name}'")
+    return {"type": schema_type}
+
+
+def _unwrap_optional(annotation):
+    """Optional[X] -> (X, True); anything else -> (annotation, False)."""
+    if typing.get_origin(annotation) is typing.Union:
+        non_none = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if len(non_none) == 1:
+            return non_none[0], True
+    return annotation, False
+
+
+_ARGS_HEADERS = ("Args:", "Arguments:", "Parameters:")
+
+
+def _parse_docstring(docstring):
+    """Splits a Google-style docstring into (first paragraph, {param name: description})."""
+    lines = docstring.splitlines()
+
+    summary_lines = []
+    for line in lines:
+        if not line.strip() or line.strip() in _ARGS_HEADERS:
+            break
+        summary_lines.append(line.strip())
+
+    param_docs = {}
+    in_args = False
+    param_indent = None
+    current_param = None
+    for line in lines:
+        stripped = line.strip()
+        if stripped in _ARGS_HEADERS:
+            in_args = True
+            continue
+        if not in_args or not stripped:
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0:
+            # Back at the left margin: the Args section is over
+            in_args = False
+            continue
+        if param_indent is None:
+            param_indent = indent
+        if indent == param_indent and ":" in stripped:
+            name, _, text = stripped.partition(":")
+            current_param = name.split("(")[0].strip() # Allow "name (type): description"
+            param_docs[current_param] = text.strip()
+        elif current_param is not None:
+            param_docs[current_param] += " " + stripped
+
+    return " ".join(summary_lines), param_docs
@@ -0,0 +1,503 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def is_rate_limited(error):
+    """True for a quota error: google.api_core's ResourceExhausted (or anything else carrying HTTP status 429)."""
+    return getattr(error, "code", None) == 429
+
+
+def _reply_parts(response):
+    if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        return list(response.candidates[0].content.parts)
+    return []
+
+
+def _turn_history(content, responses):
+    """The history entries of one turn: the user message and the model's reply gathered from `responses`."""
+    texts = [content] if isinstance(content, str) else list(content)
+    return [
+        {"role": "user", "parts": [{"text": text} for text in texts]},
+        {"role": "model", "parts": [part for response in responses for part in _reply_parts(response)]},
+    ]
+
+
+# --- Request quota ---
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average and bursts of up to `burst`. Thread-safe.
+    reserve() always takes a token, possibly one that only becomes available later, and returns how long the
+    caller has to wait for it; callers are therefore served in the order they asked.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self.pauses = 0 # Incremented by pause(); reservations made before a pause are void
+        self._tokens = self.burst
+        self._updated = time.monotonic() # May lie in the future while paused
+        self._lock = threading.Lock()
+
+    def _refill_locked(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            if self._tokens >= 1 and now >= self._updated:
+                self._tokens -= 1
+                return True
+            return False
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            self._tokens -= 1
+            wait = max(0.0, self._updated - now)
+            if self._tokens < 0:
+                wait += -self._tokens / self.rate
+            return wait
+
+    def pause(self, seconds):
+        """
+        Hands out no tokens for `seconds`, then starts again from an empty bucket. Callers still waiting on a
+        reservation must reserve again (see `pauses`), so they are spread out at `rate` after the pause
+        instead of all going at once.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = 0.0
+            self._updated = max(self._updated, now + seconds)
+            self.pauses += 1
+
+
+# --- One in-flight reply shared by identical requests ---
+class _SharedStream:
+    """
+    Replays the chunks of one streamed reply to every request coalesced onto it. Whichever consumer first
+    needs a chunk nobody has read yet pulls it from the upstream response, so the reply keeps flowing for the
+    others when one of them stops reading.
+    """
+
+    def __init__(self, response, content, on_finished):
+        self._response = response
+        self._content = content
+        self._on_finished = on_finished
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self.history = None # The turn as history entries, once the reply is complete
+        self.consumers = 0 # Guarded by the dispatcher's lock
+
+    def _finish(self, error):
+        # _done goes last: consumers reading without the lock rely on the error and history being set by then
+        self._error = error
+        if error is None:
+            self.history = _turn_history(self._content, self._chunks)
+        self._done = True
+        self._on_finished(self)
+
+
+class _SyncSharedStream(_SharedStream):
+    """
+    Only pulling from the upstream response is serialized (by `_lock`). Chunks already pulled are read
+    without it, so a consumer that is behind isn't held up by another one waiting on the network.
+    """
+
+    def __init__(self, response, content, on_finished):
+        super().__init__(iter(response), content, on_finished)
+        self._lock = threading.Lock()
+
+    def _pull_locked(self):
+        try:
+            self._chunks.append(next(self._response))
+        except StopIteration:
+            self._finish(None)
+        except Exception as error:
+            self._finish(error)
+
+    def chunks(self):
+        index = 0
+        while True:
+            if index == len(self._chunks) and not self._done:
+                with self._lock:
+                    if index == len(self._chunks) and not self._done: # Nobody pulled it while we waited
+                        self._pull_locked()
+            if index < len(self._chunks):
+                chunk = self._chunks[index]
+            elif self._error is not None:
+                raise self._error
+            else:
+                return
+            index += 1
+            yield chunk
+
+    def abandon(self):
+        pass # A blocked next() can't be interrupted; nobody asks for the next chunk
+
+
+class _AsyncSharedStream(_SharedStream):
+    """
+    Chunks are pulled by a separate task that consumers await through asyncio.shield(), so a consumer
+    being cancelled (e.g. on barge-in) doesn't cut the reply short for the others.
+    """
+
+    def __init__(self, response, content, on_finished):
+        super().__init__(response.__aiter__(), content, on_finished)
+        self._pulling = None
+
+    async def _pull(self):
+        try:
+            self._chunks.append(await self._response.__anext__())
+        except StopAsyncIteration:
+            self._finish(None)
+        except Exception as error:
+            self._finish(error)
+        finally:
+            self._pulling = None
+
+    async def chunks(self):
+        index = 0
+        while True:
+            if index == len(self._chunks) and not self._done:
+                if self._pulling is None:
+                    self._pulling = asyncio.ensure_future(self._pull())
+                await asyncio.shield(self._pulling)
+            if index < len(self._chunks):
+                chunk = self._chunks[index]
+            elif self._error is not None:
+                raise self._error
+            else:
+                return
+            index += 1
+            yield chunk
+
+    def abandon(self):
+        if self._pulling is not None:
+            self._pulling.cancel()
+
+
+# --- Every model call goes through here ---
+class UpstreamDispatcher:
+    """
+    Wraps a model (genai.GenerativeModel or a stand-in with the same start_chat() interface) so that every
+    send_message()/send_message_async() of its chats:
+
+      - waits for a token from a `requests_per_second` bucket (no limit when it is 0), keeping the server
+        under the API quota instead of finding the limit through 429s;
+      - is retried up to `max_retries` times on a 429, after an exponentially growing, jittered delay. With a
+        bucket, the delay pauses the bucket for *all* calls, which then resume at the bucket's rate, so a
+        quota error slows everyone down instead of setting off a retry storm;
+      - with `coalesce` on, shares one upstream call between identical requests in flight at the same time
+        on chats with an empty history (standalone first messages), which don't depend on any session state.
+        The shared call is made on a chat of its own, and each requesting chat gets the turn added to its
+        history only once it has read the whole reply, so a request cancelled part-way (e.g. on barge-in,
+        which rolls its history back) is left as it was, however long the others keep reading.
+
+    Only the call itself is retried: a 429 can't happen once a streamed reply has started, and an error
+    after that is passed on as before.
+    """
+
+    def __init__(self, model, requests_per_second=0.0, burst=None, max_retries=3, retry_base_seconds=0.5,
+                 retry_max_seconds=8.0, coalesce=False):
+        self.model = model
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.coalesce = coalesce
+        self._bucket = TokenBucket(requests_per_second, burst) if requests_per_second > 0 else None
+        self._lock = threading.Lock()
+        self._in_flight = {} # coalescing key -> shared reply, for threaded callers
+        self._in_flight_async = {} # the same for asyncio callers (their futures belong to the event loop)
+        self._rng = random.Random()
+
+    def start_chat(self, history=None):
+        return DispatchedChat(self, self.model.start_chat(history=history))
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def stats(self):
+        with self._lock:
+            return {"coalescing": len(self._in_flight) + len(self._in_flight_async)}
+
+    # --- Quota and retries ---
+    def _retry_delay(self, attempt):
+        ceiling = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempt)
+        return ceiling / 2 + self._rng.uniform(0, ceiling / 2)
+
+    def _on_rate_limited(self, attempt):
+        """Returns how long the caller itself should sleep before retrying."""
+        delay = self._retry_delay(attempt)
+        metrics.counter("upstream_requests_total", outcome="rate_limited").inc()
+        logger.warning("Upstream Rate Limited: retrying in %.2fs (attempt %s)", delay, attempt + 1)
+        if self._bucket is None:
+            return delay
+        self._bucket.pause(delay) # The retry waits for a token like everyone else
+        return 0.0
+
+    def _wait_for_token(self):
+        if self._bucket is None:
+            return
+        started = time.monotonic()
+        while True:
+            pauses = self._bucket.pauses
+            time.sleep(self._bucket.reserve())
+            if self._bucket.pauses == pauses:
+                break
+        metrics.observe_stage("upstream_wait", time.monotonic() - started)
+
+    async def _wait_for_token_async(self):
+        if self._bucket is None:
+            return
+        started = time.monotonic()
+        while True:
+            pauses = self._bucket.pauses
+            await asyncio.sleep(self._bucket.reserve())
+            if self._bucket.pauses == pauses:
+                break
+        metrics.observe_stage("upstream_wait", time.monotonic() - started)
+
+    def _call(self, send):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_token()
+            try:
+                response = send()
+            except Exception as error:
+                if not is_rate_limited(error) or attempt == self.max_retries:
+                    metrics.counter("upstream_requests_total", outcome="error").inc()
+                    raise
+                time.sleep(self._on_rate_limited(attempt))
+                continue
+            metrics.counter("upstream_requests_total", outcome="ok").inc()
+            return response
+
+    async def _call_async(self, send):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_token_async()
+            try:
+                response = await send()
+            except Exception as error:
+                if not is_rate_limited(error) or attempt == self.max_retries:
+                    metrics.counter("upstream_requests_total", outcome="error").inc()
+                    raise
+                await asyncio.sleep(self._on_rate_limited(attempt))
+                continue
+            metrics.counter("upstream_requests_total", outcome="ok").inc()
+            return response
+
+    # --- Coalescing ---
+    def _coalescing_key(self, chat, content, stream, kwargs):
+        if not self.coalesce or kwargs or chat.history:
+            return None
+        if isinstance(content, str):
+            return (stream, content)
+        if isinstance(content, (list, tuple)) and all(isinstance(part, str) for part in content):
+            return (stream, tuple(content)) # A message sent with prefetched tool results
+        return None
+
+    # A shared call is made on a chat of its own: no session's history is touched until its request has the
+    # whole reply (see _consume), so a session cancelled mid-reply stays as it was rolled back
+    def _send_standalone(self, content, stream=False):
+        return self.model.start_chat(history=[]).send_message(content, stream=stream)
+
+    async def _send_standalone_async(self, content, stream=False):
+        return await self.model.start_chat(history=[]).send_message_async(content, stream=stream)
+
+    def _finished(self, in_flight, key, shared):
+        with self._lock:
+            if in_flight.get(key) is shared:
+                del in_flight[key]
+
+    def _join_or_lead(self, in_flight, key, new_shared):
+        """
+        Returns (shared reply, is_leader): the reply in flight for `key`, or one made by `new_shared()` and
+        registered for `key` if there is none. The caller counts as one of its consumers either way.
+        Looking up and registering under one lock hold makes sure identical requests get a single leader.
+        """
+        with self._lock:
+            shared = in_flight.get(key)
+            leader = shared is None
+            if leader:
+                shared = in_flight[key] = new_shared()
+            shared.consumers += 1
+        if not leader:
+            metrics.counter("upstream_requests_total", outcome="coalesced").inc()
+        return shared, leader
+
+    def _leave(self, in_flight, key, shared):
+        with self._lock:
+            shared.consumers -= 1
+            if shared.consumers > 0 or in_flight.get(key) is not shared:
+                return
+            # Everyone stopped reading before the reply was complete; later requests start afresh
+            del in_flight[key]
+        shared.abandon()
+
+    def send_message(self, chat, content, stream=False, **kwargs):
+        key = self._coalescing_key(chat, content, stream, kwargs)
+        if key is None:
+            return self._call(lambda: chat.send_message(content, stream=stream, **kwargs))
+
+        if not stream:
+            # Identical requests arriving meanwhile wait for this one's reply
+            future, leader = self._join_or_lead(self._in_flight, key, lambda: _ReplyFuture(content))
+            if not leader:
+                return future.wait(chat)
+            try:
+                future.set(response=self._call(lambda: self._send_standalone(content)))
+            except Exception as error:
+                future.set(error=error)
+                raise
+            finally:
+                self._finished(self._in_flight, key, future)
+            return future.wait(chat)
+        # The upstream call is made once the first chunk is asked for, under the shared stream's lock,
+        # so identical requests arriving meanwhile wait for it instead of making their own
+        shared, _ = self._join_or_lead(self._in_flight, key, lambda: _SyncSharedStream(
+            _LazyCall(lambda: self._call(lambda: self._send_standalone(content, stream=True))),
+            content, lambda done: self._finished(self._in_flight, key, done)))
+        return self._consume(shared, chat, key)
+
+    def _consume(self, shared, chat, key):
+        try:
+            yield from shared.chunks()
+        finally:
+            self._leave(self._in_flight, key, shared)
+        # Only reached when the whole reply was read
+        if shared.history is not None:
+            chat.history = list(chat.history) + shared.history
+
+    async def send_message_async(self, chat, content, stream=False, **kwargs):
+        key = self._coalescing_key(chat, content, stream, kwargs)
+        if key is None:
+            return await self._call_async(lambda: chat.send_message_async(content, stream=stream, **kwargs))
+
+        if not stream:
+            future, leader = self._join_or_lead(self._in_flight_async, key, lambda: _AsyncReplyFuture(content))
+            if not leader:
+                return await future.wait(chat)
+            try:
+                future.set(response=await self._call_async(lambda: self._send_standalone_async(content)))
+            except BaseException as error: # Including CancelledError, so waiting requests don't hang
+                future.set(error=error)
+                raise
+            finally:
+                self._finished(self._in_flight_async, key, future)
+            return await future.wait(chat)
+        shared, _ = self._join_or_lead(self._in_flight_async, key, lambda: _AsyncSharedStream(
+            _LazyAsyncCall(lambda: self._call_async(lambda: self._send_standalone_async(content, stream=True))),
+            content, lambda done: self._finished(self._in_flight_async, key, done)))
+        return self._consume_async(shared, chat, key)
+
+    async def _consume_async(self, shared, chat, key):
+        try:
+            async for chunk in shared.chunks():
+                yield chunk
+        finally:
+            self._leave(self._in_flight_async, key, shared)
+        # Only reached when the whole reply was read
+        if shared.history is not None:
+            chat.history = list(chat.history) + shared.history
+
+
+class _LazyCall:
+    """Iterator that makes the upstream call when its first chunk is asked for, inside the shared stream's lock."""
+
+    def __init__(self, call):
+        self._call = call
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self._call())
+        return next(self._iterator)
+
+
+class _LazyAsyncCall:
+    def __init__(self, call):
+        self._call = call
+        self._iterator = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = (await self._call()).__aiter__()
+        return await self._iterator.__anext__()
+
+
+class _ReplyFuture:
+    """A non-streamed reply shared by identical requests."""
+
+    def __init__(self, content):
+        self._content = content
+        self._event = threading.Event()
+        self._error = None
+        self.response = None
+        self.consumers = 0
+
+    def set(self, response=None, error=None):
+        self.response, self._error = response, error
+        self._event.set()
+
+    def _result(self, chat):
+        if self._error is not None:
+            raise self._error
+        chat.history = list(chat.history) + _turn_history(self._content, [self.response])
+        return self.response
+
+    def wait(self, chat):
+        self._event.wait()
+        return self._result(chat)
+
+
+class _AsyncReplyFuture(_ReplyFuture):
+    def __init__(self, content):
+        super().__init__(content)
+        self._event = asyncio.Event()
+
+    async def wait(self, chat):
+        await self._event.wait()
+        return self._result(chat)
+
+
+# --- Chat session whose model calls go through the dispatcher ---
+class DispatchedChat:
+    """Drop-in for genai.ChatSession: send_message()/send_message_async() are dispatched, everything else is passed through."""
+
+    def __init__(self, dispatcher, chat):
+        self._dispatcher = dispatcher
+        self._chat = chat
+
+    @property
+    def history(self):
+        return self._chat.history
+
+    @history.setter
+    def history(self, history):
+        self._chat.history = history
+
+    def send_message(self, content, stream=False, **kwargs):
+        return self._dispatcher.send_message(self._chat, content, stream=stream, **kwargs)
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        return await self._dispatcher.send_message_async(self._chat, content, stream=stream, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)